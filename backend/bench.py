@@ -0,0 +1,353 @@
+"""
+  Ingestion benchmark
+
+  Drives `addHandler`/`changeHandler` with synthetic InterfacesAdded
+  and PropertiesChanged signals, the way the GLib main loop would,
+  and reports throughput, commit latency and rows written per event.
+
+  Use a scratch database, the generated devices are stored like real ones:
+
+    sudo -i -u postgres createdb blt_bench
+    BTDM_DATABASE=postgresql:///blt_bench sudo -E python3 -m backend.bench --devices 2000 --duration 60
+"""
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from gi.repository import GLib
+
+from . import bt
+from .models import Presence
+
+DEVICE = 'org.bluez.Device1'
+
+# (service, [(characteristic, flags)]) picked from for the GATT trees
+GATT_SERVICES = [
+  ('1800', [('2A00', ['read']), ('2A01', ['read'])]),
+  ('180A', [('2A29', ['read']), ('2A24', ['read']), ('2A26', ['read'])]),
+  ('180F', [('2A19', ['read', 'notify'])]),
+  ('FE9F', [('C3A2', ['write-without-response', 'notify'])]),
+]
+
+COMPANIES = [0x004C, 0x0006, 0x0075, 0x00E0]
+
+def fullUUID(short):
+  return f'0000{short}-0000-1000-8000-00805f9b34fb'
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+
+  values = sorted(values)
+
+  return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class SignalGenerator(object):
+  """
+    SignalGenerator
+
+    Description: Synthetic BlueZ signal stream. Every device appears
+    once (plus its GATT tree), then reports RSSI `rssiRate` times a
+    second. Payloads change with probability `payloadChurn` per
+    report and `rotating` devices get a new random address every
+    `rotateEvery` seconds, reappearing with InterfacesAdded.
+
+    Devices are spread over `adapters` adapters (hci0..hciN-1) and
+    an `overlap` fraction is also heard by a second one, which then
+    reports it on its own object path.
+
+    Events are (simulated seconds, kind, path, parameters) where kind
+    is 'added'/'changed' and parameters the GLib.Variant BlueZ sends.
+  """
+  def __init__(self, devices = 1000, rssiRate = 1.0, payloadChurn = 0.1, gatt = 0.05, rotating = 0.2, rotateEvery = 900, seed = 0, adapters = 1, overlap = 0.0):
+    self.random = random.Random(seed)
+    self.devices = devices
+    self.rssiRate = rssiRate
+    self.payloadChurn = payloadChurn
+    self.gatt = gatt
+    self.rotating = rotating
+    self.rotateEvery = rotateEvery
+    self.adapters = adapters
+    self.overlap = overlap
+
+  def address(self, private = False):
+    octets = [self.random.randrange(256) for i in range(6)]
+
+    # resolvable private addresses have 01 as the top bits
+    if private:
+      octets[0] = 0x40 | (octets[0] & 0x3F)
+
+    return ':'.join(f'{octet:02X}' for octet in octets)
+
+  def path(self, addr, adapter = 'hci0'):
+    return f'/org/bluez/{adapter}/dev_{addr.replace(":", "_")}'
+
+  def hearing(self, index):
+    """
+      hearing
+
+      @param index - Integer device number
+      @return list of String adapter names that hear the device
+    """
+    home = index % self.adapters
+    names = [f'hci{home}']
+
+    if self.adapters > 1 and self.random.random() < self.overlap:
+      names.append(f'hci{(home + 1) % self.adapters}')
+
+    return names
+
+  def payload(self):
+    return bytes(self.random.randrange(256) for i in range(self.random.randrange(4, 24)))
+
+  def manufacturerData(self):
+    return GLib.Variant('a{qv}', { self.random.choice(COMPANIES): GLib.Variant('ay', self.payload()) })
+
+  def added(self, addr, adapter = 'hci0'):
+    properties = {
+      'Address': GLib.Variant('s', addr),
+      'Alias': GLib.Variant('s', addr.replace(':', '-')),
+      'RSSI': GLib.Variant('n', self.random.randrange(-100, -30)),
+      'ManufacturerData': self.manufacturerData(),
+      'UUIDs': GLib.Variant('as', [fullUUID(service) for service, characteristics in self.random.sample(GATT_SERVICES, 2)]),
+    }
+
+    return GLib.Variant('(oa{sa{sv}})', (self.path(addr, adapter), { DEVICE: properties }))
+
+  def tree(self, addr, adapter = 'hci0'):
+    """
+      tree
+
+      @return list of (path, GLib.Variant) InterfacesAdded per GATT object
+    """
+    out = []
+    device = self.path(addr, adapter)
+    handle = 1
+
+    for service, characteristics in GATT_SERVICES:
+      servicePath = f'{device}/service{handle:04x}'
+      out.append((servicePath, GLib.Variant('(oa{sa{sv}})', (servicePath, { bt.GATT_SERVICE: {
+        'UUID': GLib.Variant('s', fullUUID(service)),
+        'Device': GLib.Variant('o', device),
+        'Primary': GLib.Variant('b', True),
+      }}))))
+
+      for characteristic, flags in characteristics:
+        handle += 1
+        charPath = f'{servicePath}/char{handle:04x}'
+        out.append((charPath, GLib.Variant('(oa{sa{sv}})', (charPath, { bt.GATT_CHAR: {
+          'UUID': GLib.Variant('s', fullUUID(characteristic)),
+          'Service': GLib.Variant('o', servicePath),
+          'Flags': GLib.Variant('as', flags),
+          'Value': GLib.Variant('ay', self.payload()),
+        }}))))
+
+        if 'notify' in flags:
+          handle += 1
+          descPath = f'{charPath}/desc{handle:04x}'
+          out.append((descPath, GLib.Variant('(oa{sa{sv}})', (descPath, { bt.GATT_DESC: {
+            'UUID': GLib.Variant('s', fullUUID('2902')),
+            'Characteristic': GLib.Variant('o', charPath),
+            'Value': GLib.Variant('ay', b'\x00\x00'),
+          }}))))
+
+      handle += 1
+
+    return out
+
+  def changed(self, properties):
+    return GLib.Variant('(sa{sv}as)', (DEVICE, properties, []))
+
+  def appear(self, when, addr, gatt, adapters):
+    for adapter in adapters:
+      yield (when, 'added', self.path(addr, adapter), self.added(addr, adapter))
+
+    # connections go through one adapter
+    if gatt:
+      for path, parameters in self.tree(addr, adapters[0]):
+        yield (when, 'added', path, parameters)
+
+      yield (when, 'changed', self.path(addr, adapters[0]), self.changed({ 'ServicesResolved': GLib.Variant('b', True) }))
+
+  def events(self, duration):
+    """
+      events
+
+      @param duration - Integer simulated seconds
+      @return generator of (seconds, kind, path, GLib.Variant)
+    """
+    devices = []
+
+    for i in range(self.devices):
+      rotating = self.random.random() < self.rotating
+      gatt = self.random.random() < self.gatt
+      addr = self.address(rotating)
+      adapters = self.hearing(i)
+      devices.append([addr, rotating, gatt, self.random.uniform(0, self.rotateEvery), adapters])
+
+      yield from self.appear(0.0, addr, gatt, adapters)
+
+    step = 1 / self.rssiRate
+
+    for tick in range(1, int(duration * self.rssiRate) + 1):
+      when = tick * step
+
+      for device in devices:
+        addr, rotating, gatt, rotateAt, adapters = device
+
+        if rotating and when >= rotateAt:
+          addr = device[0] = self.address(True)
+          device[3] = when + self.rotateEvery
+
+          yield from self.appear(when, addr, gatt, adapters)
+
+        for adapter in adapters:
+          yield (when, 'changed', self.path(addr, adapter), self.changed({ 'RSSI': GLib.Variant('n', self.random.randrange(-100, -30)) }))
+
+        if self.random.random() < self.payloadChurn:
+          yield (when, 'changed', self.path(addr, adapters[0]), self.changed({ 'ManufacturerData': self.manufacturerData() }))
+
+class CommitLatency(object):
+  """
+    CommitLatency
+
+    IngestBuffer listener. Time between a presence row being queued
+    by a worker and its flush committing.
+  """
+  def __init__(self):
+    self.samples = []
+    self.lock = threading.Lock()
+
+  def __call__(self, committed):
+    now = datetime.now(timezone.utc)
+    rows = committed.get(Presence.__table__, [])
+
+    with self.lock:
+      self.samples.extend((now - row['time']).total_seconds() * 1000 for row in rows if row['time'].tzinfo is not None)
+
+def drain(timeout = 300):
+  """
+    drain
+
+    Waits for the workers to handle every submitted event, then
+    flushes the buffer
+  """
+  deadline = time.monotonic() + timeout
+
+  while time.monotonic() < deadline:
+    stats = bt.pool.stats()
+
+    if stats['processed'] >= stats['submitted']:
+      break
+
+    time.sleep(0.01)
+
+  bt.buffer.flush()
+
+def run(generator, duration, realtime = False):
+  """
+    run
+
+    Feeds the generated signals to the handlers
+
+    @param generator - SignalGenerator
+    @param duration - Integer simulated seconds
+    @param realtime - Bool pace events on their simulated time
+    @return report - Dict
+  """
+  bt.start(signals=False)
+
+  latency = CommitLatency()
+  bt.buffer.listen(latency)
+
+  before = dict(bt.buffer.stats)
+  poolBefore = bt.pool.stats()
+  bt.buffer.latencies.clear()
+
+  counts = { 'added': 0, 'changed': 0 }
+  addrs = set()
+  start = time.perf_counter()
+
+  for when, kind, path, parameters in generator.events(duration):
+    if realtime:
+      delay = when - (time.perf_counter() - start)
+
+      if delay > 0:
+        time.sleep(delay)
+
+    counts[kind] += 1
+
+    if kind == 'added':
+      addrs.add(bt.dbusPathToMac(path))
+      bt.addHandler(None, ':1.0', '/', 'org.freedesktop.DBus.ObjectManager', 'InterfacesAdded', parameters, None)
+    else:
+      bt.changeHandler(None, ':1.0', path, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', parameters, None)
+
+  submitted = time.perf_counter() - start
+  drain()
+  elapsed = time.perf_counter() - start
+
+  after = bt.buffer.stats
+  poolAfter = bt.pool.stats()
+  events = counts['added'] + counts['changed']
+  rows = after['rows'] - before['rows']
+  updates = after['updates'] - before['updates']
+  flushes = list(bt.buffer.latencies)
+
+  return {
+    'events': events,
+    'added': counts['added'],
+    'changed': counts['changed'],
+    'devices': len(addrs),
+    'dropped': poolAfter['dropped'] - poolBefore['dropped'],
+    'errors': poolAfter['errors'] - poolBefore['errors'],
+    'submitSeconds': submitted,
+    'seconds': elapsed,
+    'eventsPerSecond': events / elapsed if elapsed else 0.0,
+    'flushes': after['flushes'] - before['flushes'],
+    'flushP50': percentile(flushes, 50),
+    'flushP95': percentile(flushes, 95),
+    'flushP99': percentile(flushes, 99),
+    'commitP50': percentile(latency.samples, 50),
+    'commitP95': percentile(latency.samples, 95),
+    'commitP99': percentile(latency.samples, 99),
+    'rows': rows,
+    'updates': updates,
+    # mac rows are inserted by the workers, outside of the buffer
+    'rowsPerEvent': (rows + updates + len(addrs)) / events if events else 0.0,
+  }
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Synthetic D-Bus signal ingestion benchmark')
+  parser.add_argument('--devices', type=int, default=1000)
+  parser.add_argument('--duration', type=int, default=30, help='simulated seconds')
+  parser.add_argument('--rssi-rate', type=float, default=1.0, help='RSSI updates per device per second')
+  parser.add_argument('--payload-churn', type=float, default=0.1, help='chance a report also changes the payload')
+  parser.add_argument('--gatt', type=float, default=0.05, help='fraction of devices with a GATT tree')
+  parser.add_argument('--rotating', type=float, default=0.2, help='fraction of devices rotating their address')
+  parser.add_argument('--rotate-every', type=int, default=900, help='seconds between address rotations')
+  parser.add_argument('--realtime', action='store_true', help='pace events on their simulated time')
+  parser.add_argument('--adapters', type=int, default=1, help='adapters the devices are spread over')
+  parser.add_argument('--overlap', type=float, default=0.0, help='fraction of devices also heard by a second adapter')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+
+  generator = SignalGenerator(args.devices, args.rssi_rate, args.payload_churn, args.gatt, args.rotating, args.rotate_every, args.seed, args.adapters, args.overlap)
+  report = run(generator, args.duration, args.realtime)
+
+  print(f'events       {report["events"]} ({report["added"]} added, {report["changed"]} changed) from {report["devices"]} addresses')
+  print(f'dropped      {report["dropped"]}   errors {report["errors"]}')
+  print(f'throughput   {report["eventsPerSecond"]:.0f} events/s ({report["seconds"]:.2f}s, submitted in {report["submitSeconds"]:.2f}s)')
+  print(f'flush        p50 {report["flushP50"]:.1f}ms  p95 {report["flushP95"]:.1f}ms  p99 {report["flushP99"]:.1f}ms  ({report["flushes"]} flushes)')
+  print(f'commit       p50 {report["commitP50"]:.1f}ms  p95 {report["commitP95"]:.1f}ms  p99 {report["commitP99"]:.1f}ms')
+  print(f'db rows      {report["rows"]} inserted, {report["updates"]} upserted/updated, {report["rowsPerEvent"]:.3f} per event')
+
+  bt.shutdown()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -1,355 +1,709 @@
 import re
 import sys
 import json
+import time
+import atexit
 import logging
+import threading
 from datetime import datetime, timezone
 from gi.repository import Gio, GLib
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm.session import sessionmaker
 
-GATT_SERVICE = 'org.bluez.GattService1'
-GATT_CHAR = 'org.bluez.GattCharacteristic1'
-GATT_DESC = 'org.bluez.GattDescriptor1'
-
 logger = logging.getLogger(__name__)
 
+# cold boot timings, see `start` and `/api/ingest`
+BOOT_START = time.monotonic()
+
 if __name__ == '__main__':
   logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
-  from models import Mac, OUID, Data, RSSI, Presence, UUID, UUID_Lookup, engine
-  from util import macHasUUID, safeCommit, dbusPathToMac
+  from models import Mac, Presence, PresenceRollup, UUID, engine
+  from util import safeCommit, dbusPathToMac, dbusPathToAdapter, macsAndPresence2json, row2json
+  from events import EventHub
+  from ingest import IngestBuffer
+  from lookup import OUIResolver, UUIDResolver
+  from cache import DeviceCache
+  from leaderboard import Leaderboard
+  from gatt import GattBatches, GATT_TYPES, GATT_SERVICE, GATT_CHAR, GATT_DESC, gattValue
+  from workers import WorkerPool
+  from rollup import PresenceRollups, backfill
+  from rssi import aggregator as rssis
+  from payload import store as payloads
+  from partitions import prepare, Maintenance
+  from migrations import migrate
+  from capture import CaptureWriter
+  from metrics import counter, histogram, collected
+  from seed import load as seed
+  from config import WORKERS, QUEUE_SIZE, FLUSH_INTERVAL, FLUSH_ROWS, DEVICE_CACHE_SIZE, LEADERBOARD_SIZE, GATT_IDLE, CAPTURE, CAPTURE_ONLY, ADAPTER, ADAPTERS
 else:
-  from backend.models import Mac, OUID, Data, RSSI, Presence, UUID, UUID_Lookup, engine
-  from backend.util import macHasUUID, safeCommit, dbusPathToMac
+  from backend.models import Mac, Presence, PresenceRollup, UUID, engine
+  from backend.util import safeCommit, dbusPathToMac, dbusPathToAdapter, macsAndPresence2json, row2json
+  from backend.events import EventHub
+  from backend.ingest import IngestBuffer
+  from backend.lookup import OUIResolver, UUIDResolver
+  from backend.cache import DeviceCache
+  from backend.leaderboard import Leaderboard
+  from backend.gatt import GattBatches, GATT_TYPES, GATT_SERVICE, GATT_CHAR, GATT_DESC, gattValue
+  from backend.workers import WorkerPool
+  from backend.rollup import PresenceRollups, backfill
+  from backend.rssi import aggregator as rssis
+  from backend.payload import store as payloads
+  from backend.partitions import prepare, Maintenance
+  from backend.migrations import migrate
+  from backend.capture import CaptureWriter
+  from backend.metrics import counter, histogram, collected
+  from backend.seed import load as seed
+  from backend.config import WORKERS, QUEUE_SIZE, FLUSH_INTERVAL, FLUSH_ROWS, DEVICE_CACHE_SIZE, LEADERBOARD_SIZE, GATT_IDLE, CAPTURE, CAPTURE_ONLY, ADAPTER, ADAPTERS
+
+# Nothing below touches the database or the system bus until `start`
+
+# one session per thread (ingestion workers), connections come from the engine pool
+session = scoped_session(sessionmaker(bind=engine))
+
+# daily partitions for presence/rssi_summary/data and the retention window
+maintenance = Maintenance(engine)
+
+# presence/rssi/data/uuid rows are written behind in batches
+buffer = IngestBuffer(engine, FLUSH_INTERVAL, FLUSH_ROWS)
+
+# vendor prefixes and uuids are resolved in memory, see `/api/lookup/reload`
+ouis = OUIResolver()
+uuidLookups = UUIDResolver()
+
+# per device state so the hot path does not SELECT the mac row
+devices = DeviceCache(DEVICE_CACHE_SIZE)
+buffer.register(devices.collect)
+
+# most seen devices for `count=` requests, see backend/leaderboard.py
+leaders = Leaderboard(LEADERBOARD_SIZE)
+
+# a connected device's services/characteristics/descriptors are written together
+gatt = GattBatches(GATT_IDLE)
+buffer.register(gatt.collect)
+
+# a device read back after eviction knows the uuids not committed yet
+devices.register(lambda mac_id: [row['uuid'] for row in buffer.queued(UUID) if row['mac_id'] == mac_id])
+devices.register(gatt.queued)
+buffer.listen(devices.flushed)
+buffer.listen(gatt.flushed)
+
+# per device/time bucket presence counts for the timeline graph
+rollups = PresenceRollups()
+buffer.register(rollups.collect)
+
+# rssi is coalesced into per-window summaries, raw samples stay in memory
+buffer.register(rssis.collect)
+
+# advertisement payloads are stored once per (mac, key, content)
+buffer.register(payloads.collect)
+
+# committed rows are pushed to `/api/stream` clients
+hub = EventHub()
+
+boot = {
+  'steps': {},
+  'ready': None,
+  'firstIngest': None,
+}
+
+# changes whenever a cached API response would be wrong rather than just
+# late (a new or deleted device, a reset), see backend/responses.py
+generation = 0
+
+def invalidate():
+  global generation
+  generation += 1
+
+  return generation
+
+def publishRows(written):
+  """
+    publishRows
+
+    IngestBuffer listener. One `batch` event per flush with the new
+    presence/rssi/data rows.
+
+    @param written - Dict of Table -> committed rows
+  """
+  samples = rssis.drain()
+  datas = payloads.drain()
+
+  if boot['firstIngest'] is None and any(table.name == 'presence' and rows for table, rows in written.items()):
+    boot['firstIngest'] = time.monotonic() - BOOT_START
+    logger.info(f'First advertisement ingested {boot["firstIngest"]:.2f}s after boot')
+
+  if not hub.active():
+    return
+
+  out = {}
+
+  for table, rows in written.items():
+    if table.name == 'presence':
+      out[table.name] = [row2json(row) for row in rows]
 
-Session = sessionmaker(bind=engine)
-session = Session()
+  if datas:
+    out['data'] = [row2json(row) for row in datas]
+
+  if samples:
+    out['rssi'] = [row2json({ 'mac_id': mac_id, 'time': when, 'rssi': rssi }) for mac_id, when, rssi in samples]
+
+  if out:
+    hub.publish('batch', out)
+
+buffer.listen(publishRows)
 
-bus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
 cancel = Gio.Cancellable.new()
 
-"""
-  Setup DBus Proxy Objects for manager and first bluetooth adapter
+class LazyProxy(object):
+  """
+    LazyProxy
 
-  https://lazka.github.io/pgi-docs/#Gio-2.0/classes/DBusProxy.html#Gio.DBusProxy.new_sync
+    Description: Gio.DBusProxy built on first use, so importing this
+    module does no D-Bus I/O. Attribute access is forwarded to the
+    proxy (ex: `adapter.StartDiscovery()`).
 
-  @param connection - DBus Connection
-  @param flags - Gio.DBusProxyFlags
-  @param info - Gio.DBusInterfaceInfo/None
-  @param name - str/None
-  @param object_path - str
-  @param interface_name - str
-  @param cancellable - Gio.Cancellable/None
+    https://lazka.github.io/pgi-docs/#Gio-2.0/classes/DBusProxy.html#Gio.DBusProxy.new_sync
+
+    @param object_path - str
+    @param interface_name - str
+  """
+  def __init__(self, object_path, interface_name):
+    self.object_path = object_path
+    self.interface_name = interface_name
+    self.proxy = None
+    self.lock = threading.Lock()
+
+  def get(self):
+    with self.lock:
+      if self.proxy is None:
+        self.proxy = Gio.DBusProxy.new_sync(
+          Gio.bus_get_sync(Gio.BusType.SYSTEM),
+          Gio.DBusProxyFlags.NONE,
+          None,
+          'org.bluez',
+          self.object_path,
+          self.interface_name,
+          cancel,
+        )
+
+      return self.proxy
+
+  def __getattr__(self, name):
+    return getattr(self.get(), name)
+
+"""
+  DBus Proxy Objects for manager and the default bluetooth adapter
 """
-manager = Gio.DBusProxy.new_sync(
-  bus,
-  Gio.DBusProxyFlags.NONE,
-  None,
-  'org.bluez',
-  '/',
-  'org.freedesktop.DBus.ObjectManager',
-  cancel,
-)
-
-adapter = Gio.DBusProxy.new_sync(
-  bus,
-  Gio.DBusProxyFlags.NONE,
-  None,
-  'org.bluez',
-  '/org/bluez/hci0',
-  'org.bluez.Adapter1',
-  cancel,
-)
+manager = LazyProxy('/', 'org.freedesktop.DBus.ObjectManager')
 
-def addHandler(*args):
+# one proxy per adapter name, see `adapterFor`
+adapterProxies = {}
+adapterLock = threading.Lock()
+
+def adapterFor(name):
   """
-    addHandler
+    adapterFor
 
-    InterfacesAdded signal
+    @param name - String adapter name (hci0, hci1..)
+    @return LazyProxy org.bluez.Adapter1
+  """
+  with adapterLock:
+    if name not in adapterProxies:
+      adapterProxies[name] = LazyProxy(f'/org/bluez/{name}', 'org.bluez.Adapter1')
 
-    Callable function for DBusSignalCallback
-    https://lazka.github.io/pgi-docs/Gio-2.0/callbacks.html#Gio.DBusSignalCallback
+    return adapterProxies[name]
 
-    @param connection - DBus Connection
-    @param sender_name - String
-    @param interface_name - String
-    @param signal_name - String (Also called 'member_name')
-    @param parameters - Dict
-    @param user_data - ?
+def adapterNames():
   """
-  data = args[5]
-  path = data[0]
-  interfaces = data[1]
+    adapterNames
 
-  try:
-    device = interfaces['org.bluez.Device1']
+    BTDM_ADAPTERS when set, otherwise every adapter BlueZ reports.
+    Devices seen by several adapters are merged on their address.
 
-    addr = device['Address']
-    name = device['Alias']
-    addrPrefix = addr.replace(':', '')[0:6]
-    ouid = None
-    updated = False
+    @return list of String adapter names, hci2 before hci10
+  """
+  if ADAPTERS:
+    return list(ADAPTERS)
 
-    logger.info(json.dumps(device))
+  objects = manager.GetManagedObjects()
+  names = [path.rsplit('/', 1)[1] for path, interfaces in objects.items() if 'org.bluez.Adapter1' in interfaces]
 
-    for oui in session.query(OUID).filter(OUID.prefix.like(addrPrefix)):
-      logger.info(f'OUID {oui.vendor}')
-      ouid = oui.id
+  return sorted(names, key=lambda name: (len(name), name)) or [ADAPTER]
 
-    mac = session.query(Mac).filter(Mac.addr == addr).first()
+adapter = adapterFor(ADAPTER)
 
-    if mac:
-      logger.info(f'Seen {mac.addr} before. Updating metadata')
-      mac.seen += 1
-      mac.last_seen = datetime.now(timezone.utc)
-      mac.ouid = ouid
-      mac.name = name
-    else:
-      logger.info(f'Adding new mac {addr}')
-      logger.info(f'{addr} {name} {ouid} {addrPrefix}')
+def addUUID(state, uuid, action, type = 'primary', flags = '', value = '', when = None):
+  """
+    addUUID
 
-      mac = Mac(addr, name, ouid)
-      session.add(mac)
-      safeCommit(session)
+    Queues a UUID row for the device unless it is already known
 
-    presence = Presence(mac.id, 'seen')
-    session.add(presence)
-    safeCommit(session)
+    @param state - DeviceState
+    @param uuid - String (upper case)
+    @param action - String for the log line
+    @param type - String [advertised, primary, characteristic, descriptor]
+    @param when - DateTime/None for now
+  """
+  if uuid in state.uuids:
+    return
 
-    if 'ServiceData' in device:
-      data = device['ServiceData']
+  state.uuids.add(uuid)
+  uuid_lookup_id = uuidLookups.resolve(uuid)
 
-      for key in data:
-        dataList = list(data[key])
-        intString = ' '.join([str(int(v)) for v in dataList])
+  logger.debug('UUID %s: %s %s %s %s %s', action, state.addr, uuid, uuid_lookup_id, flags, value)
+  buffer.add(UUID, mac_id=state.id, lookup_id=uuid_lookup_id, uuid=uuid, type=type, flags=flags, value=value, time=when or datetime.now(timezone.utc))
 
-        logger.info(f'DATA ADD: {addr} {key} {intString}')
-        data = Data(mac.id, key, intString)
+def addData(state, key, values, action, when = None):
+  """
+    addData
+
+    Stores a ServiceData/ManufacturerData payload, deduplicated
 
-        session.add(data)
-        safeCommit(session)
+    @param state - DeviceState
+    @param key - String/Integer ServiceData uuid or company id
+    @param values - list of byte values
+    @param action - String for the log line
+    @param when - DateTime/None for now
+  """
+  payload = bytes(int(v) for v in values)
 
-    if 'ManufacturerData' in device:
-      data = device['ManufacturerData']
+  if payloads.add(state.id, str(key), payload, when or datetime.now(timezone.utc)):
+    logger.debug('%s: %s %s %s', action, state.addr, key, payload.hex())
+
+def addPresence(state, type, when = None, persist = True, adapter = None):
+  """
+    addPresence
 
+    Queues a presence row and counts it in the rollups
 
-      for key in data:
-        dataList = list(data[key])
-        intString = ' '.join([str(int(v)) for v in dataList])
+    @param state - DeviceState
+    @param type - String [seen, name, rssi, data, uuid]
+    @param when - DateTime/None for now
+    @param persist - Bool False to only count it in the rollups
+    @param adapter - String adapter that saw the device
+  """
+  when = when or datetime.now(timezone.utc)
 
-        logger.info(f'DATA ADD: {addr} {key} {intString}')
-        data = Data(mac.id, key, intString)
+  if persist:
+    buffer.add(Presence, mac_id=state.id, type=type, time=when, adapter=adapter)
 
-        session.add(data)
-        safeCommit(session)
+  rollups.add(state.id, type, when)
 
+def ingestAdded(path, interfaces, when = None):
+  """
+    ingestAdded
 
-    if 'UUIDs' in device:
-      uuids = device['UUIDs']
+    Persists an InterfacesAdded event. Runs on an ingestion worker.
 
-      for uuid in uuids:
-        uuid = uuid.upper()
+    @param path - String DBus object path
+    @param interfaces - Dict of interface -> properties
+    @param when - DateTime the signal was received, None for now
+  """
+  when = when or datetime.now(timezone.utc)
 
-        if not macHasUUID(mac, uuid):
-          uuid_chunk = uuid[4:8]
-          uuid_lookup_id = None
+  device = interfaces['org.bluez.Device1']
 
-          for lookup in session.query(UUID_Lookup).filter(UUID_Lookup.prefix.like(uuid_chunk)):
-            uuid_lookup_id = lookup.id
+  addr = device['Address']
+  name = device['Alias']
+  addrPrefix = addr.replace(':', '')[0:6]
+  ouid = ouis.resolve(addr)
+  updated = False
 
-            logger.info(f'UUID ADVERTISE ADD: {addr} {uuid} {uuid_lookup_id}')
-            entry = UUID(mac.id, uuid_lookup_id, uuid, type='advertised')
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug(json.dumps(device))
 
-            session.add(entry)
-            safeCommit(session)
-  except Exception as e:
-    if GATT_SERVICE in interfaces:
-      service = interfaces[GATT_SERVICE]
-      uuid = service['UUID'].upper()
-      addr = dbusPathToMac(service['Device'])
-      mac = session.query(Mac).filter(Mac.addr == addr).first()
+    if ouid is not None:
+      logger.debug('OUID %s', ouis.vendor(ouid))
 
-      if mac:
-        if not macHasUUID(mac, uuid):
-          uuid_chunk = uuid[4:8]
-          uuid_lookup_id = None
+  state = devices.fetch(session, addr)
 
-          for lookup in session.query(UUID_Lookup).filter(UUID_Lookup.prefix.like(uuid_chunk)):
-            uuid_lookup_id = lookup.id
+  if state:
+    logger.debug('Seen %s before. Updating metadata', state.addr)
+    devices.update(state, ouid=ouid, name=name)
+    devices.touch(state, when)
+    leaders.update(state.id, state.seen, when)
+  else:
+    logger.info('Adding new mac %s %s %s %s', addr, name, ouid, addrPrefix)
 
-            logger.info(f'UUID SERVICE ADD: {addr} {uuid} {uuid_lookup_id}')
-            entry = UUID(mac.id, uuid_lookup_id, uuid)
+    mac = Mac(addr, name, ouid)
+    mac.first_seen = mac.last_seen = when
+    session.add(mac)
+    safeCommit(session)
 
-            session.add(entry)
-            safeCommit(session)
-    if GATT_CHAR in interfaces:
-      characteristic = interfaces[GATT_CHAR]
-      uuid = characteristic['UUID'].upper()
-      addr = dbusPathToMac(characteristic['Service'])
-      flags = ','.join(characteristic['Flags'])
-      value = characteristic['Value']
-      mac = session.query(Mac).filter(Mac.addr == addr).first()
+    if mac.id is None:
+      return
 
-      if mac:
-        if not macHasUUID(mac, uuid):
-          uuid_chunk = uuid[4:8]
-          uuid_lookup_id = None
+    state = devices.add(mac)
+    leaders.update(state.id, state.seen, when)
+    invalidate()
 
-          for lookup in session.query(UUID_Lookup).filter(UUID_Lookup.prefix.like(uuid_chunk)):
-            uuid_lookup_id = lookup.id
+    if hub.active():
+      hub.publish('device', macsAndPresence2json([mac], [])[0])
 
-            logger.info(f'UUID CHAR ADD: {addr} {uuid} {uuid_lookup_id} {flags} {value}')
-            entry = UUID(mac.id, uuid_lookup_id, uuid, 'characteristic', flags, value)
+  addPresence(state, 'seen', when, adapter=dbusPathToAdapter(path))
 
-            session.add(entry)
-            safeCommit(session)
-    if GATT_DESC in interfaces:
-      descriptor = interfaces[GATT_DESC]
-      uuid = descriptor['UUID'].upper()
-      addr = dbusPathToMac(descriptor['Characteristic'])
-      value = descriptor['Value']
-      mac = session.query(Mac).filter(Mac.addr == addr).first()
+  if 'ServiceData' in device:
+    data = device['ServiceData']
 
-      if mac:
-        if not macHasUUID(mac, uuid):
-          uuid_chunk = uuid[4:8]
-          uuid_lookup_id = None
+    for key in data:
+      addData(state, key, data[key], 'DATA ADD', when)
 
-          for lookup in session.query(UUID_Lookup).filter(UUID_Lookup.prefix.like(uuid_chunk)):
-            uuid_lookup_id = lookup.id
+  if 'ManufacturerData' in device:
+    data = device['ManufacturerData']
 
-            logger.info(f'UUID DESC ADD: {addr} {uuid} {uuid_lookup_id} {value}')
-            entry = UUID(mac.id, uuid_lookup_id, uuid, 'descriptor', '', value)
+    for key in data:
+      addData(state, key, data[key], 'DATA ADD', when)
 
-            session.add(entry)
-            safeCommit(session)
+  if 'UUIDs' in device:
+    uuids = device['UUIDs']
 
+    for uuid in uuids:
+      addUUID(state, uuid.upper(), 'ADVERTISE ADD', type='advertised', when=when)
 
-def changeHandler(*args):
+def ingestGatt(path, interfaces, when = None):
   """
-    changeHandler
+    ingestGatt
 
-    PropertiesChanged signal
+    Queues an InterfacesAdded event for a GATT service, characteristic
+    or descriptor in its device's batch. BlueZ emits one per attribute
+    while resolving services after a connect. Runs on an ingestion
+    worker.
 
-    Callable function for DBusSignalCallback
-    https://lazka.github.io/pgi-docs/Gio-2.0/callbacks.html#Gio.DBusSignalCallback
+    @param path - String DBus object path (under the device's path)
+    @param interfaces - Dict of interface -> properties
+    @param when - DateTime the signal was received, None for now
+  """
+  state = devices.fetch(session, dbusPathToMac(path))
 
-    @param connection - DBus Connection
-    @param sender_name - String
-    @param interface_name - String
-    @param signal_name - String (Also called 'member_name')
-    @param parameters - Dict
-    @param user_data - ?
+  if not state:
+    return
+
+  when = when or datetime.now(timezone.utc)
+
+  for interface, (type, action) in GATT_TYPES.items():
+    if interface not in interfaces:
+      continue
+
+    attribute = interfaces[interface]
+    uuid = attribute['UUID'].upper()
+
+    if uuid in state.uuids:
+      continue
+
+    state.uuids.add(uuid)
+
+    flags = ','.join(attribute.get('Flags', []))
+    value = gattValue(attribute.get('Value'))
+    uuid_lookup_id = uuidLookups.resolve(uuid)
+
+    logger.debug('UUID %s: %s %s %s %s %s', action, state.addr, uuid, uuid_lookup_id, flags, value)
+    gatt.add(state.id, uuid_lookup_id, uuid, type, flags, value, when)
+
+def ingestChanged(path, interface, properties, when = None):
   """
-  path = args[2]
-  data = args[5]
-  interface = data[0]
-  properties = data[1]
+    ingestChanged
 
+    Persists a PropertiesChanged event. Runs on an ingestion worker.
+
+    @param path - String DBus object path
+    @param interface - String
+    @param properties - Dict of changed properties
+    @param when - DateTime the signal was received, None for now
+  """
   if interface == 'org.bluez.Device1':
-    addr = path[-17:].replace('_', ':')
+    addr = dbusPathToMac(path)
+    adapter = dbusPathToAdapter(path)
 
-    mac = session.query(Mac).filter(Mac.addr == addr).first()
+    state = devices.fetch(session, addr)
 
     presenceType = None
-    seen = datetime.now(timezone.utc)
+    persist = True
+    seen = when or datetime.now(timezone.utc)
+
+    if state:
+      # every GATT object of the device was announced, write its batch
+      if properties.get('ServicesResolved'):
+        gatt.resolve(state.id)
 
-    if mac:
       for chgType, val in properties.items():
         if 'Name' in chgType:
           presenceType = 'name'
+          persist = True
           name = val
 
-          logger.info(f'Name CHG: {addr} {name}')
-          mac.name = name
-
-          safeCommit(session)
+          logger.info('Name CHG: %s %s', addr, name)
+          devices.update(state, name=name)
+          hub.publish('name', { 'id': str(state.id), 'addr': addr, 'name': name })
 
         if 'RSSI' in chgType:
           presenceType = 'rssi'
           rssi = val
 
-          logger.info(f'RSSI CHG: {addr} {rssi}')
-          entry = RSSI(mac.id, rssi)
+          logger.debug('RSSI CHG: %s %s', addr, rssi)
 
-          session.add(entry)
-          safeCommit(session)
+          # only the first rssi of each window gets a raw presence row
+          persist = rssis.add(state.id, rssi, seen)
 
         if 'ManufacturerData' in chgType or 'ServiceData' in chgType:
           presenceType = 'data'
+          persist = True
           data = val
 
           for key in val:
-            data = list(val[key])
-            intString = ' '.join([str(int(v)) for v in data])
-
-            logger.info(f'DATA CHG: {addr} {chgType} {key} {intString}')
-            data = Data(mac.id, key, intString)
-
-            session.add(data)
-            safeCommit(session)
+            addData(state, key, val[key], f'DATA CHG: {chgType}', seen)
 
         if 'UUID' in chgType:
           presenceType = 'uuid'
+          persist = True
           uuids = val
 
           for uuid in uuids:
-            uuid = uuid.upper()
+            addUUID(state, uuid.upper(), 'CHG', when=seen)
 
-            if not macHasUUID(mac, uuid):
-              uuid_chunk = uuid[4:8]
-              uuid_lookup_id = None
+        devices.touch(state, seen)
+        leaders.update(state.id, state.seen, seen)
 
-              for lookup in session.query(UUID_Lookup).filter(UUID_Lookup.prefix.like(uuid_chunk)):
-                uuid_lookup_id = lookup.id
+        addPresence(state, presenceType, seen, persist or presenceType != 'rssi', adapter)
 
-              logger.info(f'UUID CHG: {addr} {uuid} {uuid_lookup_id}')
-              entry = UUID(mac.id, uuid_lookup_id, uuid)
+signalsReceived = counter('btdm_signals_total', 'BlueZ signals received', ('signal',))
+signalsDropped = counter('btdm_signals_dropped_total', 'Signals dropped because the ingestion queue was full', ('signal',))
+handlerSeconds = histogram('btdm_handler_seconds', 'Ingestion worker time per event', ('handler',))
 
-              session.add(entry)
-              safeCommit(session)
+def ingest(target, *event):
+  """
+    ingest
 
-        mac.seen += 1
-        mac.last_seen = seen
+    WorkerPool target. Hands the worker's thread local session back
+    to the pool once the event is handled.
+  """
+  began = time.perf_counter()
 
-        presence = Presence(mac.id, presenceType)
-        session.add(presence)
-        safeCommit(session)
+  try:
+    target(*event)
+  finally:
+    session.remove()
+    handlerSeconds.observe(time.perf_counter() - began, target.__name__)
+
+pool = WorkerPool(ingest, WORKERS, QUEUE_SIZE)
+
+# read from the components' own counters when /api/metrics is scraped
+collected('btdm_queue_depth', 'Events waiting for an ingestion worker', 'gauge', lambda: [((), pool.depth())])
+collected('btdm_events_processed_total', 'Events handled by the ingestion workers', 'counter', lambda: [((), pool.stats()['processed'])])
+collected('btdm_event_errors_total', 'Events whose handler raised', 'counter', lambda: [((), pool.stats()['errors'])])
+collected('btdm_buffer_pending_rows', 'Rows waiting for the next flush', 'gauge', lambda: [((), buffer.size)])
+collected('btdm_lookup_hits_total', 'Ingestion lookups answered from memory', 'counter', lambda: [
+  (('device',), devices.hits), (('oui',), ouis.hits), (('uuid',), uuidLookups.hits),
+], ('lookup',))
+collected('btdm_lookup_misses_total', 'Ingestion lookups that missed (device: read from the database, oui/uuid: unknown)', 'counter', lambda: [
+  (('device',), devices.misses), (('oui',), ouis.misses), (('uuid',), uuidLookups.misses),
+], ('lookup',))
+collected('btdm_device_cache_size', 'Devices in the ingestion cache', 'gauge', lambda: [((), len(devices.states))])
+collected('btdm_stream_clients', 'Connected /api/stream clients', 'gauge', lambda: [((), len(hub.subscribers))])
+
+# raw signals are appended to BTDM_CAPTURE when set, see backend/capture.py
+capture = None
+
+def dispatch(signal, path, parameters, when = None, block = False):
+  """
+    dispatch
 
-"""
-  Setup Signals
-
-  https://lazka.github.io/pgi-docs/#Gio-2.0/classes/DBusConnection.html#Gio.DBusConnection.signal_subscribe
-
-  @param sender - String
-  @param interface_name - String
-  @param member - String (signal name)
-  @param object_path - String
-  @param arg0 - str/None
-  @param flags - Gio.DBusSignalFlags
-  @param callback - Callable
-  @param user_data - ?
-"""
-bus.signal_subscribe(
-  None,
-  'org.freedesktop.DBus.Properties',
-  'PropertiesChanged',
-  None,
-  None,
-  Gio.DBusSignalFlags.NONE,
-  changeHandler,
-  None
-)
-bus.signal_subscribe(
-  None,
-  'org.freedesktop.DBus.ObjectManager',
-  'InterfacesAdded',
-  None,
-  None,
-  Gio.DBusSignalFlags.NONE,
-  addHandler,
-  None
-)
+    Unpacks a signal and queues it for the ingestion workers. Shared
+    by the D-Bus handlers and capture replay.
+
+    @param signal - String [InterfacesAdded, PropertiesChanged]
+    @param path - String DBus object path the signal was emitted on
+    @param parameters - GLib.Variant signal parameters
+    @param when - DateTime the signal was received, None for now
+    @param block - Bool wait for queue space instead of dropping
+    @return bool - False if the event was dropped
+  """
+  signalsReceived.inc(signal)
+
+  if signal == 'InterfacesAdded':
+    path, interfaces = parameters.unpack()
+
+    if 'org.bluez.Device1' in interfaces:
+      event = (ingestAdded, path, interfaces, when)
+    elif GATT_SERVICE in interfaces or GATT_CHAR in interfaces or GATT_DESC in interfaces:
+      event = (ingestGatt, path, interfaces, when)
+    else:
+      return True
+  else:
+    interface, properties, invalidated = parameters.unpack()
+
+    if interface != 'org.bluez.Device1':
+      return True
+
+    event = (ingestChanged, path, interface, properties, when)
+
+  # keyed by address, not path, so every adapter's reports of a device
+  # are handled in order by the same worker and merge into one DeviceState
+  if not pool.submit(dbusPathToMac(path), *event, block=block):
+    signalsDropped.inc(signal)
+    logger.warning(f'Ingestion queue full. Dropped {signal} {path}')
+    return False
+
+  return True
+
+def addHandler(*args):
+  """
+    addHandler
+
+    InterfacesAdded signal. Only records and queues it, `ingestAdded`
+    does the database work on a worker thread.
+
+    Callable function for DBusSignalCallback
+    https://lazka.github.io/pgi-docs/Gio-2.0/callbacks.html#Gio.DBusSignalCallback
+
+    @param connection - DBus Connection
+    @param sender_name - String
+    @param interface_name - String
+    @param signal_name - String (Also called 'member_name')
+    @param parameters - Dict
+    @param user_data - ?
+  """
+  if capture is not None:
+    capture.write('InterfacesAdded', args[2], args[5])
+
+  if not CAPTURE_ONLY:
+    dispatch('InterfacesAdded', args[2], args[5])
+
+def changeHandler(*args):
+  """
+    changeHandler
+
+    PropertiesChanged signal. Only records and queues it,
+    `ingestChanged` does the database work on a worker thread.
+
+    Callable function for DBusSignalCallback
+    https://lazka.github.io/pgi-docs/Gio-2.0/callbacks.html#Gio.DBusSignalCallback
+
+    @param connection - DBus Connection
+    @param sender_name - String
+    @param interface_name - String
+    @param signal_name - String (Also called 'member_name')
+    @param parameters - Dict
+    @param user_data - ?
+  """
+  if capture is not None:
+    capture.write('PropertiesChanged', args[2], args[5])
+
+  if not CAPTURE_ONLY:
+    dispatch('PropertiesChanged', args[2], args[5])
+
+def shutdown():
+  """
+    shutdown
+
+    Drains the ingestion workers, then flushes the write-behind buffer
+  """
+  pool.stop()
+  buffer.stop()
+  maintenance.stop()
+
+  if capture is not None:
+    capture.close()
+
+def subscribe():
+  """
+    subscribe
+
+    Setup Signals
+
+    https://lazka.github.io/pgi-docs/#Gio-2.0/classes/DBusConnection.html#Gio.DBusConnection.signal_subscribe
+
+    @param sender - String
+    @param interface_name - String
+    @param member - String (signal name)
+    @param object_path - String
+    @param arg0 - str/None
+    @param flags - Gio.DBusSignalFlags
+    @param callback - Callable
+    @param user_data - ?
+  """
+  bus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
+
+  bus.signal_subscribe(
+    None,
+    'org.freedesktop.DBus.Properties',
+    'PropertiesChanged',
+    None,
+    None,
+    Gio.DBusSignalFlags.NONE,
+    changeHandler,
+    None
+  )
+  bus.signal_subscribe(
+    None,
+    'org.freedesktop.DBus.ObjectManager',
+    'InterfacesAdded',
+    None,
+    None,
+    Gio.DBusSignalFlags.NONE,
+    addHandler,
+    None
+  )
+
+def timed(step, target, *args):
+  began = time.monotonic()
+  out = target(*args)
+  boot['steps'][step] = time.monotonic() - began
+
+  return out
+
+started = False
+startLock = threading.Lock()
+
+def start(signals = True):
+  """
+    start
+
+    Connects everything importing this module does not: migrations,
+    seed data, in memory lookups, background threads and the BlueZ
+    signal subscriptions. Safe to call more than once.
+
+    @param signals - Bool False to ingest without subscribing to the
+    system bus (benchmark, capture replay)
+  """
+  global started, capture
+
+  with startLock:
+    if started:
+      return
+
+    started = True
+
+    # tables and pending schema migrations, see `python3 -m backend.migrations`
+    timed('migrate', migrate, engine)
+    timed('seed', seed, engine)
+    timed('partitions', prepare, engine)
+    maintenance.start()
+    buffer.start()
+
+    timed('oui', ouis.load, session)
+    timed('uuid', uuidLookups.load, session)
+    timed('leaderboard', leaders.load, session)
+
+    if session.query(PresenceRollup.id).first() is None and session.query(Presence.id).first() is not None:
+      timed('backfill', backfill, session)
+
+    session.remove()
+    pool.start()
+
+    if CAPTURE:
+      capture = CaptureWriter(CAPTURE)
+
+    atexit.register(shutdown)
+
+    if signals:
+      timed('signals', subscribe)
+
+    boot['ready'] = time.monotonic() - BOOT_START
+    steps = ', '.join(f'{step} {seconds:.2f}s' for step, seconds in boot['steps'].items())
+    logger.info(f'Ready {boot["ready"]:.2f}s after boot ({steps})')
 
 loop = GLib.MainLoop()
 
 if __name__ == '__main__':
+  start()
   loop.run()
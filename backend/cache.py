@@ -0,0 +1,234 @@
+import logging
+import threading
+from collections import OrderedDict
+from sqlalchemy import update, bindparam
+
+from .models import Mac, UUID
+
+logger = logging.getLogger(__name__)
+
+class DeviceState(object):
+  """
+    DeviceState
+
+    Description: The slice of a `mac` row the ingestion handlers need,
+    plus the set of UUIDs already stored for it.
+  """
+  def __init__(self, id, addr, name, ouid, seen, last_seen, uuids = None):
+    self.id = id
+    self.addr = addr
+    self.name = name
+    self.ouid = ouid
+    self.seen = seen or 0
+    self.last_seen = last_seen
+    self.uuids = set(uuids or [])
+    self.pendingSeen = 0
+
+class DeviceCache(object):
+  """
+    DeviceCache
+
+    Description: Bounded LRU of DeviceState keyed by mac address.
+    `seen`/`last_seen`/`name`/`ouid` changes are kept in memory and
+    written back in bulk by `collect`, which is registered on the
+    IngestBuffer so it runs in the periodic flush transaction.
+
+    A state evicted with changes that are not committed yet stays
+    pinned in `evicted` until `flushed`, and is picked up again instead
+    of being read back stale. A state read from the database also
+    knows the UUIDs still queued for it, see `register`.
+
+    @param maxSize - Integer devices kept in memory
+  """
+  def __init__(self, maxSize = 10000):
+    self.maxSize = maxSize
+    self.states = OrderedDict()
+    self.dirty = {}
+    self.writing = {}
+    self.evicted = {}
+    self.sources = []
+    self.lock = threading.RLock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, addr):
+    """
+      get
+
+      @param addr - String mac address
+      @return state - DeviceState or None
+    """
+    with self.lock:
+      state = self.states.get(addr)
+
+      if state is not None:
+        self.states.move_to_end(addr)
+        self.hits += 1
+        return state
+
+      state = self.evicted.pop(addr, None)
+
+      if state is not None:
+        self.hits += 1
+        return self.put(state)
+
+      return None
+
+  def register(self, queued):
+    """
+      register
+
+      @param queued - Callable(mac_id) returning the UUIDs queued for
+      the device that may not be committed yet
+    """
+    self.sources.append(queued)
+
+  def fetch(self, session, addr):
+    """
+      fetch
+
+      Cached state for `addr`, loading it from the database on a miss.
+      The mac row is read column wise so the joined `uuids` relation
+      is not pulled in.
+
+      @param session - SQLAlchemy session
+      @param addr - String mac address
+      @return state - DeviceState or None if the mac is unknown
+    """
+    state = self.get(addr)
+
+    if state is not None:
+      return state
+
+    with self.lock:
+      self.misses += 1
+
+    row = session.query(Mac.id, Mac.name, Mac.ouid, Mac.seen, Mac.last_seen).filter(Mac.addr == addr).first()
+
+    if row is None:
+      return None
+
+    # queued first, then stored: a row leaves the queues only once committed
+    uuids = set(uuid for queued in self.sources for uuid in queued(row.id))
+    uuids.update(uuid for uuid, in session.query(UUID.uuid).filter(UUID.mac_id == row.id))
+    state = DeviceState(row.id, addr, row.name, row.ouid, row.seen, row.last_seen, uuids)
+
+    return self.put(state)
+
+  def add(self, mac):
+    """
+      add
+
+      Caches a freshly inserted Mac
+
+      @param mac - Mac sqlAlchemy
+      @return state - DeviceState
+    """
+    state = DeviceState(mac.id, mac.addr, mac.name, mac.ouid, mac.seen, mac.last_seen)
+
+    return self.put(state)
+
+  def put(self, state):
+    with self.lock:
+      self.states[state.addr] = state
+      self.states.move_to_end(state.addr)
+
+      while len(self.states) > self.maxSize:
+        addr, evicted = self.states.popitem(last=False)
+
+        if evicted.id in self.dirty or evicted.id in self.writing:
+          self.evicted[addr] = evicted
+
+      return state
+
+  def touch(self, state, when):
+    """
+      touch
+
+      Counts one more sighting of the device
+
+      @param state - DeviceState
+      @param when - DateTime
+    """
+    with self.lock:
+      state.seen += 1
+      state.pendingSeen += 1
+      state.last_seen = when
+      self.dirty[state.id] = state
+
+  def update(self, state, **fields):
+    """
+      update
+
+      Changes name/ouid of the device, written back with the counters
+
+      @param state - DeviceState
+    """
+    with self.lock:
+      for key, value in fields.items():
+        setattr(state, key, value)
+
+      self.dirty[state.id] = state
+
+  def discard(self, addr):
+    with self.lock:
+      state = self.states.pop(addr, None) or self.evicted.pop(addr, None)
+
+      if state is not None:
+        self.dirty.pop(state.id, None)
+
+  def clear(self):
+    with self.lock:
+      self.states.clear()
+      self.dirty.clear()
+      self.writing = {}
+      self.evicted.clear()
+
+  def collect(self):
+    """
+      collect
+
+      IngestBuffer collector. Drains the dirty devices into one
+      executemany UPDATE.
+
+      @return batches - list of (statement, params)
+    """
+    with self.lock:
+      dirty, self.dirty = self.dirty, {}
+      self.writing = dirty
+      params = []
+
+      for state in dirty.values():
+        params.append({
+          '_id': state.id,
+          '_seen': state.pendingSeen,
+          '_last_seen': state.last_seen,
+          '_name': state.name,
+          '_ouid': state.ouid,
+        })
+        state.pendingSeen = 0
+
+    if not params:
+      return []
+
+    statement = update(Mac.__table__).where(Mac.id == bindparam('_id')).values(
+      seen=Mac.seen + bindparam('_seen'),
+      last_seen=bindparam('_last_seen'),
+      name=bindparam('_name'),
+      ouid=bindparam('_ouid'),
+    )
+
+    return [(statement, params)]
+
+  def flushed(self, written):
+    """
+      flushed
+
+      IngestBuffer listener. The collected changes are committed,
+      evicted states without newer ones are let go.
+    """
+    with self.lock:
+      self.writing = {}
+
+      for addr in [addr for addr, state in self.evicted.items() if state.id not in self.dirty]:
+        del self.evicted[addr]
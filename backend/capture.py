@@ -0,0 +1,183 @@
+"""
+  Capture log
+
+  Append-only binary log of the raw BlueZ signals `bt.py` receives.
+  Every record is the receive time, the signal, the object path and
+  the GLib.Variant parameters in their serialized D-Bus form, so a
+  survey can be re-ingested later with the same timestamps.
+
+    BTDM_CAPTURE=survey.cap sudo -E python3 server.py
+    BTDM_DATABASE=postgresql:///blt_replay sudo -E python3 -m backend.capture replay survey.cap [--speed 1]
+"""
+import os
+import sys
+import time
+import struct
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from gi.repository import GLib
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BTDMCAP1'
+
+# receive time (epoch seconds), signal, path/type/data lengths
+RECORD = struct.Struct('<dBHHI')
+
+SIGNALS = ['InterfacesAdded', 'PropertiesChanged']
+
+class CaptureWriter(object):
+  """
+    CaptureWriter
+
+    Description: Appends signals to a capture file. Writes go through
+    a large userspace buffer that is flushed every `flushEvery`
+    seconds, so the GLib main loop never waits on the disk.
+
+    @param filename - String
+    @param flushEvery - Float seconds between flushes
+  """
+  def __init__(self, filename, flushEvery = 1.0):
+    self.filename = filename
+    self.flushEvery = flushEvery
+    self.lock = threading.Lock()
+    self.records = 0
+    self.lastFlush = time.monotonic()
+
+    new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+    self.file = open(filename, 'ab', buffering=1 << 20)
+
+    if new:
+      self.file.write(MAGIC)
+
+    logger.info(f'Capturing signals to {filename}')
+
+  def write(self, signal, path, parameters, when = None):
+    """
+      write
+
+      @param signal - String [InterfacesAdded, PropertiesChanged]
+      @param path - String DBus object path
+      @param parameters - GLib.Variant
+      @param when - Float epoch seconds, None for now
+    """
+    path = path.encode()
+    type = parameters.get_type_string().encode()
+    data = parameters.get_data_as_bytes().get_data()
+
+    with self.lock:
+      self.file.write(RECORD.pack(when or time.time(), SIGNALS.index(signal), len(path), len(type), len(data)))
+      self.file.write(path)
+      self.file.write(type)
+      self.file.write(data)
+      self.records += 1
+
+      if time.monotonic() - self.lastFlush >= self.flushEvery:
+        self.file.flush()
+        self.lastFlush = time.monotonic()
+
+  def close(self):
+    with self.lock:
+      if not self.file.closed:
+        self.file.close()
+
+def read(filename):
+  """
+    read
+
+    @param filename - String
+    @return generator of (Float epoch seconds, signal, path, GLib.Variant)
+  """
+  with open(filename, 'rb') as file:
+    if file.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f'{filename} is not a capture file')
+
+    while True:
+      header = file.read(RECORD.size)
+
+      # a short record is the tail of a capture that was cut off
+      if len(header) < RECORD.size:
+        return
+
+      when, signal, pathSize, typeSize, dataSize = RECORD.unpack(header)
+      body = file.read(pathSize + typeSize + dataSize)
+
+      if len(body) < pathSize + typeSize + dataSize:
+        return
+
+      path = body[:pathSize].decode()
+      type = body[pathSize:pathSize + typeSize].decode()
+      data = body[pathSize + typeSize:]
+      parameters = GLib.Variant.new_from_bytes(GLib.VariantType.new(type), GLib.Bytes.new(data), False)
+
+      yield when, SIGNALS[signal], path, parameters
+
+def replay(filename, speed = None):
+  """
+    replay
+
+    Re-ingests a capture with its original receive times. Events
+    wait for queue space instead of being dropped.
+
+    @param filename - String
+    @param speed - Float replay rate (1 = as captured), None as fast as possible
+    @return count - Integer signals replayed
+  """
+  from . import bt
+
+  bt.start(signals=False)
+
+  count = 0
+  start = time.monotonic()
+  first = None
+
+  for when, signal, path, parameters in read(filename):
+    if first is None:
+      first = when
+
+    if speed:
+      delay = (when - first) / speed - (time.monotonic() - start)
+
+      if delay > 0:
+        time.sleep(delay)
+
+    bt.dispatch(signal, path, parameters, datetime.fromtimestamp(when, timezone.utc), block=True)
+    count += 1
+
+  bt.shutdown()
+
+  return count
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='BlueZ signal capture replay')
+  parser.add_argument('command', choices=['replay', 'info'])
+  parser.add_argument('filename')
+  parser.add_argument('--speed', type=float, default=None, help='1 replays as captured, default as fast as possible')
+  args = parser.parse_args()
+
+  logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+
+  if args.command == 'info':
+    counts = {}
+    first = last = None
+
+    for when, signal, path, parameters in read(args.filename):
+      counts[signal] = counts.get(signal, 0) + 1
+      first = first or when
+      last = when
+
+    for signal, count in counts.items():
+      print(f'{signal}: {count}')
+
+    if first is not None:
+      print(f'{datetime.fromtimestamp(first, timezone.utc).isoformat()} - {datetime.fromtimestamp(last, timezone.utc).isoformat()}')
+
+    sys.exit(0)
+
+  started = time.monotonic()
+  count = replay(args.filename, args.speed)
+  elapsed = time.monotonic() - started
+
+  print(f'Replayed {count} signals in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f}/s)')
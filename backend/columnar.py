@@ -0,0 +1,225 @@
+import gzip
+import json
+from datetime import datetime, timedelta
+from flask import Response
+from sqlalchemy.orm import object_session
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+from .models import Presence, Data
+from .rssi import rssiByMac
+from .util import shouldInclude, timeFilters, ID_WINDOW
+from .payload import render
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+# presence type codes, the index in this list is the code sent to clients
+PRESENCE_TYPES = ['seen', 'name', 'rssi', 'data', 'uuid']
+
+FORMATS = ('json', 'columnar', 'msgpack')
+
+def epochMs(when):
+  """
+    epochMs
+
+    @param when - naive UTC DateTime/None
+    @return Integer ms since epoch/None
+  """
+  if when is None:
+    return None
+
+  if when.tzinfo is not None:
+    when = when.replace(tzinfo=None) - when.utcoffset()
+
+  return (when - EPOCH) // MILLISECOND
+
+def typeCode(type):
+  try:
+    return PRESENCE_TYPES.index(type)
+  except ValueError:
+    return -1
+
+def columnsByMac(session, columns, model, ids, timestamp = False, idRange = None):
+  """
+    columnsByMac
+
+    Description: Like `rowsByMac` but only selects `columns` (mac_id
+    first) and keeps rows as tuples, skipping ORM objects and the
+    `as_dict` string conversion.
+
+    @return dict - mac id -> list of tuples (without mac_id)
+  """
+  out = {id: [] for id in ids}
+
+  for i in range(0, len(ids), ID_WINDOW):
+    query = session.query(model.mac_id, *columns).filter(model.mac_id.in_(ids[i:i + ID_WINDOW]))
+
+    if timestamp:
+      query = query.filter(*timeFilters(model, timestamp))
+
+    if idRange:
+      query = query.filter(model.id > idRange[0], model.id <= idRange[1])
+
+    for row in query.order_by(model.id):
+      out[row[0]].append(row[1:])
+
+  return out
+
+def mac2columnar(mac):
+  """
+    mac2columnar
+
+    Mac metadata with native types (ints, epoch ms) and empty series
+  """
+  item = {
+    'id': mac.id,
+    'addr': mac.addr,
+    'name': mac.name,
+    'tag': mac.tag,
+    'seen': mac.seen,
+    'first_seen': epochMs(mac.first_seen),
+    'last_seen': epochMs(mac.last_seen),
+    'ouid': None,
+    'uuid': [],
+    'presence': { 't': [], 'type': [] },
+    'rssi': { 't': [], 'rssi': [], 'min': [], 'max': [], 'count': [] },
+    'data': { 't': [], 'key': [], 'value': [] },
+  }
+
+  if mac.oui:
+    item['ouid'] = mac.oui.as_dict()
+
+    if mac.oui.category:
+      item['ouid']['category'] = mac.oui.category.as_dict()
+
+  for uuid in mac.uuids:
+    uuidObj = uuid.as_dict()
+    uuidObj['lookup'] = uuid.lookup.as_dict() if uuid.lookup else {}
+    item['uuid'].append(uuidObj)
+
+  return item
+
+def columnarPayload(items):
+  return {
+    'format': 'columnar',
+    'types': PRESENCE_TYPES,
+    'macs': items,
+  }
+
+def macsAndPresence2columnar(macs, presences):
+  """
+    macsAndPresence2columnar
+
+    Description: Columnar counterpart of `macsAndPresence2json`. Each
+    mac's presence is two parallel arrays: epoch ms and type code.
+
+    @param macs - Array of Mac
+    @param presences - Array of Presence/PresenceRollup
+  """
+  items = {}
+
+  for mac in macs:
+    items[mac.id] = mac2columnar(mac)
+
+  for presence in presences:
+    item = items.get(presence.mac_id)
+
+    if item is not None:
+      item['presence']['t'].append(epochMs(presence.time))
+      item['presence']['type'].append(typeCode(presence.type))
+
+  return columnarPayload(list(items.values()))
+
+def macs2columnar(macs, include = False, timestamp = False, plotAll = False, since = None, cursor = None):
+  """
+    macs2columnar
+
+    Description: Columnar counterpart of `macs2json`, same filters
+
+    @param macs - Array of Mac
+    @param include - String/Bool to include data/rssi
+    @param since - Dict cursor, only rows after it (replaces timestamp)
+    @param cursor - Dict cursor, only rows up to it
+  """
+  items = [mac2columnar(mac) for mac in macs]
+
+  if not macs:
+    return columnarPayload(items)
+
+  session = object_session(macs[0])
+  ids = [mac.id for mac in macs]
+  after = timestamp if timestamp and not plotAll and not since else False
+
+  def idRange(table):
+    return (since[table], cursor[table]) if since else None
+
+  series = [('presence', Presence, [Presence.time, Presence.type])]
+
+  if include and shouldInclude(include, 'data'):
+    series.append(('data', Data, [Data.time, Data.key, Data.value, Data.payload]))
+
+  for table, model, columns in series:
+    rows = columnsByMac(session, columns, model, ids, after, idRange(table))
+
+    for item in items:
+      out = item[table]
+      keys = list(out.keys())
+
+      for row in rows[item['id']]:
+        out['t'].append(epochMs(row[0]))
+
+        if table == 'data' and row[3] is not None:
+          row = (row[0], row[1], render(row[3]))
+
+        for key, value in zip(keys[1:], row[1:]):
+          out[key].append(typeCode(value) if table == 'presence' else value)
+
+  if include and shouldInclude(include, 'rssi'):
+    rssis = rssiByMac(session, ids, after, idRange('rssi'))
+
+    for item in items:
+      out = item['rssi']
+
+      for row in rssis[item['id']]:
+        out['t'].append(epochMs(row['time']))
+        out['rssi'].append(row['rssi'])
+        out['min'].append(row['min'])
+        out['max'].append(row['max'])
+        out['count'].append(row['count'])
+
+  return columnarPayload(items)
+
+def encode(payload, fmt, acceptEncoding = ''):
+  """
+    encode
+
+    Serializes a columnar payload as json or msgpack, gzip compressed
+    when the client accepts it.
+
+    @param payload - Dict
+    @param fmt - String [columnar, msgpack]
+    @param acceptEncoding - String Accept-Encoding request header
+    @return Response
+  """
+  if fmt == 'msgpack':
+    if msgpack is None:
+      raise ValueError('msgpack is not installed (apt install python3-msgpack)')
+
+    body = msgpack.packb(payload, use_bin_type=True)
+    mimetype = 'application/msgpack'
+  else:
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    mimetype = 'application/json'
+
+  response = Response(body, mimetype=mimetype)
+  response.headers['Vary'] = 'Accept-Encoding'
+
+  if 'gzip' in (acceptEncoding or ''):
+    response.set_data(gzip.compress(body, 5))
+    response.headers['Content-Encoding'] = 'gzip'
+
+  return response
@@ -0,0 +1,79 @@
+import os
+
+def env(name, default, cast = str):
+  """
+    env
+
+    Reads a `BTDM_<name>` environment variable
+
+    Ex: BTDM_WORKERS=8 python3 server.py
+
+    @param name - String
+    @param default - value when unset
+    @param cast - Callable to convert the string
+  """
+  value = os.environ.get(f'BTDM_{name}')
+
+  if value is None or value == '':
+    return default
+
+  return cast(value)
+
+# SQLAlchemy url, ex: a separate database for backend/bench.py or sqlite:///data/blt.db
+DATABASE = env('DATABASE', 'postgresql:///blt')
+
+# sqlite only, see backend/storage.py
+SQLITE_MMAP = env('SQLITE_MMAP', 268435456, int) # bytes
+SQLITE_CACHE = env('SQLITE_CACHE', 32768, int) # KiB
+
+# log.txt level, per advertisement lines are only written at DEBUG
+LOG_LEVEL = env('LOG_LEVEL', 'INFO', str.upper)
+
+# database connection pool shared by ingestion workers, the flush thread and flask
+POOL_SIZE = env('POOL_SIZE', 10, int)
+POOL_OVERFLOW = env('POOL_OVERFLOW', 20, int)
+
+# ingestion
+WORKERS = env('WORKERS', 4, int)
+QUEUE_SIZE = env('QUEUE_SIZE', 10000, int)
+FLUSH_INTERVAL = env('FLUSH_INTERVAL', 250, int) # ms
+FLUSH_ROWS = env('FLUSH_ROWS', 1000, int)
+DEVICE_CACHE_SIZE = env('DEVICE_CACHE_SIZE', 10000, int)
+LEADERBOARD_SIZE = env('LEADERBOARD_SIZE', 1000, int) # most seen devices kept in memory for count= requests
+GATT_IDLE = env('GATT_IDLE', 1.0, float) # seconds, a GATT batch is written without ServicesResolved
+
+# /api/query/sample response cache, see backend/responses.py
+RESPONSE_TTL = env('RESPONSE_TTL', 2.0, float) # seconds, 0 disables the cache
+RESPONSE_TIME_BUCKET = env('RESPONSE_TIME_BUCKET', 5, int) # seconds `time` is rounded down to
+RESPONSE_CACHE_BYTES = env('RESPONSE_CACHE_BYTES', 67108864, int)
+
+# rssi is stored as per-window summaries, the latest raw samples stay in memory
+RSSI_WINDOW = env('RSSI_WINDOW', 10, int) # seconds
+RSSI_RING = env('RSSI_RING', 64, int) # raw samples kept per device
+
+# presence/rssi_summary/data are partitioned per day, older partitions are dropped
+RETENTION_DAYS = env('RETENTION_DAYS', 0, int) # 0 keeps everything
+PARTITION_DAYS_AHEAD = env('PARTITION_DAYS_AHEAD', 2, int)
+MAINTENANCE_INTERVAL = env('MAINTENANCE_INTERVAL', 3600, int) # seconds
+
+# DELETE /api/query?time=.. removes this many macs per transaction
+RESET_BATCH = env('RESET_BATCH', 1000, int)
+
+# raw BlueZ signals are appended to this capture file, see backend/capture.py
+CAPTURE = env('CAPTURE', '')
+CAPTURE_ONLY = env('CAPTURE_ONLY', False, lambda value: value.lower() in ('1', 'true', 'yes')) # record without ingesting
+
+def adapterList(value):
+  return [name.strip() for name in value.split(',') if name.strip()]
+
+def transportMap(value):
+  # hci0=le,hci1=bredr
+  return dict(pair.strip().split('=', 1) for pair in value.split(',') if '=' in pair)
+
+# bluetooth adapters, empty captures on every adapter BlueZ reports
+ADAPTER = env('ADAPTER', 'hci0') # default for /api/adapter without ?adapter=
+ADAPTERS = env('ADAPTERS', [], adapterList) # ex: hci0,hci1,hci2
+TRANSPORTS = env('TRANSPORTS', {}, transportMap) # discovery transport per adapter, ex: hci0=le,hci1=bredr
+
+# unix socket the ingestion daemon serves adapter control on, see backend/control.py
+CONTROL_SOCKET = env('CONTROL_SOCKET', '/run/btdm.sock')
@@ -0,0 +1,534 @@
+"""
+  Control channel
+
+  Everything the API asks of the process that owns the BlueZ
+  connection: adapter control, device connect/forget, resets and the
+  ingestion stats/stream.
+
+  `python3 server.py` runs ingestion and the API in one process and
+  calls `LocalController` directly. The split deployment runs the
+  ingestion daemon (`python3 -m backend.daemon`), which serves a
+  `LocalController` on a unix socket, and API workers
+  (`gunicorn server:app`) reach it through `RemoteController`.
+
+  One JSON line `{"command", "args"}` per request, answered by one
+  JSON line `{"result"}` or `{"error", "status", "data"}`. `stream`
+  keeps the connection open and relays the `/api/stream` events.
+"""
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+from datetime import datetime
+
+from .config import ADAPTER, TRANSPORTS
+from .util import devicePathsForMac, getDeviceForPath, dbusPathToAdapter
+
+logger = logging.getLogger(__name__)
+
+TRANSPORT = 'auto' # Default Transport upon boot Enum[bredr,auto,le]
+
+# LocalController methods a RemoteController may call
+COMMANDS = {
+  'adapterNames', 'adapter', 'adapters', 'scan', 'transport', 'setTransport',
+  'device', 'connect', 'disconnect', 'forget', 'reset', 'resetProgress',
+  'ingest', 'metrics', 'reloadLookups', 'generation', 'invalidate', 'top',
+}
+
+class ControlError(Exception):
+  """
+    ControlError
+
+    @param message - String
+    @param status - Integer HTTP status the API answers with
+    @param data - json serializable details (ex: the running reset job)
+  """
+  def __init__(self, message, status = 500, data = None):
+    super().__init__(message)
+    self.status = status
+    self.data = data
+
+def jsonDefault(value):
+  # unpacked GLib variants hold bytes (ex: `ay` properties)
+  if isinstance(value, (bytes, bytearray)):
+    return list(value)
+
+  if isinstance(value, datetime):
+    return value.isoformat()
+
+  raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+class LocalController(object):
+  """
+    LocalController
+
+    Description: Runs in the process that owns the BlueZ connection
+    and the ingestion state. `backend.bt` is imported on construction
+    so API workers that only use a RemoteController never load it.
+  """
+  remote = False
+
+  def __init__(self):
+    from . import bt
+    from .rssi import aggregator
+    from .payload import store
+
+    self.bt = bt
+    self.rssis = aggregator
+    self.payloads = store
+
+    # discovery transport per adapter, BTDM_TRANSPORTS overrides TRANSPORT
+    self.transports = {}
+
+    # last DELETE /api/query background job, one at a time
+    self.resetJob = None
+    self.resetLock = threading.Lock()
+
+  def adapterNames(self):
+    return self.bt.adapterNames()
+
+  def names(self, name = None):
+    return [name] if name else self.adapterNames()
+
+  def adapter(self, name = None):
+    """
+      adapter
+
+      @param name - String adapter name, None for BTDM_ADAPTER
+      @return Dict of the cached Adapter1 properties, transport and name
+    """
+    name = name or ADAPTER
+    adapter = self.bt.adapterFor(name)
+    out = {}
+
+    for key in adapter.get_cached_property_names():
+      out[key] = adapter.get_cached_property(key).unpack()
+
+    out['adapter'] = name
+    out['transport'] = self.transport(name)
+
+    return out
+
+  def adapters(self):
+    out = []
+
+    for name in self.adapterNames():
+      try:
+        out.append(self.adapter(name))
+      except Exception as e:
+        logger.error(e)
+        out.append({ 'adapter': name, 'error': str(e) })
+
+    return out
+
+  def scan(self, on, name = None):
+    """
+      scan
+
+      @param on - Bool StartDiscovery/StopDiscovery
+      @param name - String adapter name, None for every adapter
+      @return list of String adapter names
+    """
+    names = self.names(name)
+
+    for name in names:
+      logger.info(f'{"Starting" if on else "Stopping"} Discovery on {name}')
+      adapter = self.bt.adapterFor(name)
+
+      if on:
+        adapter.StartDiscovery()
+      else:
+        adapter.StopDiscovery()
+
+    return names
+
+  def transport(self, name = None):
+    name = name or ADAPTER
+
+    return self.transports.get(name, TRANSPORTS.get(name, TRANSPORT))
+
+  def setTransport(self, transport, name = None):
+    """
+      setTransport
+
+      @param transport - String Enum[bredr,auto,le]
+      @param name - String adapter name, None for every adapter
+      @return list of String adapter names
+    """
+    from gi.repository import GLib
+
+    names = self.names(name)
+
+    for name in names:
+      self.bt.adapterFor(name).SetDiscoveryFilter('(a{sv})', { 'Transport': GLib.Variant('s', transport) })
+      self.transports[name] = transport
+
+    return names
+
+  def startDiscovery(self):
+    """
+      startDiscovery
+
+      Boot time discovery on every adapter, with its BTDM_TRANSPORTS
+      transport. One failing dongle does not stop the others.
+    """
+    try:
+      names = self.adapterNames()
+    except Exception as e:
+      logger.error(e)
+      names = [ADAPTER]
+
+    for name in names:
+      try:
+        if name in TRANSPORTS:
+          self.setTransport(TRANSPORTS[name], name)
+
+        self.scan(True, name)
+      except Exception as e:
+        logger.error(f'{name}: {e}')
+
+  def device(self, addr):
+    """
+      device
+
+      @param addr - String mac address
+      @return Dict deviceData/adapters, None when no adapter has it
+    """
+    paths = devicePathsForMac(self.bt.manager.GetManagedObjects(), addr)
+
+    if not paths:
+      return None
+
+    device = getDeviceForPath(paths[0])
+    out = { 'deviceData': {}, 'adapters': [dbusPathToAdapter(path) for path in paths] }
+
+    for key in device.get_cached_property_names():
+      out['deviceData'][key] = device.get_cached_property(key).unpack()
+
+    return out
+
+  def devicePath(self, addr):
+    paths = devicePathsForMac(self.bt.manager.GetManagedObjects(), addr)
+
+    if not paths:
+      raise ControlError('MAC is not in range', 400)
+
+    # the first adapter that has the device in range
+    return paths[0]
+
+  def connect(self, addr):
+    getDeviceForPath(self.devicePath(addr)).Connect()
+
+    return True
+
+  def disconnect(self, addr):
+    getDeviceForPath(self.devicePath(addr)).Disconnect()
+
+    return True
+
+  def discard(self, macs):
+    """
+      discard
+
+      Forgets the in memory state of deleted macs
+
+      @param macs - list of (id, addr)
+    """
+    for id, addr in macs:
+      self.bt.devices.discard(addr)
+      self.bt.leaders.discard(id)
+      self.bt.gatt.discard(id)
+      self.bt.rollups.discard(id)
+      self.rssis.discard(id)
+      self.payloads.discard(id)
+
+  def deleted(self, macs):
+    # ResetJob batch callback
+    self.discard(macs)
+    self.invalidate()
+
+  def forget(self, macs):
+    """
+      forget
+
+      A mac row was deleted: drop its ingestion state and remove it
+      from every adapter that saw it
+
+      @param macs - list of (id, addr)
+      @return Integer BlueZ devices removed
+    """
+    self.discard(macs)
+    self.invalidate()
+
+    objects = self.bt.manager.GetManagedObjects()
+    removed = 0
+
+    for id, addr in macs:
+      for path in devicePathsForMac(objects, addr):
+        try:
+          self.bt.adapterFor(dbusPathToAdapter(path)).RemoveDevice('(o)', path)
+          removed += 1
+        except Exception as e:
+          logger.error(e)
+
+    return removed
+
+  def reset(self, timestamp = None):
+    """
+      reset
+
+      Starts the DELETE /api/query job
+
+      @param timestamp - DateTime/ISO String, None empties everything
+      @return Dict job progress
+    """
+    from .reset import truncate, ResetJob
+    from .models import engine
+
+    if isinstance(timestamp, str):
+      timestamp = datetime.fromisoformat(timestamp)
+
+    with self.resetLock:
+      if self.resetJob is not None and self.resetJob.running:
+        raise ControlError('A reset is already running', 409, self.resetJob.progress)
+
+      if timestamp:
+        # rows are removed by the job in bounded batches
+        self.resetJob = ResetJob(self.bt.adapterFor, self.bt.manager, engine, timestamp, self.deleted)
+      else:
+        truncate(engine)
+        self.bt.buffer.clear()
+        self.bt.devices.clear()
+        self.bt.leaders.clear()
+        self.bt.gatt.clear()
+        self.bt.rollups.clear()
+        self.rssis.clear()
+        self.payloads.clear()
+        self.resetJob = ResetJob(self.bt.adapterFor, self.bt.manager, engine)
+
+      self.resetJob.start()
+      self.invalidate()
+
+      return self.resetJob.progress
+
+  def resetProgress(self):
+    return self.resetJob.progress if self.resetJob is not None else {}
+
+  def top(self, count, since = None):
+    """
+      top
+
+      @param count - Integer
+      @param since - DateTime/ISO String, only devices seen after it
+      @return list of Integer mac ids, None when the database has to answer
+    """
+    if isinstance(since, str):
+      since = datetime.fromisoformat(since)
+
+    return self.bt.leaders.top(count, since)
+
+  def generation(self):
+    return self.bt.generation
+
+  def invalidate(self):
+    """
+      invalidate
+
+      Cached API responses built before now are not served again
+    """
+    return self.bt.invalidate()
+
+  def ingest(self):
+    return {
+      'queue': self.bt.pool.stats(),
+      'buffer': self.bt.buffer.stats,
+      'boot': self.bt.boot,
+    }
+
+  def metrics(self):
+    from .metrics import registry
+
+    return registry.render()
+
+  def reloadLookups(self):
+    session = self.bt.session
+
+    try:
+      return {
+        'oui': self.bt.ouis.reload(session),
+        'uuid': self.bt.uuidLookups.reload(session),
+      }
+    finally:
+      session.remove()
+
+  def stream(self):
+    return self.bt.hub.stream()
+
+class ControlHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    controller = self.server.controller
+
+    for line in self.rfile:
+      try:
+        request = json.loads(line)
+        command = request.get('command')
+        args = request.get('args') or {}
+      except Exception as e:
+        self.reply({ 'error': f'Invalid request: {e}', 'status': 400 })
+        return
+
+      if command == 'stream':
+        self.relay(controller.stream())
+        return
+
+      try:
+        if command not in COMMANDS:
+          raise ControlError(f'Unknown command {command}', 400)
+
+        response = { 'result': getattr(controller, command)(**args) }
+      except ControlError as e:
+        response = { 'error': str(e), 'status': e.status, 'data': e.data }
+      except Exception as e:
+        logger.error(f'{command}: {e}')
+        response = { 'error': str(e), 'status': 500 }
+
+      self.reply(response)
+
+  def reply(self, response):
+    self.wfile.write((json.dumps(response, default=jsonDefault) + '\n').encode())
+    self.wfile.flush()
+
+  def relay(self, messages):
+    try:
+      for message in messages:
+        self.wfile.write(message.encode())
+        self.wfile.flush()
+    except (BrokenPipeError, ConnectionResetError):
+      pass
+    finally:
+      # unsubscribes from the hub
+      messages.close()
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """
+    ControlServer
+
+    Description: Serves a LocalController on a unix socket, one
+    thread per connection.
+
+    @param controller - LocalController
+    @param path - String socket path
+  """
+  daemon_threads = True
+
+  def __init__(self, controller, path):
+    self.controller = controller
+    self.path = path
+    self.thread = None
+
+    # a socket left behind by a daemon that was killed
+    if os.path.exists(path):
+      os.unlink(path)
+
+    super().__init__(path, ControlHandler)
+
+    # API workers may run as another user of the same group
+    os.chmod(path, 0o660)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.serve_forever, name='control', daemon=True)
+    self.thread.start()
+
+    logger.info(f'Control channel listening on {self.path}')
+
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+class RemoteController(object):
+  """
+    RemoteController
+
+    Description: LocalController's commands, forwarded to the
+    ingestion daemon. Called with keyword arguments, ex:
+    `controller.scan(on=True, name='hci1')`. Every call is its own
+    connection, a unix socket connect costs microseconds.
+
+    @param path - String socket path
+    @param timeout - Float seconds to wait for an answer
+  """
+  remote = True
+
+  def __init__(self, path, timeout = 10.0):
+    self.path = path
+    self.timeout = timeout
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+
+    try:
+      sock.connect(self.path)
+    except OSError as e:
+      sock.close()
+      raise ControlError(f'Ingestion daemon is not reachable on {self.path}: {e}', 503)
+
+    return sock
+
+  def send(self, sock, command, args):
+    sock.sendall((json.dumps({ 'command': command, 'args': args }, default=jsonDefault) + '\n').encode())
+
+  def call(self, command, **args):
+    with self.connect() as sock:
+      self.send(sock, command, args)
+      line = sock.makefile('rb').readline()
+
+    if not line:
+      raise ControlError('Ingestion daemon closed the connection', 503)
+
+    response = json.loads(line)
+
+    if 'error' in response:
+      raise ControlError(response['error'], response.get('status', 500), response.get('data'))
+
+    return response['result']
+
+  def __getattr__(self, name):
+    if name not in COMMANDS:
+      raise AttributeError(name)
+
+    return lambda **args: self.call(name, **args)
+
+  def stream(self):
+    """
+      stream
+
+      Connects now, so an unreachable daemon fails the request
+      instead of the response body
+
+      @return generator of bytes Server-Sent Events
+    """
+    sock = self.connect()
+    sock.settimeout(None)
+    self.send(sock, 'stream', {})
+
+    def relay():
+      try:
+        while True:
+          chunk = sock.recv(65536)
+
+          if not chunk:
+            return
+
+          yield chunk
+      finally:
+        sock.close()
+
+    return relay()
@@ -0,0 +1,37 @@
+"""
+  Ingestion daemon
+
+  The BlueZ side of the split deployment: subscribes to the adapters,
+  ingests, and serves adapter control to the API workers over the
+  BTDM_CONTROL_SOCKET unix socket, see backend/control.py.
+
+    sudo -E python3 -m backend.daemon
+    gunicorn --workers 4 --threads 8 --bind 0.0.0.0:1338 server:app
+"""
+import logging
+
+from . import bt
+from .control import LocalController, ControlServer
+from .config import CONTROL_SOCKET, LOG_LEVEL
+
+logger = logging.getLogger(__name__)
+
+def main():
+  logging.basicConfig(format='%(asctime)s %(message)s', filename='log.txt', filemode='a', level=LOG_LEVEL)
+
+  bt.start()
+
+  controller = LocalController()
+  server = ControlServer(controller, CONTROL_SOCKET).start()
+  controller.startDiscovery()
+
+  logger.info('Starting GLib.MainLoop()')
+
+  try:
+    bt.loop.run()
+  finally:
+    server.stop()
+    bt.shutdown()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+import json
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Subscription(object):
+  def __init__(self, maxQueue):
+    self.queue = queue.Queue(maxsize=maxQueue)
+    self.closed = False
+
+class EventHub(object):
+  """
+    EventHub
+
+    Description: Fans ingestion events out to the `/api/stream`
+    Server-Sent Events clients. Each event is serialized once and the
+    same message is queued for every subscriber. A subscriber that
+    falls `maxQueue` messages behind is disconnected (the browser
+    reconnects and reloads) instead of slowing ingestion down.
+
+    @param maxQueue - Integer messages buffered per subscriber
+  """
+  def __init__(self, maxQueue = 1000):
+    self.maxQueue = maxQueue
+    self.subscribers = set()
+    self.lock = threading.Lock()
+    self.published = 0
+
+  def active(self):
+    return len(self.subscribers) > 0
+
+  def subscribe(self):
+    subscription = Subscription(self.maxQueue)
+
+    with self.lock:
+      self.subscribers.add(subscription)
+
+    return subscription
+
+  def unsubscribe(self, subscription):
+    subscription.closed = True
+
+    with self.lock:
+      self.subscribers.discard(subscription)
+
+  def publish(self, kind, payload):
+    """
+      publish
+
+      @param kind - String SSE event name [device, name, batch]
+      @param payload - json serializable
+    """
+    if not self.subscribers:
+      return
+
+    message = f'event: {kind}\ndata: {json.dumps(payload)}\n\n'
+
+    with self.lock:
+      subscribers = list(self.subscribers)
+      self.published += 1
+
+    for subscription in subscribers:
+      try:
+        subscription.queue.put_nowait(message)
+      except queue.Full:
+        logger.warning('Stream subscriber too slow. Disconnecting')
+        self.unsubscribe(subscription)
+
+  def stream(self, heartbeat = 15):
+    """
+      stream
+
+      Generator for a flask streaming Response
+
+      @param heartbeat - Integer seconds between keep-alive comments
+    """
+    subscription = self.subscribe()
+
+    try:
+      yield 'retry: 3000\n\n'
+
+      while not subscription.closed:
+        try:
+          yield subscription.queue.get(timeout=heartbeat)
+        except queue.Empty:
+          yield ': ping\n\n'
+    finally:
+      self.unsubscribe(subscription)
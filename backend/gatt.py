@@ -0,0 +1,161 @@
+import time
+import logging
+import threading
+
+from .models import UUID
+from .rollup import toUTC
+
+logger = logging.getLogger(__name__)
+
+GATT_SERVICE = 'org.bluez.GattService1'
+GATT_CHAR = 'org.bluez.GattCharacteristic1'
+GATT_DESC = 'org.bluez.GattDescriptor1'
+
+# interface -> (uuid type, log action)
+GATT_TYPES = {
+  GATT_SERVICE: ('primary', 'SERVICE ADD'),
+  GATT_CHAR: ('characteristic', 'CHAR ADD'),
+  GATT_DESC: ('descriptor', 'DESC ADD'),
+}
+
+def gattValue(value):
+  """
+    gattValue
+
+    Ex: [1, 255] -> 01ff
+
+    @param value - list of byte values/bytes/None
+    @return string
+  """
+  return bytes(int(v) for v in value or []).hex()
+
+class GattBatch(object):
+  def __init__(self):
+    self.rows = []
+    self.resolved = False
+    self.touched = time.monotonic()
+
+class GattBatches(object):
+  """
+    GattBatches
+
+    Description: GATT attributes of a device collected while BlueZ
+    enumerates them (one InterfacesAdded per service, characteristic
+    and descriptor after a connect). A device's attributes are written
+    together, as one executemany INSERT in the IngestBuffer flush,
+    once it reports ServicesResolved or `idle` seconds after its last
+    attribute.
+
+    @param idle - Float seconds without a new attribute before a batch
+    is written anyway (ex: the device disconnected mid discovery)
+  """
+  def __init__(self, idle = 1.0):
+    self.idle = idle
+    self.pending = {}
+    self.writing = []
+    self.lock = threading.Lock()
+
+  def add(self, mac_id, lookup_id, uuid, type, flags, value, when):
+    """
+      add
+
+      @param mac_id - Integer
+      @param lookup_id - Integer uuid_lookup id/None
+      @param uuid - String (upper case)
+      @param type - String [primary, characteristic, descriptor]
+      @param flags - String comma separated
+      @param value - String hex
+      @param when - DateTime
+    """
+    row = {
+      'mac_id': mac_id,
+      'lookup_id': lookup_id,
+      'uuid': uuid,
+      'type': type,
+      'flags': flags,
+      'value': value,
+      'time': toUTC(when),
+    }
+
+    with self.lock:
+      batch = self.pending.get(mac_id)
+
+      if batch is None:
+        batch = self.pending[mac_id] = GattBatch()
+
+      batch.rows.append(row)
+      batch.touched = time.monotonic()
+
+  def resolve(self, mac_id):
+    """
+      resolve
+
+      The device reported ServicesResolved, its batch is written on
+      the next flush
+
+      @param mac_id - Integer
+    """
+    with self.lock:
+      batch = self.pending.get(mac_id)
+
+      if batch is not None:
+        batch.resolved = True
+
+  def discard(self, mac_id):
+    with self.lock:
+      self.pending.pop(mac_id, None)
+
+  def clear(self):
+    with self.lock:
+      self.pending = {}
+      self.writing = []
+
+  def queued(self, mac_id):
+    """
+      queued
+
+      DeviceCache source: the device's attributes not committed yet
+
+      @param mac_id - Integer
+      @return uuids - list of String
+    """
+    with self.lock:
+      batch = self.pending.get(mac_id)
+      rows = (batch.rows if batch else []) + [row for row in self.writing if row['mac_id'] == mac_id]
+
+      return [row['uuid'] for row in rows]
+
+  def collect(self):
+    """
+      collect
+
+      IngestBuffer collector. Every finished batch in one executemany.
+
+      @return batches - list of (statement, params)
+    """
+    now = time.monotonic()
+    rows = []
+
+    with self.lock:
+      for mac_id, batch in list(self.pending.items()):
+        if batch.resolved or now - batch.touched >= self.idle:
+          rows.extend(batch.rows)
+          del self.pending[mac_id]
+
+      self.writing = rows
+
+    if not rows:
+      return []
+
+    logger.debug('GATT: %d attributes', len(rows))
+
+    return [(UUID.__table__.insert(), rows)]
+
+  def flushed(self, written):
+    """
+      flushed
+
+      IngestBuffer listener. The collected batches are committed.
+    """
+    with self.lock:
+      self.writing = []
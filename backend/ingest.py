@@ -0,0 +1,295 @@
+import time
+import logging
+import threading
+from datetime import datetime
+from collections import deque
+from sqlalchemy.sql.dml import Insert
+
+from . import metrics
+from .storage import isSQLite
+
+logger = logging.getLogger(__name__)
+
+flushSeconds = metrics.histogram('btdm_flush_seconds', 'Write-behind flush transaction time')
+commitDelay = metrics.histogram('btdm_commit_delay_seconds', 'Time from the oldest row of a flush being queued to its commit')
+rowsWritten = metrics.counter('btdm_rows_written_total', 'Rows inserted by write-behind flushes', ('table',))
+flushErrors = metrics.counter('btdm_flush_errors_total', 'Flushes that fell back to row by row inserts')
+
+def execute(conn, statement, params = None):
+  """
+    execute
+
+    Runs `statement` once, or once per dict of `params`: as a single
+    multi-row INSERT on postgres, as an executemany otherwise (UPDATEs,
+    sqlite)
+
+    @param conn - SQLAlchemy Connection
+    @param statement - SQLAlchemy statement
+    @param params - list of dicts/None
+  """
+  if not params:
+    return conn.execute(statement)
+
+  if isinstance(statement, Insert) and not isSQLite(conn):
+    return conn.execute(statement.values(params))
+
+  return conn.execute(statement, params)
+
+class IngestBuffer(object):
+  """
+    IngestBuffer
+
+    Description: Write-behind buffer for the high volume ingestion
+    tables (presence, rssi, data). Rows are collected in memory and
+    written with one multi-row INSERT per table, inside a single
+    transaction, every `interval` ms or as soon as `maxRows` rows
+    are pending. Whichever comes first.
+
+    Other components can `register` a collector whose statements
+    (ex: write-back UPDATEs) run in the same flush transaction, and
+    `listen` for the rows once they are committed.
+
+    @param engine - SQLAlchemy Engine
+    @param interval - Integer ms between flushes
+    @param maxRows - Integer pending rows that force a flush
+  """
+  def __init__(self, engine, interval = 250, maxRows = 1000):
+    self.engine = engine
+    self.interval = interval
+    self.maxRows = maxRows
+
+    self.pending = {}
+    self.writing = {} # rows of the flush running now, until committed
+    self.size = 0
+    self.since = None # monotonic time the oldest pending row was queued
+    self.collectors = []
+    self.listeners = []
+    self.lock = threading.Lock()
+    self.flushLock = threading.Lock()
+    self.wake = threading.Event()
+    self.running = False
+    self.thread = None
+
+    # recent flush latencies (ms) for percentiles, see backend/bench.py
+    self.latencies = deque(maxlen=1024)
+
+    self.stats = {
+      'flushes': 0,
+      'rows': 0,
+      'updates': 0,
+      'errors': 0,
+      'lastSize': 0,
+      'lastLatency': 0.0,
+      'maxLatency': 0.0,
+    }
+
+  def add(self, model, **row):
+    """
+      add
+
+      Queues a row for the table backing `model`. The row time is
+      taken now, not at flush time.
+
+      @param model - SQLAlchemy model class
+      @param row - column values
+    """
+    row.setdefault('time', datetime.utcnow())
+
+    with self.lock:
+      self.pending.setdefault(model.__table__, []).append(row)
+
+      if not self.size:
+        self.since = time.monotonic()
+
+      self.size += 1
+      full = self.size >= self.maxRows
+
+    if full:
+      self.wake.set()
+
+  def clear(self):
+    """
+      clear
+
+      Drops every pending row without writing it (ex: the tables
+      were just truncated and the rows point at deleted macs)
+
+      @return size - Integer rows dropped
+    """
+    with self.lock:
+      size, self.size = self.size, 0
+      self.pending = {}
+      self.since = None
+
+    return size
+
+  def queued(self, model):
+    """
+      queued
+
+      @param model - SQLAlchemy model class
+      @return rows - list of the rows for `model` not committed yet
+    """
+    table = model.__table__
+
+    with self.lock:
+      return self.pending.get(table, []) + self.writing.get(table, [])
+
+  def register(self, collect):
+    """
+      register
+
+      @param collect - Callable returning a list of (statement, params)
+    """
+    self.collectors.append(collect)
+
+  def listen(self, listener):
+    """
+      listen
+
+      @param listener - Callable(Dict of Table -> committed rows)
+    """
+    self.listeners.append(listener)
+
+  def flush(self):
+    """
+      flush
+
+      Writes every pending row and collected statement. Falls back to
+      row by row inserts when the batch is rejected (ex: the mac was
+      deleted while its rows were pending) so one bad row does not
+      drop the batch.
+
+      @return size - Integer rows flushed
+    """
+    with self.flushLock:
+      with self.lock:
+        pending, self.pending = self.pending, {}
+        self.writing = pending
+        size, self.size = self.size, 0
+        since, self.since = self.since, None
+
+      batches = []
+
+      for collect in self.collectors:
+        batches.extend(collect())
+
+      if not size and not batches:
+        return 0
+
+      # rows bound into the collected statements, see `execute`
+      updates = sum(len(params) if params else 1 for statement, params in batches)
+      start = time.perf_counter()
+
+      try:
+        with self.engine.begin() as conn:
+          for table, rows in pending.items():
+            execute(conn, table.insert(), rows)
+
+          for statement, params in batches:
+            execute(conn, statement, params)
+      except Exception as e:
+        logger.error(f'FLUSH FAILED: {e}')
+        self.stats['errors'] += 1
+        flushErrors.inc()
+        pending = self.flushRows(pending, batches)
+
+      latency = (time.perf_counter() - start) * 1000
+
+      self.stats['flushes'] += 1
+      self.stats['rows'] += size
+      self.stats['updates'] += updates
+      self.stats['lastSize'] = size
+      self.stats['lastLatency'] = latency
+      self.stats['maxLatency'] = max(self.stats['maxLatency'], latency)
+      self.latencies.append(latency)
+
+      flushSeconds.observe(latency / 1000)
+
+      if since is not None:
+        commitDelay.observe(time.monotonic() - since)
+
+      for table, rows in pending.items():
+        rowsWritten.inc(table.name, amount=len(rows))
+
+      logger.debug('FLUSH: %d rows %d updates in %.1fms', size, updates, latency)
+
+      for listener in self.listeners:
+        try:
+          listener(pending)
+        except Exception as e:
+          logger.error(e)
+
+      with self.lock:
+        self.writing = {}
+
+      return size
+
+  def flushRows(self, pending, batches):
+    """
+      flushRows
+
+      Slow path of `flush`. Inserts each row and runs each collected
+      statement in its own transaction, dropping the ones that fail.
+
+      @param pending - Dict of Table -> list of rows
+      @param batches - list of (statement, params)
+      @return written - Dict of Table -> rows that were inserted
+    """
+    written = {}
+
+    for table, rows in pending.items():
+      for row in rows:
+        try:
+          with self.engine.begin() as conn:
+            conn.execute(table.insert().values(row))
+
+          written.setdefault(table, []).append(row)
+        except Exception as e:
+          logger.error(f'FLUSH DROP: {table.name} {row} {e}')
+
+    for statement, params in batches:
+      try:
+        with self.engine.begin() as conn:
+          execute(conn, statement, params)
+      except Exception as e:
+        logger.error(f'FLUSH DROP: {statement} {e}')
+
+    return written
+
+  def run(self):
+    while self.running:
+      self.wake.wait(self.interval / 1000)
+      self.wake.clear()
+
+      try:
+        self.flush()
+      except Exception as e:
+        logger.error(e)
+
+  def start(self):
+    """
+      start
+
+      Starts the background flush thread
+    """
+    if self.running:
+      return
+
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='ingest-flush', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    """
+      stop
+
+      Stops the flush thread and writes whatever is still pending.
+      Safe to call more than once (atexit + explicit shutdown).
+    """
+    if self.running:
+      self.running = False
+      self.wake.set()
+      self.thread.join()
+
+    self.flush()
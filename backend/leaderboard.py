@@ -0,0 +1,128 @@
+import logging
+import threading
+
+from .models import Mac
+from .rollup import toUTC
+
+logger = logging.getLogger(__name__)
+
+class Leaderboard(object):
+  """
+    Leaderboard
+
+    Description: The `size` most seen devices, kept up to date by
+    ingestion so `count=` requests do not sort the `mac` table.
+    Every device outside the board has been seen no more than
+    `floor` times, and `floor` is at most the smallest count on the
+    board, so the board's top n (time filtered or not) is the table's
+    top n. `seen` itself is still written back by DeviceCache.collect.
+
+    @param size - Integer devices kept
+  """
+  def __init__(self, size = 1000):
+    self.size = size
+    self.counts = {}
+    self.lastSeen = {}
+    self.floor = 0
+    # every known device is on the board
+    self.complete = True
+    self.lock = threading.Lock()
+
+  def load(self, session):
+    """
+      load
+
+      @param session - SQLAlchemy session
+      @return count - Integer devices loaded
+    """
+    rows = session.query(Mac.id, Mac.seen, Mac.last_seen).order_by(Mac.seen.desc()).limit(self.size + 1).all()
+
+    with self.lock:
+      self.complete = len(rows) <= self.size
+      rows = rows[:self.size]
+      self.counts = {id: seen or 0 for id, seen, last_seen in rows}
+      self.lastSeen = {id: last_seen for id, seen, last_seen in rows}
+      self.floor = min(self.counts.values()) if rows and not self.complete else 0
+
+    logger.info(f'Leaderboard loaded: {len(rows)} devices')
+
+    return len(rows)
+
+  def update(self, mac_id, seen, when):
+    """
+      update
+
+      Called on every sighting with the device's new total
+
+      @param mac_id - Integer
+      @param seen - Integer
+      @param when - DateTime last seen
+    """
+    with self.lock:
+      if mac_id in self.counts:
+        self.counts[mac_id] = seen
+        self.lastSeen[mac_id] = toUTC(when)
+        return
+
+      if len(self.counts) < self.size and (self.complete or seen >= self.floor):
+        self.counts[mac_id] = seen
+        self.lastSeen[mac_id] = toUTC(when)
+        return
+
+      if seen <= self.floor:
+        return
+
+      # the floor only moves up, catch up with the board before evicting
+      smallest = min(self.counts, key=self.counts.get)
+      self.floor = self.counts[smallest]
+
+      if seen <= self.floor:
+        return
+
+      del self.counts[smallest]
+      del self.lastSeen[smallest]
+      self.complete = False
+
+      self.counts[mac_id] = seen
+      self.lastSeen[mac_id] = toUTC(when)
+
+  def discard(self, mac_id):
+    with self.lock:
+      self.counts.pop(mac_id, None)
+      self.lastSeen.pop(mac_id, None)
+
+  def clear(self):
+    with self.lock:
+      self.counts = {}
+      self.lastSeen = {}
+      self.floor = 0
+      self.complete = True
+
+  def top(self, count, since = None):
+    """
+      top
+
+      @param count - Integer
+      @param since - naive UTC DateTime/None only devices seen after it
+      @return list of Integer mac ids, most seen first. None when the
+      board cannot answer and the caller has to ask the database
+    """
+    if count > self.size:
+      return None
+
+    with self.lock:
+      ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+      lastSeen = self.lastSeen
+      complete = self.complete
+
+      out = []
+
+      for mac_id, seen in ranked:
+        if since is None or (lastSeen[mac_id] is not None and lastSeen[mac_id] > since):
+          out.append(mac_id)
+
+          if len(out) == count:
+            return out
+
+    # fewer matches than asked, devices off the board may match too
+    return out if complete else None
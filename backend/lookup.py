@@ -0,0 +1,193 @@
+import logging
+import threading
+
+from .models import OUID, UUID_Lookup
+
+logger = logging.getLogger(__name__)
+
+# IEEE assignment sizes in hex digits: MA-S (36 bit), MA-M (28 bit), MA-L (24 bit)
+OUI_LENGTHS = (9, 7, 6)
+
+# Bluetooth Base UUID 0000xxxx-0000-1000-8000-00805F9B34FB
+BASE_UUID_SUFFIX = '-0000-1000-8000-00805F9B34FB'
+
+def normalizeHex(value):
+  """
+    normalizeHex
+
+    Strips separators from a mac/prefix and uppercases it
+
+    Ex: 00:1a-2b -> 001A2B
+
+    @param value - String
+    @return string
+  """
+  return value.replace(':', '').replace('-', '').replace('.', '').upper()
+
+class OUIResolver(object):
+  """
+    OUIResolver
+
+    Description: In memory index of the `ouid` table. Prefixes are
+    bucketed by length so a lookup is one dict hit per assignment
+    size, longest (most specific) first.
+  """
+  def __init__(self):
+    self.index = {}
+    self.vendors = {}
+    self.lock = threading.Lock()
+
+    # read by /api/metrics, not locked so counts are approximate
+    self.hits = 0
+    self.misses = 0
+
+  def load(self, session):
+    """
+      load
+
+      (Re)loads the whole `ouid` table. The new index is built on
+      the side and swapped in so lookups never see a partial table.
+
+      @param session - SQLAlchemy session
+      @return count - Integer prefixes loaded
+    """
+    index = {length: {} for length in OUI_LENGTHS}
+    vendors = {}
+
+    # rows in id order so the last duplicate prefix wins, same as the old LIKE loop
+    for id, prefix, vendor in session.query(OUID.id, OUID.prefix, OUID.vendor).order_by(OUID.id):
+      prefix = normalizeHex(prefix or '')
+
+      if len(prefix) in index:
+        index[len(prefix)][prefix] = id
+        vendors[id] = vendor
+
+    with self.lock:
+      self.index = index
+      self.vendors = vendors
+
+    count = sum(len(bucket) for bucket in index.values())
+    logger.info(f'OUI index loaded: {count} prefixes')
+
+    return count
+
+  reload = load
+
+  def resolve(self, addr):
+    """
+      resolve
+
+      Longest prefix match of a mac address
+
+      @param addr - String mac address
+      @return id - Integer ouid id or None
+    """
+    index = self.index
+    addr = normalizeHex(addr)
+
+    for length in OUI_LENGTHS:
+      id = index.get(length, {}).get(addr[0:length])
+
+      if id is not None:
+        self.hits += 1
+        return id
+
+    self.misses += 1
+
+    return None
+
+  def vendor(self, id):
+    return self.vendors.get(id)
+
+def shortUUID(uuid):
+  """
+    shortUUID
+
+    Reduces a UUID to its 16 bit alias when it is derived from the
+    Bluetooth Base UUID. Vendor 128 bit UUIDs have no alias.
+
+    Ex: 0000180F-0000-1000-8000-00805F9B34FB -> 180F
+    Ex: 0000180F -> 180F
+
+    @param uuid - String
+    @return string/None
+  """
+  uuid = uuid.upper()
+
+  if len(uuid) == 4:
+    return uuid
+
+  if len(uuid) == 8 and uuid.startswith('0000'):
+    return uuid[4:8]
+
+  if len(uuid) == 36 and uuid.startswith('0000') and uuid.endswith(BASE_UUID_SUFFIX):
+    return uuid[4:8]
+
+  return None
+
+class UUIDResolver(object):
+  """
+    UUIDResolver
+
+    Description: In memory map of the `uuid_lookup` table shared by
+    the advertised UUID and GATT service/characteristic/descriptor
+    ingestion paths.
+  """
+  def __init__(self):
+    self.index = {}
+    self.lock = threading.Lock()
+
+    # read by /api/metrics, not locked so counts are approximate
+    self.hits = 0
+    self.misses = 0
+
+  def load(self, session):
+    """
+      load
+
+      (Re)loads the whole `uuid_lookup` table
+
+      @param session - SQLAlchemy session
+      @return count - Integer uuids loaded
+    """
+    index = {}
+
+    for id, prefix in session.query(UUID_Lookup.id, UUID_Lookup.prefix).order_by(UUID_Lookup.id):
+      if prefix:
+        index[prefix.upper()] = id
+
+    with self.lock:
+      self.index = index
+
+    logger.info(f'UUID index loaded: {len(index)} uuids')
+
+    return len(index)
+
+  reload = load
+
+  def resolve(self, uuid):
+    """
+      resolve
+
+      Resolves a 16, 32 or 128 bit UUID to its lookup id. Full
+      128 bit entries are matched as is, base UUIDs by their alias.
+
+      @param uuid - String
+      @return id - Integer uuid_lookup id or None
+    """
+    index = self.index
+    uuid = uuid.upper()
+    short = shortUUID(uuid)
+
+    if short is not None and short in index:
+      self.hits += 1
+      return index[short]
+
+    id = index.get(uuid)
+
+    if id is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+
+    return id
@@ -0,0 +1,206 @@
+"""
+  Metrics
+
+  In process counters, gauges and histograms rendered in the
+  Prometheus text format by `GET /api/metrics`. Hot path updates are
+  one lock and an add, nothing is formatted until a scrape.
+
+  https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a fast RSSI update to a slow flush
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(names, values, extra = ''):
+  pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+
+  if extra:
+    pairs.append(extra)
+
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def formatValue(value):
+  if value == float('inf'):
+    return '+Inf'
+
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+  """
+    Metric
+
+    @param name - String, `btdm_` prefixed
+    @param help - String
+    @param labels - tuple of String label names
+  """
+  type = 'untyped'
+
+  def __init__(self, name, help, labels = ()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def samples(self):
+    """
+      samples
+
+      @return list of (name suffix, label values, extra label, value)
+    """
+    with self.lock:
+      return [('', key, '', value) for key, value in self.values.items()]
+
+  def render(self):
+    lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+    for suffix, key, extra, value in self.samples():
+      lines.append(f'{self.name}{suffix}{formatLabels(self.labels, key, extra)} {formatValue(value)}')
+
+    return '\n'.join(lines)
+
+class Counter(Metric):
+  type = 'counter'
+
+  def inc(self, *labels, amount = 1):
+    """
+      inc
+
+      Ex: signals.inc('InterfacesAdded')
+
+      @param labels - label values in `self.labels` order
+      @param amount - Number
+    """
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+  type = 'gauge'
+
+  def set(self, value, *labels):
+    with self.lock:
+      self.values[labels] = value
+
+class Histogram(Metric):
+  """
+    Histogram
+
+    Cumulative buckets are only summed up at scrape time, `observe`
+    increments a single bucket.
+
+    @param buckets - tuple of ascending upper bounds
+  """
+  type = 'histogram'
+
+  def __init__(self, name, help, labels = (), buckets = BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, *labels):
+    """
+      observe
+
+      @param value - Number, seconds for latencies
+      @param labels - label values in `self.labels` order
+    """
+    index = bisect_left(self.buckets, value)
+
+    with self.lock:
+      counts = self.values.get(labels)
+
+      if counts is None:
+        # one slot per bucket, +Inf, then the sum
+        counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+
+      counts[index] += 1
+      counts[-1] += value
+
+  def samples(self):
+    with self.lock:
+      values = [(key, list(counts)) for key, counts in self.values.items()]
+
+    out = []
+
+    for key, counts in values:
+      total = 0
+
+      for bound, count in zip(self.buckets + (float('inf'),), counts):
+        total += count
+        out.append(('_bucket', key, f'le="{formatValue(float(bound))}"', total))
+
+      out.append(('_sum', key, '', counts[-1]))
+      out.append(('_count', key, '', total))
+
+    return out
+
+class Collected(Metric):
+  """
+    Collected
+
+    Description: Metric read at scrape time from state another
+    component already keeps (ex: `WorkerPool.stats()`), so the
+    component does not have to update a second counter.
+
+    @param type - String [counter, gauge]
+    @param collect - Callable returning a list of (label values, value)
+  """
+  def __init__(self, name, help, type, collect, labels = ()):
+    super().__init__(name, help, labels)
+    self.type = type
+    self.collect = collect
+
+  def samples(self):
+    return [('', tuple(key), '', value) for key, value in self.collect()]
+
+class Registry(object):
+  def __init__(self):
+    self.metrics = {}
+    self.lock = threading.Lock()
+
+  def register(self, metric):
+    """
+      register
+
+      Returns the metric already registered under the same name, so
+      modules imported twice (`python3 backend/bt.py`) share it.
+
+      @param metric - Metric
+      @return metric - Metric
+    """
+    with self.lock:
+      return self.metrics.setdefault(metric.name, metric)
+
+  def render(self):
+    with self.lock:
+      metrics = list(self.metrics.values())
+
+    out = []
+
+    for metric in metrics:
+      try:
+        out.append(metric.render())
+      except Exception as e:
+        out.append(f'# {metric.name} failed: {escape(e)}')
+
+    return '\n'.join(out) + '\n'
+
+registry = Registry()
+
+def counter(name, help, labels = ()):
+  return registry.register(Counter(name, help, labels))
+
+def gauge(name, help, labels = ()):
+  return registry.register(Gauge(name, help, labels))
+
+def histogram(name, help, labels = (), buckets = BUCKETS):
+  return registry.register(Histogram(name, help, labels, buckets))
+
+def collected(name, help, type, collect, labels = ()):
+  return registry.register(Collected(name, help, type, collect, labels))
@@ -0,0 +1,280 @@
+import re
+import sys
+import json
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, text
+
+from .models import Base, SchemaVersion, Mac, Presence, RSSI, RSSISummary, Data, UUID, engine
+from .partitions import PARTITIONED, isPartitioned, convert
+from .storage import isSQLite
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_xact_lock key so two processes never migrate at once
+LOCK_KEY = 7243
+
+# EXPLAIN QUERY PLAN detail naming the index a sqlite SEARCH/SCAN uses
+SQLITE_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+
+# sqlite databases are created with the current models, the postgres only
+# steps (ALTER .. IF NOT EXISTS, partitions) are skipped there
+
+def dataPayloadColumns(conn):
+  # columns added to `data` for deduplicated payloads
+  if isSQLite(conn):
+    return
+
+  for statement in [
+    'ALTER TABLE data ADD COLUMN IF NOT EXISTS payload bytea',
+    'ALTER TABLE data ADD COLUMN IF NOT EXISTS hash varchar',
+    'ALTER TABLE data ADD COLUMN IF NOT EXISTS last_seen timestamp without time zone',
+    'ALTER TABLE data ADD COLUMN IF NOT EXISTS count integer DEFAULT 1',
+    'ALTER TABLE data ADD COLUMN IF NOT EXISTS day date',
+  ]:
+    conn.execute(text(statement))
+
+def partitionByDay(conn):
+  if isSQLite(conn):
+    return
+
+  for table, key in PARTITIONED.items():
+    if not isPartitioned(conn, table):
+      convert(conn, table, key)
+
+def macTimeIndexes(conn):
+  # per device reads: mac_id IN (...) AND time > .. ORDER BY time
+  # rssi_summary is already covered by its (mac_id, time) unique index
+  for statement in [
+    'CREATE INDEX IF NOT EXISTS ix_presence_mac_time ON presence (mac_id, time DESC)',
+    'CREATE INDEX IF NOT EXISTS ix_rssi_mac_time ON rssi (mac_id, time DESC)',
+    'CREATE INDEX IF NOT EXISTS ix_data_mac_last_seen ON data (mac_id, last_seen DESC)',
+    'CREATE INDEX IF NOT EXISTS ix_uuid_mac ON uuid (mac_id)',
+    'CREATE INDEX IF NOT EXISTS ix_mac_last_seen ON mac (last_seen)',
+  ]:
+    conn.execute(text(statement))
+
+def timeBrinIndexes(conn):
+  # rows are appended in time order, a BRIN index stays tiny
+  for table in ['presence', 'rssi', 'rssi_summary', 'data']:
+    if isSQLite(conn):
+      # no BRIN in sqlite, a plain b-tree serves the time range reads and retention
+      conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_time ON {table} (time)'))
+    else:
+      conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_time_brin ON {table} USING brin (time)'))
+
+def presenceAdapter(conn):
+  # which adapter an observation came from, NULL for rows from before multi-adapter capture
+  if isSQLite(conn):
+    # sqlite has no ADD COLUMN IF NOT EXISTS, tables created with the current models have it
+    columns = [row[1] for row in conn.execute(text('PRAGMA table_info(presence)'))]
+
+    if 'adapter' not in columns:
+      conn.execute(text('ALTER TABLE presence ADD COLUMN adapter varchar'))
+  else:
+    conn.execute(text('ALTER TABLE presence ADD COLUMN IF NOT EXISTS adapter varchar'))
+
+def sqliteAutoincrement(conn):
+  # cursor ids must not be reused after a reset. sqlite only adds AUTOINCREMENT
+  # in CREATE TABLE: rebuild from the table's own DDL, then put its indexes back
+  if not isSQLite(conn):
+    return
+
+  for table in ['presence', 'rssi_summary', 'data']:
+    sql, = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), { 'name': table }).fetchone()
+
+    if 'AUTOINCREMENT' in sql:
+      continue
+
+    indexes = [index for index, in conn.execute(
+      text("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL"), { 'name': table }
+    )]
+    create, count = re.subn(r'\bid INTEGER NOT NULL,(.*),\s*PRIMARY KEY \(id\)', r'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,\1', sql, flags=re.S)
+
+    if not count:
+      raise RuntimeError(f'Unexpected {table} schema: {sql}')
+
+    create = re.sub(rf'^CREATE TABLE "?{table}"?', f'CREATE TABLE {table}_new', create)
+    columns = ', '.join(f'"{row[1]}"' for row in conn.execute(text(f'PRAGMA table_info({table})')))
+
+    conn.execute(text(create))
+    conn.execute(text(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}'))
+    conn.execute(text(f'DROP TABLE {table}'))
+    conn.execute(text(f'ALTER TABLE {table}_new RENAME TO {table}'))
+
+    for index in indexes:
+      conn.execute(text(index))
+
+def sqliteRekeyTriggers(conn):
+  # upserts move the updated row to a new id (storage.nextId), sqlite_sequence
+  # only follows inserts on its own
+  if not isSQLite(conn):
+    return
+
+  for table in ['rssi_summary', 'data']:
+    conn.execute(text(
+      f'CREATE TRIGGER IF NOT EXISTS {table}_rekey AFTER UPDATE OF id ON {table} '
+      f"BEGIN UPDATE sqlite_sequence SET seq = NEW.id WHERE name = '{table}' AND seq < NEW.id; END"
+    ))
+
+def dropSeenIndex(conn):
+  # `count=` is answered by the in memory leaderboard, the index only cost an
+  # index write per device on every flush
+  conn.execute(text('DROP INDEX IF EXISTS ix_mac_seen'))
+
+# (version, name, Callable(conn)), append only. Never renumber or edit a shipped migration
+MIGRATIONS = [
+  (1, 'data payload columns', dataPayloadColumns),
+  (2, 'partition presence/rssi_summary/data by day', partitionByDay),
+  (3, 'mac_id, time indexes', macTimeIndexes),
+  (4, 'time brin indexes', timeBrinIndexes),
+  (5, 'presence adapter column', presenceAdapter),
+  (6, 'drop mac seen index', dropSeenIndex),
+  (7, 'sqlite autoincrement cursor ids', sqliteAutoincrement),
+  (8, 'sqlite re-keyed upsert triggers', sqliteRekeyTriggers),
+]
+
+def currentVersion(conn):
+  return conn.execute(text('SELECT coalesce(max(version), 0) FROM schema_version')).scalar()
+
+def migrate(engine):
+  """
+    migrate
+
+    Description: Creates missing tables then applies every pending
+    migration, each in its own transaction along with its
+    `schema_version` row. Safe to run on every start.
+
+    @param engine - SQLAlchemy Engine
+    @return applied - list of Integer versions applied
+  """
+  Base.metadata.create_all(engine)
+  applied = []
+
+  for version, name, migration in MIGRATIONS:
+    with engine.begin() as conn:
+      if not isSQLite(conn):
+        conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), { 'key': LOCK_KEY })
+
+      if currentVersion(conn) >= version:
+        continue
+
+      logger.info(f'Migrating to {version}: {name}')
+      migration(conn)
+      conn.execute(SchemaVersion.__table__.insert().values(version=version, name=name, applied=datetime.utcnow()))
+      applied.append(version)
+
+  return applied
+
+def planNodes(plan):
+  yield plan
+
+  for child in plan.get('Plans', []):
+    yield from planNodes(child)
+
+def explain(conn, statement):
+  """
+    explain
+
+    @param conn - SQLAlchemy Connection
+    @param statement - SQLAlchemy select
+    @return plan - Dict root node of EXPLAIN (FORMAT JSON)
+  """
+  compiled = statement.compile(dialect=conn.dialect, compile_kwargs={ 'render_postcompile': True })
+  cursor = conn.connection.cursor()
+  cursor.execute(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params)
+  plan, = cursor.fetchone()
+
+  if isinstance(plan, str):
+    plan = json.loads(plan)
+
+  return plan[0]['Plan']
+
+def explainSQLite(conn, statement):
+  """
+    explainSQLite
+
+    @param conn - SQLAlchemy Connection
+    @param statement - SQLAlchemy select
+    @return (Bool uses indexes, list of String index names)
+  """
+  compiled = statement.compile(dialect=conn.dialect, compile_kwargs={ 'render_postcompile': True })
+  cursor = conn.connection.cursor()
+  cursor.execute(f'EXPLAIN QUERY PLAN {compiled}', [compiled.params[name] for name in compiled.positiontup or []])
+  details = [row[-1] for row in cursor.fetchall()]
+  indexes = sorted(set(match.group(1) for detail in details for match in [SQLITE_INDEX.search(detail)] if match))
+
+  # a SCAN without an index reads the whole table, temp b-trees (ORDER BY) are fine
+  ok = not any(detail.startswith('SCAN') and 'INDEX' not in detail for detail in details)
+
+  return ok, indexes
+
+def apiQueries():
+  """
+    apiQueries
+
+    The reads `/api/query` and `/api/query/sample` run the most, in
+    the shape `rowsByMac`/`rssiByMac`/`samplePresence` build them.
+
+    @return list of (name, select)
+  """
+  ids = [1, 2, 3]
+  since = datetime.utcnow() - timedelta(hours=1)
+
+  return [
+    ('mac by last_seen', select([Mac.__table__]).where(Mac.last_seen > since)),
+    ('presence by mac', select([Presence.__table__]).where(Presence.mac_id.in_(ids)).where(Presence.time > since).order_by(Presence.time.desc())),
+    ('presence by time', select([Presence.__table__]).where(Presence.time > since)),
+    ('rssi_summary by mac', select([RSSISummary.__table__]).where(RSSISummary.mac_id.in_(ids)).where(RSSISummary.time > since).order_by(RSSISummary.time)),
+    ('data by mac', select([Data.__table__]).where(Data.mac_id.in_(ids)).where(Data.last_seen > since).where(Data.day >= since.date())),
+    ('uuid by mac', select([UUID.__table__]).where(UUID.mac_id.in_(ids))),
+  ]
+
+def check(engine):
+  """
+    check
+
+    Description: EXPLAINs `apiQueries` and reports the indexes they
+    use. Sequential scans are disabled for the check so a small or
+    empty database gives the same answer as a large one: a query that
+    still plans a Seq Scan has no usable index. SQLite reports its
+    EXPLAIN QUERY PLAN instead, where a bare SCAN is the failure.
+
+    @param engine - SQLAlchemy Engine
+    @return list of (name, Bool uses indexes, list of String index names)
+  """
+  results = []
+
+  with engine.begin() as conn:
+    if isSQLite(conn):
+      for name, statement in apiQueries():
+        ok, indexes = explainSQLite(conn, statement)
+        results.append((name, ok, indexes))
+
+      return results
+
+    conn.execute(text('SET LOCAL enable_seqscan = off'))
+
+    for name, statement in apiQueries():
+      nodes = list(planNodes(explain(conn, statement)))
+      indexes = sorted(set(node['Index Name'] for node in nodes if 'Index Name' in node))
+      ok = not any(node['Node Type'] == 'Seq Scan' for node in nodes)
+
+      results.append((name, ok, indexes))
+
+  return results
+
+if __name__ == '__main__':
+  logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+  # python3 -m backend.migrations [check]
+  if sys.argv[1:] == ['check']:
+    results = check(engine)
+
+    for name, ok, indexes in results:
+      print(f'{"ok  " if ok else "SEQ "} {name}: {", ".join(indexes) or "-"}')
+
+    sys.exit(0 if all(ok for name, ok, indexes in results) else 1)
+
+  applied = migrate(engine)
+  print(f'Applied: {", ".join(str(version) for version in applied) or "none"}')
@@ -1,16 +1,20 @@
 from datetime import datetime, timezone
-from sqlalchemy import create_engine, ForeignKey
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, Float, LargeBinary, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import as_declarative
 from sqlalchemy.orm import relationship
 
-engine = create_engine(
-  'postgresql:///blt',
-  echo=False,
-  connect_args={
-    'options': '-c timezone=utc'
-  }
-)
+if __name__ == '__main__':
+  from config import DATABASE, POOL_SIZE, POOL_OVERFLOW, SQLITE_MMAP, SQLITE_CACHE
+  from storage import createEngine, isSQLite
+else:
+  from backend.config import DATABASE, POOL_SIZE, POOL_OVERFLOW, SQLITE_MMAP, SQLITE_CACHE
+  from backend.storage import createEngine, isSQLite
+
+engine = createEngine(DATABASE, POOL_SIZE, POOL_OVERFLOW, SQLITE_MMAP, SQLITE_CACHE)
+
+# SQLite has no partitions, and only a lone INTEGER primary key autoincrements
+PARTITIONED = not isSQLite(DATABASE)
 
 @as_declarative()
 class Base(object):
@@ -58,7 +62,7 @@ class Mac(Base):
 
   first_seen = Column(DateTime, default=datetime.utcnow)
   last_seen = Column(DateTime, default=datetime.utcnow, index=True)
-  seen = Column(Integer, default=1, index=True)
+  seen = Column(Integer, default=1) # top n is served by backend/leaderboard.py, not an index
 
   oui = relationship('OUID', lazy='joined')
   uuids = relationship('UUID', lazy='joined')
@@ -71,17 +75,50 @@ class Mac(Base):
     self.name = name
     self.ouid = ouid
 
+def utcday():
+  return datetime.utcnow().date()
+
+# presence, rssi_summary and data are range partitioned by day on postgres, see backend/partitions.py
+# their ids make up the `/api/query` cursor, AUTOINCREMENT keeps sqlite from reusing them after a reset
 class Presence(Base):
   __tablename__ = 'presence'
+  __table_args__ = {
+    'postgresql_partition_by': 'RANGE (time)',
+    'sqlite_autoincrement': True,
+  }
 
-  id = Column(Integer, primary_key=True)
+  id = Column(Integer, primary_key=True, autoincrement=True)
   mac_id = Column(Integer, ForeignKey(Mac.id))
   type = Column(String)
-  time = Column(DateTime, default=datetime.utcnow)
+  time = Column(DateTime, primary_key=PARTITIONED, default=datetime.utcnow)
+  adapter = Column(String) # hci0, hci1.. the observation came from
 
-  def __init__(self, mac_id, type):
+  def __init__(self, mac_id, type, adapter = None):
     self.mac_id = mac_id
     self.type = type
+    self.adapter = adapter
+
+class PresenceRollup(Base):
+  __tablename__ = 'presence_rollup'
+  __table_args__ = (
+    UniqueConstraint('resolution', 'mac_id', 'bucket'),
+  )
+
+  id = Column(Integer, primary_key=True)
+  mac_id = Column(Integer, ForeignKey(Mac.id, ondelete='CASCADE'))
+  resolution = Column(Integer) # bucket width in seconds
+  bucket = Column(DateTime)
+  type = Column(String) # type of the last presence in the bucket
+  time = Column(DateTime) # time of the last presence in the bucket
+  count = Column(Integer, default=0)
+
+  def __init__(self, mac_id, resolution, bucket, type, time, count):
+    self.mac_id = mac_id
+    self.resolution = resolution
+    self.bucket = bucket
+    self.type = type
+    self.time = time
+    self.count = count
 
 class UUID_Lookup(Base):
   __tablename__ = 'uuid_lookup'
@@ -130,19 +167,83 @@ class RSSI(Base):
     self.mac_id = mac_id
     self.rssi = rssi
 
+class RSSISummary(Base):
+  __tablename__ = 'rssi_summary'
+  __table_args__ = (
+    UniqueConstraint('mac_id', 'time'),
+    {
+      'postgresql_partition_by': 'RANGE (time)',
+      'sqlite_autoincrement': True,
+    },
+  )
+
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  mac_id = Column(Integer, ForeignKey(Mac.id, ondelete='CASCADE'))
+  time = Column(DateTime, primary_key=PARTITIONED) # window start
+  last_time = Column(DateTime) # time of the last sample in the window
+  count = Column(Integer)
+  min = Column(Integer)
+  max = Column(Integer)
+  mean = Column(Float)
+  last = Column(Integer)
+
+  def __init__(self, mac_id, time, last_time, count, min, max, mean, last):
+    self.mac_id = mac_id
+    self.time = time
+    self.last_time = last_time
+    self.count = count
+    self.min = min
+    self.max = max
+    self.mean = mean
+    self.last = last
+
 class Data(Base):
   __tablename__ = 'data'
-
-  id = Column(Integer, primary_key=True)
+  __table_args__ = (
+    Index('ix_data_payload', 'mac_id', 'key', 'hash', 'day', unique=True),
+    {
+      'postgresql_partition_by': 'RANGE (day)',
+      'sqlite_autoincrement': True,
+    },
+  )
+
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  day = Column(Date, primary_key=PARTITIONED, default=utcday) # partition key, payloads are deduplicated per day
   mac_id = Column(Integer, ForeignKey(Mac.id))
-  time = Column(DateTime, default=datetime.utcnow)
+  time = Column(DateTime, default=datetime.utcnow) # first seen
   key = Column(String)
-  value = Column(Text)
+  value = Column(Text) # decimal string, rows from before `payload`
+  payload = Column(LargeBinary)
+  hash = Column(String)
+  last_seen = Column(DateTime, default=datetime.utcnow)
+  count = Column(Integer, default=1)
 
-  def __init__(self, mac_id, key, value):
+  def __init__(self, mac_id, key, value, payload = None):
     self.mac_id = mac_id
     self.key = key
     self.value = value
+    self.payload = payload
+
+  def as_dict(self):
+    out = {c.name: str(getattr(self, c.name)) for c in self.__table__.columns if c.name not in ('payload', 'hash', 'day')}
+
+    # same space separated decimal representation as the text rows
+    if self.payload is not None:
+      out['value'] = ' '.join(str(b) for b in self.payload)
+
+    return out
+
+class SchemaVersion(Base):
+  __tablename__ = 'schema_version'
+
+  version = Column(Integer, primary_key=True, autoincrement=False)
+  name = Column(String)
+  applied = Column(DateTime, default=datetime.utcnow)
+
+class Seed(Base):
+  __tablename__ = 'seed'
 
-# create tables
-Base.metadata.create_all(engine)
+  name = Column(String, primary_key=True)
+  checksum = Column(String) # sha256 of the loaded file
+  rows = Column(Integer)
+  loaded = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,194 @@
+import re
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+from .models import Base
+from .storage import isSQLite
+from .config import RETENTION_DAYS, PARTITION_DAYS_AHEAD, MAINTENANCE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# table -> partition key column
+PARTITIONED = {
+  'presence': 'time',
+  'rssi_summary': 'time',
+  'data': 'day',
+}
+
+BOUND = re.compile(r"TO \('([0-9-]+)")
+
+def isPartitioned(conn, table):
+  return conn.execute(text("""
+    SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+    WHERE c.relname = :table
+  """), { 'table': table }).first() is not None
+
+def convert(conn, table, key):
+  """
+    convert
+
+    Description: Turns an existing plain table into the partitioned
+    one from the model, in place. The old table (and its indexes) is
+    renamed to `<table>_legacy` and attached as the partition holding
+    everything up to the day after its newest row, so no row is copied.
+
+    @param conn - SQLAlchemy Connection (in a transaction)
+    @param table - String
+    @param key - String partition key column
+  """
+  legacy = f'{table}_legacy'
+
+  logger.info(f'Partitioning {table}. Existing rows become {legacy}')
+
+  if table == 'data':
+    conn.execute(text(f'UPDATE {table} SET day = time::date WHERE day IS NULL'))
+
+  indexes = conn.execute(text('SELECT indexname FROM pg_indexes WHERE tablename = :table'), { 'table': table }).fetchall()
+
+  conn.execute(text(f'ALTER TABLE {table} RENAME TO {legacy}'))
+
+  for index, in indexes:
+    conn.execute(text(f'ALTER INDEX {index} RENAME TO {index}_legacy'))
+
+  sequence = conn.execute(text('SELECT pg_get_serial_sequence(:table, :column)'), { 'table': legacy, 'column': 'id' }).scalar()
+  upper = conn.execute(text(f'SELECT max({key}) FROM {legacy}')).scalar()
+
+  conn.execute(text(f'ALTER TABLE {legacy} ALTER COLUMN {key} SET NOT NULL'))
+
+  Base.metadata.tables[table].create(conn)
+
+  # keep ids increasing across the old and new rows
+  conn.execute(text(f"""
+    SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM {legacy}), false)
+  """))
+
+  if sequence:
+    conn.execute(text(f'ALTER TABLE {legacy} ALTER COLUMN id DROP DEFAULT'))
+    conn.execute(text(f'DROP SEQUENCE IF EXISTS {sequence}'))
+
+  upper = (upper.date() if isinstance(upper, datetime) else upper or datetime.utcnow().date()) + timedelta(days=1)
+
+  conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{upper.isoformat()}')"))
+
+def partitionName(table, day):
+  return f'{table}_p{day.strftime("%Y%m%d")}'
+
+def ensurePartitions(engine, daysAhead = PARTITION_DAYS_AHEAD):
+  """
+    ensurePartitions
+
+    Creates the daily partitions from today to `daysAhead` days out,
+    plus a default partition for rows outside of them (clock skew).
+    Days already covered (ex: by a legacy partition) are skipped.
+  """
+  if isSQLite(engine):
+    return
+
+  today = datetime.utcnow().date()
+
+  for table in PARTITIONED:
+    with engine.begin() as conn:
+      conn.execute(text(f'CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT'))
+
+    for offset in range(0, daysAhead + 1):
+      day = today + timedelta(days=offset)
+      name = partitionName(table, day)
+
+      try:
+        with engine.begin() as conn:
+          conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table}
+            FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')
+          """))
+      except Exception as e:
+        logger.debug(f'Partition {name} skipped: {e}')
+
+def dropExpired(engine, retentionDays = RETENTION_DAYS):
+  """
+    dropExpired
+
+    Drops every partition whose upper bound is older than the
+    retention window. Rollups are not partitioned and are deleted,
+    as are the expired rows on SQLite.
+
+    @return dropped - list of partition names
+  """
+  dropped = []
+
+  if not retentionDays:
+    return dropped
+
+  cutoff = datetime.utcnow().date() - timedelta(days=retentionDays)
+
+  if isSQLite(engine):
+    with engine.begin() as conn:
+      for table, key in PARTITIONED.items():
+        conn.execute(text(f'DELETE FROM {table} WHERE {key} < :cutoff'), { 'cutoff': cutoff.isoformat() })
+
+      conn.execute(text('DELETE FROM presence_rollup WHERE bucket < :cutoff'), { 'cutoff': cutoff.isoformat() })
+
+    return dropped
+
+  with engine.begin() as conn:
+    for table in PARTITIONED:
+      partitions = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+      """), { 'table': table }).fetchall()
+
+      for name, bound in partitions:
+        match = BOUND.search(bound or '')
+
+        if match and datetime.strptime(match.group(1), '%Y-%m-%d').date() <= cutoff:
+          conn.execute(text(f'DROP TABLE {name}'))
+          dropped.append(name)
+
+    conn.execute(text('DELETE FROM presence_rollup WHERE bucket < :cutoff'), { 'cutoff': cutoff })
+
+  if dropped:
+    logger.info(f'Retention dropped partitions: {", ".join(dropped)}')
+
+  return dropped
+
+def prepare(engine):
+  """
+    prepare
+
+    Creates upcoming partitions and applies retention. Run at startup,
+    after `migrate` has partitioned the tables, then by `Maintenance`.
+  """
+  ensurePartitions(engine)
+  dropExpired(engine)
+
+class Maintenance(object):
+  """
+    Maintenance
+
+    Description: Background thread running partition creation and
+    retention every `interval` seconds.
+  """
+  def __init__(self, engine, interval = MAINTENANCE_INTERVAL):
+    self.engine = engine
+    self.interval = interval
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        ensurePartitions(self.engine)
+        dropExpired(self.engine)
+      except Exception as e:
+        logger.error(e)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name='partition-maintenance', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
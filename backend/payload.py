@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import threading
+from .models import Data, engine
+from .storage import upsert, nextId, greatest
+from .rollup import toUTC
+
+logger = logging.getLogger(__name__)
+
+def render(payload):
+  """
+    render
+
+    Ex: b'\x4c\x00' -> '76 0'
+
+    @param payload - bytes
+    @return string
+  """
+  return ' '.join(str(b) for b in payload)
+
+def payloadHash(payload):
+  return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+class PayloadStore(object):
+  """
+    PayloadStore
+
+    Description: Deduplicated ServiceData/ManufacturerData storage.
+    A payload is inserted once per (mac, key, content hash, day) as bytea;
+    seeing it again only bumps `count`/`last_seen` of that row. Pending
+    payloads are aggregated in memory and upserted by `collect`, which
+    is registered on the IngestBuffer.
+  """
+  def __init__(self):
+    self.pending = {}
+    self.last = {}
+    self.live = []
+    self.lock = threading.Lock()
+
+  def add(self, mac_id, key, payload, when):
+    """
+      add
+
+      @param mac_id - Integer
+      @param key - String ServiceData uuid / ManufacturerData company id
+      @param payload - bytes
+      @param when - DateTime
+      @return bool - True if the payload differs from the last one for mac/key
+    """
+    when = toUTC(when)
+    hash = payloadHash(payload)
+
+    with self.lock:
+      entry = self.pending.get((mac_id, key, hash))
+
+      if entry is None:
+        self.pending[(mac_id, key, hash)] = [payload, when, when, 1]
+      else:
+        entry[2] = when
+        entry[3] += 1
+
+      changed = self.last.get((mac_id, key)) != hash
+      self.last[(mac_id, key)] = hash
+
+      if changed:
+        self.live.append({ 'mac_id': mac_id, 'key': key, 'value': render(payload), 'time': when })
+        del self.live[:-1000]
+
+      return changed
+
+  def drain(self):
+    """
+      drain
+
+      Changed payloads since the last drain, for the event stream
+    """
+    with self.lock:
+      live, self.live = self.live, []
+
+    return live
+
+  def discard(self, mac_id):
+    with self.lock:
+      for key in [key for key in self.last if key[0] == mac_id]:
+        del self.last[key]
+
+  def clear(self):
+    with self.lock:
+      self.pending.clear()
+      self.last.clear()
+      self.live = []
+
+  def collect(self):
+    """
+      collect
+
+      IngestBuffer collector. Inserts new payloads and bumps the
+      counters of the ones already stored.
+
+      @return batches - list of (statement, params)
+    """
+    with self.lock:
+      pending, self.pending = self.pending, {}
+
+    if not pending:
+      return []
+
+    rows = [{
+      'day': first.date(),
+      'mac_id': mac_id,
+      'key': key,
+      'hash': hash,
+      'payload': payload,
+      'time': first,
+      'last_seen': last,
+      'count': count,
+    } for (mac_id, key, hash), (payload, first, last, count) in pending.items()]
+
+    table = Data.__table__
+
+    return [upsert(engine, table, rows, ['mac_id', 'key', 'hash', 'day'], lambda excluded: {
+      'count': table.c.count + excluded.count,
+      'last_seen': greatest(engine, table.c.last_seen, excluded.last_seen),
+      'id': nextId(engine, table),
+    })]
+
+store = PayloadStore()
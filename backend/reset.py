@@ -0,0 +1,171 @@
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import select, text
+
+from .models import Mac, UUID, Presence, PresenceRollup, RSSI, RSSISummary, Data
+from .util import dbusPathToMac, dbusPathToAdapter
+from .storage import isSQLite
+from .config import RESET_BATCH
+
+logger = logging.getLogger(__name__)
+
+# every table holding collected data, mac last since the others reference it
+CHILD_TABLES = [model.__table__ for model in (RSSI, RSSISummary, UUID, Presence, PresenceRollup, Data)]
+TABLES = CHILD_TABLES + [Mac.__table__]
+
+DEVICE_INTERFACE = 'org.bluez.Device1'
+
+def truncate(engine):
+  """
+    truncate
+
+    Empties every collected table in one transaction. The cursor ids
+    are not restarted so cursors handed out before the reset stay
+    valid: TRUNCATE leaves the postgres sequences alone, and the sqlite
+    cursor tables are AUTOINCREMENT (migration 7) so an unfiltered
+    DELETE, SQLite's TRUNCATE, does not hand their rowids out again.
+
+    @param engine - SQLAlchemy Engine
+  """
+  with engine.begin() as conn:
+    if isSQLite(engine):
+      for table in TABLES:
+        conn.execute(table.delete())
+    else:
+      conn.execute(text(f'TRUNCATE {", ".join(table.name for table in TABLES)}'))
+
+  logger.info('truncate done')
+
+def deleteSince(engine, timestamp, batchSize = RESET_BATCH):
+  """
+    deleteSince
+
+    Deletes the macs last seen after `timestamp` and their rows,
+    `batchSize` macs per transaction so locks are held briefly.
+
+    @param engine - SQLAlchemy Engine
+    @param timestamp - DateTime
+    @param batchSize - Integer macs per transaction
+    @return generator of list of (id, addr) deleted per batch
+  """
+  while True:
+    with engine.begin() as conn:
+      macs = conn.execute(
+        select([Mac.id, Mac.addr]).where(Mac.last_seen > timestamp).order_by(Mac.id).limit(batchSize)
+      ).fetchall()
+
+      if not macs:
+        return
+
+      ids = [id for id, addr in macs]
+
+      for table in CHILD_TABLES:
+        conn.execute(table.delete().where(table.c.mac_id.in_(ids)))
+
+      conn.execute(Mac.__table__.delete().where(Mac.id.in_(ids)))
+
+    yield [(id, addr) for id, addr in macs]
+
+class ResetJob(object):
+  """
+    ResetJob
+
+    Description: Background part of `DELETE /api/query`. Runs the
+    batched range delete when a `timestamp` is given, then removes
+    the matching devices from the BlueZ cache. `progress` is what
+    `GET /api/query/reset` reports.
+
+    @param adapterFor - Callable(String adapter name) -> DBusProxy org.bluez.Adapter1
+    @param manager - DBusProxy org.freedesktop.DBus.ObjectManager
+    @param engine - SQLAlchemy Engine
+    @param timestamp - DateTime/None, None removes every device
+    @param onDeleted - Callable(list of (id, addr)) after each batch
+  """
+  def __init__(self, adapterFor, manager, engine, timestamp = None, onDeleted = None):
+    self.adapterFor = adapterFor
+    self.manager = manager
+    self.engine = engine
+    self.timestamp = timestamp
+    self.onDeleted = onDeleted
+    self.thread = None
+
+    self.progress = {
+      'state': 'pending',
+      'phase': None,
+      'time': timestamp.isoformat() if timestamp else None,
+      'deleted': 0,
+      'total': 0,
+      'removed': 0,
+      'failed': 0,
+      'started': None,
+      'finished': None,
+      'error': None,
+    }
+
+  @property
+  def running(self):
+    return self.progress['state'] in ('pending', 'running')
+
+  def deletePhase(self):
+    addrs = []
+    self.progress['phase'] = 'database'
+
+    for macs in deleteSince(self.engine, self.timestamp):
+      addrs.extend(addr for id, addr in macs)
+      self.progress['deleted'] += len(macs)
+
+      if self.onDeleted:
+        self.onDeleted(macs)
+
+    logger.info(f'range delete done: {self.progress["deleted"]} macs')
+
+    return addrs
+
+  def devicePaths(self, addrs):
+    objects = self.manager.GetManagedObjects()
+    paths = [path for path, interfaces in objects.items() if DEVICE_INTERFACE in interfaces]
+
+    if addrs is None:
+      return paths
+
+    # every adapter that saw an address has its own object for it
+    wanted = set(addrs)
+
+    return [path for path in paths if dbusPathToMac(path) in wanted]
+
+  def removePhase(self, addrs):
+    self.progress['phase'] = 'bluez'
+    paths = self.devicePaths(addrs)
+    self.progress['total'] = len(paths)
+
+    for path in paths:
+      try:
+        self.adapterFor(dbusPathToAdapter(path)).RemoveDevice('(o)', path)
+        self.progress['removed'] += 1
+      except Exception as e:
+        logger.error(f'RemoveDevice {path}: {e}')
+        self.progress['failed'] += 1
+
+    logger.info(f'bluez cleanup done: {self.progress["removed"]}/{self.progress["total"]} devices')
+
+  def run(self):
+    self.progress['state'] = 'running'
+    self.progress['started'] = datetime.utcnow().isoformat()
+
+    try:
+      addrs = self.deletePhase() if self.timestamp else None
+      self.removePhase(addrs)
+      self.progress['state'] = 'done'
+    except Exception as e:
+      logger.error(e)
+      self.progress['state'] = 'failed'
+      self.progress['error'] = str(e)
+
+    self.progress['finished'] = datetime.utcnow().isoformat()
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name='reset', daemon=True)
+    self.thread.start()
+
+    return self
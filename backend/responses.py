@@ -0,0 +1,122 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class Entry(object):
+  def __init__(self, generation, value, size):
+    self.generation = generation
+    self.value = value
+    self.size = size
+    self.created = time.monotonic()
+
+class ResponseCache(object):
+  """
+    ResponseCache
+
+    Description: Serialized API responses shared by every client
+    asking the same question (ex: dashboards polling
+    `/api/query/sample` with the same bucketed `time`). An entry is
+    served while it is younger than `ttl` seconds and was built at the
+    current ingestion `generation`. Concurrent misses on a key wait for
+    the first one instead of running the same query. Entries are
+    evicted least recently used first once `maxBytes` is exceeded.
+
+    @param maxBytes - Integer bound on the cached response bodies
+    @param ttl - Float seconds an entry is served
+  """
+  def __init__(self, maxBytes = 64 * 1024 * 1024, ttl = 2.0):
+    self.maxBytes = maxBytes
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.inflight = {}
+    self.size = 0
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.waits = 0
+    self.evictions = 0
+
+  def fresh(self, entry, generation):
+    return entry.generation == generation and time.monotonic() - entry.created < self.ttl
+
+  def get(self, key, generation, compute, timeout = 30):
+    """
+      get
+
+      @param key - hashable normalized request
+      @param generation - Integer ingestion generation, see LocalController.generation
+      @param compute - Callable returning (value, Integer size, Bool cacheable)
+      @param timeout - Float seconds to wait for another request computing `key`
+      @return value
+    """
+    while True:
+      with self.lock:
+        entry = self.entries.get(key)
+
+        if entry is not None and self.fresh(entry, generation):
+          self.entries.move_to_end(key)
+          self.hits += 1
+          return entry.value
+
+        flight = self.inflight.get(key)
+        leader = flight is None
+
+        if leader:
+          flight = self.inflight[key] = threading.Event()
+          self.misses += 1
+        else:
+          self.waits += 1
+
+      if leader:
+        break
+
+      # the leader stored its answer or failed, then one waiter takes over
+      flight.wait(timeout)
+
+    try:
+      value, size, cacheable = compute()
+
+      if cacheable and size <= self.maxBytes:
+        self.put(key, Entry(generation, value, size))
+
+      return value
+    finally:
+      with self.lock:
+        del self.inflight[key]
+
+      flight.set()
+
+  def put(self, key, entry):
+    with self.lock:
+      previous = self.entries.pop(key, None)
+
+      if previous is not None:
+        self.size -= previous.size
+
+      self.entries[key] = entry
+      self.size += entry.size
+
+      while self.size > self.maxBytes:
+        evicted, old = self.entries.popitem(last=False)
+        self.size -= old.size
+        self.evictions += 1
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+  def stats(self):
+    with self.lock:
+      return {
+        'entries': len(self.entries),
+        'bytes': self.size,
+        'hits': self.hits,
+        'misses': self.misses,
+        'waits': self.waits,
+        'evictions': self.evictions,
+      }
@@ -0,0 +1,207 @@
+import logging
+import threading
+from datetime import datetime, timezone
+from sqlalchemy import text
+from sqlalchemy.sql.expression import func
+
+from .models import Presence, PresenceRollup, engine
+from .storage import upsert, greatest, isSQLite
+
+logger = logging.getLogger(__name__)
+
+# bucket widths in seconds, finest first
+RESOLUTIONS = (10, 60, 900)
+
+def toUTC(when):
+  """
+    toUTC
+
+    Naive UTC datetime, the way presence times are stored
+
+    @param when - DateTime aware/naive
+    @return DateTime
+  """
+  if when.tzinfo is not None:
+    when = when.astimezone(timezone.utc).replace(tzinfo=None)
+
+  return when
+
+def bucketStart(when, resolution):
+  """
+    bucketStart
+
+    Ex: 12:00:07 @ 10s -> 12:00:00
+
+    @param when - naive UTC DateTime
+    @param resolution - Integer seconds
+    @return DateTime
+  """
+  epoch = (when - datetime(1970, 1, 1)).total_seconds()
+
+  return datetime.utcfromtimestamp(epoch - (epoch % resolution))
+
+class PresenceRollups(object):
+  """
+    PresenceRollups
+
+    Description: Keeps the `presence_rollup` table in step with the
+    presence rows being ingested. Counts are aggregated in memory per
+    (resolution, mac, bucket) and upserted by `collect`, which is
+    registered on the IngestBuffer.
+  """
+  def __init__(self, resolutions = RESOLUTIONS):
+    self.resolutions = resolutions
+    self.pending = {}
+    self.lock = threading.Lock()
+
+  def add(self, mac_id, type, when):
+    """
+      add
+
+      @param mac_id - Integer
+      @param type - String presence type
+      @param when - DateTime of the presence
+    """
+    when = toUTC(when)
+
+    with self.lock:
+      for resolution in self.resolutions:
+        key = (resolution, mac_id, bucketStart(when, resolution))
+        entry = self.pending.get(key)
+
+        if entry is None:
+          self.pending[key] = [1, when, type]
+        else:
+          entry[0] += 1
+
+          if when >= entry[1]:
+            entry[1] = when
+            entry[2] = type
+
+  def collect(self):
+    """
+      collect
+
+      IngestBuffer collector. One INSERT .. ON CONFLICT for every
+      bucket touched since the last flush.
+
+      @return batches - list of (statement, params)
+    """
+    with self.lock:
+      pending, self.pending = self.pending, {}
+
+    if not pending:
+      return []
+
+    rows = [{
+      'resolution': resolution,
+      'mac_id': mac_id,
+      'bucket': bucket,
+      'count': count,
+      'time': when,
+      'type': type,
+    } for (resolution, mac_id, bucket), (count, when, type) in pending.items()]
+
+    table = PresenceRollup.__table__
+
+    return [upsert(engine, table, rows, ['resolution', 'mac_id', 'bucket'], lambda excluded: {
+      'count': table.c.count + excluded.count,
+      'time': greatest(engine, table.c.time, excluded.time),
+      'type': excluded.type,
+    })]
+
+  def discard(self, mac_id):
+    with self.lock:
+      self.pending = {key: entry for key, entry in self.pending.items() if key[1] != mac_id}
+
+  def clear(self):
+    with self.lock:
+      self.pending.clear()
+
+BACKFILL = """
+  INSERT INTO presence_rollup (resolution, mac_id, bucket, type, time, count)
+  SELECT :resolution, mac_id,
+    to_timestamp(floor(extract(epoch from time) / :resolution) * :resolution) AT TIME ZONE 'UTC' AS bucket,
+    (array_agg(type ORDER BY time DESC))[1], max(time), count(*)
+  FROM presence
+  WHERE mac_id IS NOT NULL
+  GROUP BY mac_id, bucket
+  ON CONFLICT (resolution, mac_id, bucket) DO NOTHING
+"""
+
+# buckets in the text format SQLAlchemy stores sqlite datetimes in, the
+# bare `type` column comes from the row holding max(time)
+BACKFILL_SQLITE = """
+  INSERT OR IGNORE INTO presence_rollup (resolution, mac_id, bucket, type, time, count)
+  SELECT :resolution, mac_id,
+    strftime('%Y-%m-%d %H:%M:%S.000000', (CAST(strftime('%s', time) AS INTEGER) / :resolution) * :resolution, 'unixepoch') AS bucket,
+    type, max(time), count(*)
+  FROM presence
+  WHERE mac_id IS NOT NULL
+  GROUP BY mac_id, bucket
+"""
+
+def backfill(session, resolutions = RESOLUTIONS):
+  """
+    backfill
+
+    Builds the rollups from the raw presence table. Only needed once
+    for databases that have presence rows from before the rollups.
+
+    @param session - SQLAlchemy session
+  """
+  statement = text(BACKFILL_SQLITE if isSQLite(engine) else BACKFILL)
+
+  for resolution in resolutions:
+    session.execute(statement, { 'resolution': resolution })
+
+  session.commit()
+  logger.info('Presence rollups backfilled')
+
+def boundedCount(session, query, limit):
+  """
+    boundedCount
+
+    COUNT that stops after `limit` rows, so its cost is bounded by
+    `limit` and not by the table size.
+
+    @return count - Integer <= limit
+  """
+  return session.query(func.count()).select_from(query.limit(limit).subquery()).scalar()
+
+def samplePresence(session, ids, timestamp = False, maxTarget = 20000):
+  """
+    samplePresence
+
+    Description: Picks the finest presence series that keeps at most
+    `maxTarget` points for the given macs: raw presence first, then
+    each rollup resolution. The coarsest resolution is truncated to the
+    most recent `maxTarget` buckets if it is still too large.
+
+    @param session - SQLAlchemy session
+    @param ids - list of mac ids
+    @param timestamp - DateTime/False only points after it
+    @param maxTarget - Integer max points
+    @return (resolution, rows) - resolution 0 is raw presence
+  """
+  if not ids:
+    return (0, [])
+
+  query = session.query(Presence).filter(Presence.mac_id.in_(ids))
+
+  if timestamp:
+    query = query.filter(Presence.time > timestamp)
+
+  if boundedCount(session, query.with_entities(Presence.id), maxTarget + 1) <= maxTarget:
+    return (0, query.all())
+
+  for resolution in RESOLUTIONS:
+    query = session.query(PresenceRollup).filter(PresenceRollup.resolution == resolution, PresenceRollup.mac_id.in_(ids))
+
+    if timestamp:
+      query = query.filter(PresenceRollup.time > timestamp)
+
+    if boundedCount(session, query.with_entities(PresenceRollup.id), maxTarget + 1) <= maxTarget:
+      return (resolution, query.all())
+
+  return (resolution, query.order_by(PresenceRollup.bucket.desc()).limit(maxTarget).all())
@@ -0,0 +1,210 @@
+import logging
+import threading
+from datetime import timedelta
+from collections import deque
+from .models import RSSISummary, engine
+from .storage import upsert, nextId, greatest, least
+from .config import RSSI_WINDOW, RSSI_RING
+from .rollup import bucketStart, toUTC
+
+logger = logging.getLogger(__name__)
+
+class RSSIAggregator(object):
+  """
+    RSSIAggregator
+
+    Description: Coalesces RSSI PropertiesChanged events. The last
+    `ring` raw samples of each device stay in a fixed size ring in
+    memory, and only one (count, min, max, mean, last) summary per
+    device per `window` seconds is written to `rssi_summary` by
+    `collect`, registered on the IngestBuffer.
+
+    @param window - Integer seconds per summary
+    @param ring - Integer raw samples kept per device
+  """
+  def __init__(self, window = RSSI_WINDOW, ring = RSSI_RING):
+    self.window = window
+    self.ring = ring
+    self.rings = {}
+    self.pending = {}
+    self.live = []
+    self.lock = threading.Lock()
+
+  def add(self, mac_id, rssi, when):
+    """
+      add
+
+      @param mac_id - Integer
+      @param rssi - Integer dBm
+      @param when - DateTime of the sample
+      @return bool - True for the device's first sample in this window
+    """
+    when = toUTC(when)
+    key = (mac_id, bucketStart(when, self.window))
+
+    with self.lock:
+      samples = self.rings.get(mac_id)
+
+      if samples is None:
+        samples = self.rings[mac_id] = deque(maxlen=self.ring)
+
+      samples.append((when, rssi))
+      self.live.append((mac_id, when, rssi))
+
+      entry = self.pending.get(key)
+      first = entry is None and (len(samples) < 2 or bucketStart(samples[-2][0], self.window) != key[1])
+
+      if entry is None:
+        self.pending[key] = [1, rssi, rssi, rssi, rssi, when]
+      else:
+        entry[0] += 1
+        entry[1] = min(entry[1], rssi)
+        entry[2] = max(entry[2], rssi)
+        entry[3] += rssi
+        entry[4] = rssi
+        entry[5] = when
+
+      return first
+
+  def tail(self, mac_id):
+    """
+      tail
+
+      @return list of (time, rssi) oldest first
+    """
+    with self.lock:
+      return list(self.rings.get(mac_id, ()))
+
+  def drain(self):
+    """
+      drain
+
+      Samples added since the last drain, for the event stream
+
+      @return list of (mac_id, time, rssi)
+    """
+    with self.lock:
+      live, self.live = self.live, []
+
+    return live
+
+  def discard(self, mac_id):
+    with self.lock:
+      self.rings.pop(mac_id, None)
+
+  def clear(self):
+    with self.lock:
+      self.rings.clear()
+      self.pending.clear()
+      self.live = []
+
+  def collect(self):
+    """
+      collect
+
+      IngestBuffer collector. Upserts every window that received
+      samples since the last flush, merging with what is stored.
+
+      @return batches - list of (statement, params)
+    """
+    with self.lock:
+      pending, self.pending = self.pending, {}
+      self.live = self.live[-self.ring:]
+
+    if not pending:
+      return []
+
+    rows = [{
+      'mac_id': mac_id,
+      'time': window,
+      'last_time': when,
+      'count': count,
+      'min': low,
+      'max': high,
+      'mean': total / count,
+      'last': last,
+    } for (mac_id, window), (count, low, high, total, last, when) in pending.items()]
+
+    table = RSSISummary.__table__
+
+    return [upsert(engine, table, rows, ['mac_id', 'time'], lambda excluded: {
+      'count': table.c.count + excluded.count,
+      'min': least(engine, table.c.min, excluded.min),
+      'max': greatest(engine, table.c.max, excluded.max),
+      'mean': (table.c.mean * table.c.count + excluded.mean * excluded.count) / (table.c.count + excluded.count),
+      'last': excluded.last,
+      'last_time': excluded.last_time,
+      'id': nextId(engine, table),
+    })]
+
+aggregator = RSSIAggregator()
+
+def rssiByMac(session, ids, timestamp = False, idRange = None, windowSize = 1000):
+  """
+    rssiByMac
+
+    Description: RSSI series per mac for the API: stored window
+    summaries, with the windows covered by the in-memory ring replaced
+    by its raw samples. Delta (idRange) queries only return stored
+    summaries.
+
+    @param session - SQLAlchemy session
+    @param ids - list of mac ids
+    @param timestamp - DateTime/False only points after it
+    @param idRange - (after, upto) rssi_summary ids
+    @return dict - mac id -> list of dicts (time, rssi, min, max, mean, count)
+  """
+  out = {id: [] for id in ids}
+
+  for i in range(0, len(ids), windowSize):
+    query = session.query(RSSISummary).filter(RSSISummary.mac_id.in_(ids[i:i + windowSize]))
+
+    if timestamp:
+      # window start bound lets postgres prune the rssi_summary partitions
+      query = query.filter(
+        RSSISummary.last_time > timestamp,
+        RSSISummary.time > timestamp - timedelta(seconds=aggregator.window)
+      )
+
+    if idRange:
+      query = query.filter(RSSISummary.id > idRange[0], RSSISummary.id <= idRange[1])
+
+    for row in query.order_by(RSSISummary.time):
+      out[row.mac_id].append({
+        'id': row.id,
+        'mac_id': row.mac_id,
+        'time': row.time,
+        'rssi': int(round(row.mean)),
+        'min': row.min,
+        'max': row.max,
+        'mean': row.mean,
+        'last': row.last,
+        'count': row.count,
+      })
+
+  if idRange:
+    return out
+
+  for id in ids:
+    tail = aggregator.tail(id)
+
+    if not tail:
+      continue
+
+    start = bucketStart(tail[0][0], aggregator.window)
+    summaries = [s for s in out[id] if s['time'] < start]
+    samples = [{
+      'id': None,
+      'mac_id': id,
+      'time': when,
+      'rssi': rssi,
+      'min': rssi,
+      'max': rssi,
+      'mean': rssi,
+      'last': rssi,
+      'count': 1,
+    } for when, rssi in tail if not timestamp or when > timestamp]
+
+    out[id] = summaries + samples
+
+  return out
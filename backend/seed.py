@@ -0,0 +1,166 @@
+"""
+  Seed data
+
+  Loads the category/ouid/uuid_lookup rows of data/import_all.sql in
+  one transaction: COPY into a temp table then one upsert per table
+  on postgres, an executemany upsert on sqlite. The file checksum is
+  stored in `seed`, so an unchanged file is not loaded again.
+
+    python3 -m backend.seed [--force]
+"""
+import io
+import os
+import re
+import sys
+import hashlib
+import logging
+import argparse
+from datetime import datetime
+from sqlalchemy import select, text
+
+from .models import Category, OUID, UUID_Lookup, Seed, engine
+from .storage import isSQLite, upsert
+from .ingest import execute
+
+logger = logging.getLogger(__name__)
+
+SEED_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'import_all.sql')
+
+# parents first, ouid references category
+TABLES = [Category.__table__, OUID.__table__, UUID_Lookup.__table__]
+
+LINE = re.compile(r'^INSERT INTO (\w+) VALUES\((.*)\);$')
+VALUE = re.compile(r"\s*(?:'((?:[^']|'')*)'|(NULL)|(-?\d+))\s*(?:,|$)")
+
+def checksum(filename):
+  with open(filename, 'rb') as file:
+    return hashlib.sha256(file.read()).hexdigest()
+
+def parseValues(values):
+  """
+    parseValues
+
+    Ex: 3,NULL,'O''Neil' -> (3, None, "O'Neil")
+
+    @param values - String inside VALUES(...)
+    @return tuple
+  """
+  out = []
+
+  for string, null, number in VALUE.findall(values):
+    if null:
+      out.append(None)
+    elif number:
+      out.append(int(number))
+    else:
+      out.append(string.replace("''", "'"))
+
+  return tuple(out)
+
+def parse(filename):
+  """
+    parse
+
+    @param filename - String of `INSERT INTO <table> VALUES(...);` lines
+    @return dict - table name -> list of tuples in column order
+  """
+  out = {}
+
+  with open(filename, encoding='utf-8') as file:
+    for line in file:
+      match = LINE.match(line.strip())
+
+      if match:
+        out.setdefault(match.group(1), []).append(parseValues(match.group(2)))
+
+  return out
+
+def csvValue(value):
+  if value is None:
+    return ''
+
+  if isinstance(value, int):
+    return str(value)
+
+  return '"' + value.replace('"', '""') + '"'
+
+def copyTable(conn, table, rows):
+  """
+    copyTable
+
+    Postgres: COPY into a temp table, then a single upsert by id.
+    Rows referenced by macs/uuids are updated in place, never deleted.
+  """
+  columns = [column.name for column in table.columns]
+  names = ', '.join(columns)
+  temp = f'seed_{table.name}'
+  buffer = io.StringIO()
+
+  for row in rows:
+    buffer.write(','.join(csvValue(value) for value in row) + '\n')
+
+  buffer.seek(0)
+
+  conn.execute(text(f'CREATE TEMP TABLE {temp} (LIKE {table.name}) ON COMMIT DROP'))
+  conn.connection.cursor().copy_expert(f'COPY {temp} ({names}) FROM STDIN WITH (FORMAT csv)', buffer)
+  conn.execute(text(f"""
+    INSERT INTO {table.name} ({names}) SELECT {names} FROM {temp}
+    ON CONFLICT (id) DO UPDATE SET {', '.join(f'{column} = EXCLUDED.{column}' for column in columns if column != 'id')}
+  """))
+
+  # ids came from the file, move the serial past them
+  conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM {table.name}), false)"))
+
+def load(engine, filename = SEED_FILE, force = False):
+  """
+    load
+
+    @param engine - SQLAlchemy Engine
+    @param filename - String
+    @param force - Bool load even if the checksum matches
+    @return count - Integer rows loaded, 0 when skipped
+  """
+  digest = checksum(filename)
+  name = os.path.basename(filename)
+
+  with engine.begin() as conn:
+    loaded = conn.execute(select([Seed.checksum]).where(Seed.name == name)).scalar()
+
+    if loaded == digest and not force:
+      logger.info(f'Seed {name} already loaded')
+      return 0
+
+    data = parse(filename)
+    count = 0
+
+    for table in TABLES:
+      rows = data.get(table.name, [])
+      count += len(rows)
+
+      if not rows:
+        continue
+
+      if isSQLite(conn):
+        columns = [column.name for column in table.columns]
+        execute(conn, *upsert(conn, table, [dict(zip(columns, row)) for row in rows], ['id'], lambda excluded: {
+          column: getattr(excluded, column) for column in columns if column != 'id'
+        }))
+      else:
+        copyTable(conn, table, rows)
+
+    conn.execute(Seed.__table__.delete().where(Seed.name == name))
+    conn.execute(Seed.__table__.insert().values(name=name, checksum=digest, rows=count, loaded=datetime.utcnow()))
+
+  logger.info(f'Seed {name} loaded: {count} rows')
+
+  return count
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Loads the OUI/category/UUID lookup data')
+  parser.add_argument('filename', nargs='?', default=SEED_FILE)
+  parser.add_argument('--force', action='store_true', help='load even if the checksum matches')
+  args = parser.parse_args()
+
+  logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+  print(f'Loaded {load(engine, args.filename, args.force)} rows')
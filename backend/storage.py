@@ -0,0 +1,149 @@
+"""
+  Storage backends
+
+  BTDM_DATABASE picks the backend by its url scheme:
+
+  * postgresql:///blt (default) - partitioned tables, multi-row upserts
+  * sqlite:///data/blt.db - single file for field kits, no database daemon
+
+  The few statements that differ between the two are built here so
+  the rest of the backend stays dialect agnostic.
+"""
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import func, literal_column
+from sqlalchemy.dialects import postgresql, sqlite
+
+def isSQLite(bind):
+  """
+    isSQLite
+
+    @param bind - SQLAlchemy Engine/Connection or url String
+    @return bool
+  """
+  if isinstance(bind, str):
+    return bind.startswith('sqlite')
+
+  return bind.dialect.name == 'sqlite'
+
+def sqlitePragmas(mmapSize, cacheSize):
+  """
+    sqlitePragmas
+
+    Connect listener tuning every SQLite connection: WAL so the API
+    reads while the flush thread writes, NORMAL sync (safe with WAL,
+    one fsync per checkpoint), memory mapped reads and a page cache.
+
+    @param mmapSize - Integer bytes
+    @param cacheSize - Integer KiB
+  """
+  def connect(dbapiConnection, record):
+    cursor = dbapiConnection.cursor()
+
+    for pragma in [
+      'journal_mode = WAL',
+      'synchronous = NORMAL',
+      'foreign_keys = ON',
+      'temp_store = MEMORY',
+      'busy_timeout = 30000',
+      f'mmap_size = {mmapSize}',
+      f'cache_size = -{cacheSize}',
+    ]:
+      cursor.execute(f'PRAGMA {pragma}')
+
+    cursor.close()
+
+  return connect
+
+def createEngine(url, poolSize = 10, poolOverflow = 20, mmapSize = 268435456, cacheSize = 32768):
+  """
+    createEngine
+
+    @param url - String SQLAlchemy url
+    @param poolSize - Integer connections kept open
+    @param poolOverflow - Integer extra connections under load
+    @param mmapSize - Integer bytes, SQLite only
+    @param cacheSize - Integer KiB, SQLite only
+    @return engine - SQLAlchemy Engine
+  """
+  if isSQLite(url):
+    # connections move between the ingestion workers, flush thread and flask
+    engine = create_engine(
+      url,
+      echo=False,
+      poolclass=QueuePool,
+      pool_size=poolSize,
+      max_overflow=poolOverflow,
+      connect_args={
+        'check_same_thread': False,
+        'timeout': 30,
+      }
+    )
+    event.listen(engine, 'connect', sqlitePragmas(mmapSize, cacheSize))
+
+    return engine
+
+  return create_engine(
+    url,
+    echo=False,
+    pool_size=poolSize,
+    max_overflow=poolOverflow,
+    pool_pre_ping=True,
+    connect_args={
+      'options': '-c timezone=utc'
+    }
+  )
+
+def upsert(bind, table, rows, index, update):
+  """
+    upsert
+
+    INSERT .. ON CONFLICT DO UPDATE of `rows`, as an IngestBuffer batch.
+    `backend.ingest.execute` runs it as one multi-row statement on
+    Postgres and as an executemany on SQLite, which costs nothing
+    without a network round trip and stays under its bound parameter
+    limit.
+
+    Ex: upsert(engine, table, rows, ['mac_id', 'time'], lambda excluded: {
+      'count': table.c.count + excluded.count
+    })
+
+    @param bind - SQLAlchemy Engine
+    @param table - SQLAlchemy Table
+    @param rows - list of dicts
+    @param index - list of String unique index columns
+    @param update - Callable(excluded) -> Dict of column -> expression
+    @return (statement, params)
+  """
+  statement = sqlite.insert(table) if isSQLite(bind) else postgresql.insert(table)
+
+  return (statement.on_conflict_do_update(index_elements=index, set_=update(statement.excluded)), rows)
+
+def nextId(bind, table):
+  """
+    nextId
+
+    A fresh id for a row an upsert updates, so the update lands after
+    every `since` cursor handed out before it. Postgres draws it from
+    the serial sequence, SQLite from sqlite_sequence, which the
+    `<table>_rekey` triggers (migration 8) move past ids set this way.
+
+    Ex: upsert(engine, table, rows, ['mac_id', 'time'], lambda excluded: {
+      'id': nextId(engine, table),
+    })
+
+    @param bind - SQLAlchemy Engine
+    @param table - SQLAlchemy Table with a serial/AUTOINCREMENT id
+    @return expression
+  """
+  if isSQLite(bind):
+    return literal_column(f"coalesce((SELECT seq FROM sqlite_sequence WHERE name = '{table.name}'), (SELECT max(id) FROM {table.name})) + 1")
+
+  return literal_column('DEFAULT')
+
+def greatest(bind, *values):
+  # SQLite's multi-argument max() is its GREATEST
+  return func.max(*values) if isSQLite(bind) else func.greatest(*values)
+
+def least(bind, *values):
+  return func.min(*values) if isSQLite(bind) else func.least(*values)
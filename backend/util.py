@@ -1,6 +1,12 @@
-from gi.repository import Gio
+import re
+from datetime import datetime, timezone
+from sqlalchemy.orm import object_session
 from sqlalchemy.sql.expression import func
-from .models import Mac, OUID, Data, RSSI, Presence
+from .models import Mac, OUID, Data, RSSI, RSSISummary, Presence
+from .rssi import rssiByMac
+
+# max ids per `mac_id IN (...)` window
+ID_WINDOW = 1000
 
 def safeCommit(session):
   """
@@ -17,7 +23,7 @@ def safeCommit(session):
   except Exception as e:
     session.rollback()
 
-def getDeviceForMac(address):
+def getDeviceForMac(address, adapter = 'hci0'):
   """
     getDeviceForMac
 
@@ -25,10 +31,25 @@ def getDeviceForMac(address):
     for the given mac address
 
     @oaram address - String of mac addr
+    @param adapter - String adapter name the device was seen on
+    @return device - DBusProxy
+  """
+  return getDeviceForPath(macToDBusPath(address, adapter))
+
+def getDeviceForPath(path):
+  """
+    getDeviceForPath
+
+    Gets a DBusProxy device interface
+    for the given device object path
+
+    @param path - String DBus object path
     @return device - DBusProxy
   """
+  # imported here so the API tier (and tests) run without PyGObject
+  from gi.repository import Gio
+
   bus = Gio.bus_get_sync(Gio.BusType.SYSTEM)
-  path = macToDBusPath(address)
 
   device = Gio.DBusProxy.new_sync(
     bus,
@@ -42,7 +63,10 @@ def getDeviceForMac(address):
 
   return device
 
-def macToDBusPath(mac):
+# /org/bluez/<adapter>/dev_<mac>[/service..], adapters are numbered past hci9
+DEVICE_PATH = re.compile(r'^/org/bluez/(hci\d+)/dev_([0-9A-Fa-f]{2}(?:_[0-9A-Fa-f]{2}){5})(?:/|$)')
+
+def macToDBusPath(mac, adapter = 'hci0'):
   """
     macToDBusPath
 
@@ -51,9 +75,10 @@ def macToDBusPath(mac):
     Ex: 55:32:23:21 -> /org/bluez/hci0/dev_55_32_23
 
     @param mac - String
+    @param adapter - String adapter name
     @return
   """
-  return  f'/org/bluez/hci0/dev_{mac.replace(":", "_")}'
+  return  f'/org/bluez/{adapter}/dev_{mac.replace(":", "_")}'
 
 def dbusPathToMac(path):
   """
@@ -63,9 +88,37 @@ def dbusPathToMac(path):
 
     Ex: /org/bluez/hci0/dev_22_22 -> 22:22
     @param path - String
-    @return string
+    @return string/None when the path is not a device or below one
   """
-  return path[20:37].replace('_', ':')
+  match = DEVICE_PATH.match(path)
+
+  return match.group(2).replace('_', ':') if match else None
+
+def dbusPathToAdapter(path):
+  """
+    dbusPathToAdapter
+
+    Ex: /org/bluez/hci10/dev_22_22 -> hci10
+    @param path - String
+    @return string/None when the path is not a device or below one
+  """
+  match = DEVICE_PATH.match(path)
+
+  return match.group(1) if match else None
+
+def devicePathsForMac(objects, mac):
+  """
+    devicePathsForMac
+
+    Every adapter keeps its own object for a device it has seen
+
+    @param objects - Dict GetManagedObjects() result
+    @param mac - String
+    @return list of String object paths
+  """
+  mac = mac.upper()
+
+  return [path for path, interfaces in objects.items() if 'org.bluez.Device1' in interfaces and dbusPathToMac(path) == mac]
 
 def shouldInclude(include, what):
   """
@@ -137,72 +190,128 @@ def macsAndPresence2json(macs, presences):
 
   return out
 
-def macs2json(macs, include = False, timestamp = False, plotAll = False):
+def timeColumn(model):
+  """
+    timeColumn
+
+    Column the `time` filters apply to. Deduplicated data rows are
+    matched on when their payload was last seen.
+  """
+  return model.last_seen if model is Data else model.time
+
+def timeFilters(model, timestamp):
+  """
+    timeFilters
+
+    Filters for rows after `timestamp`, including one on the partition
+    key so Postgres only scans the partitions that can match.
+
+    @return list of filter clauses
+  """
+  filters = [timeColumn(model) > timestamp]
+
+  # a payload seen again on a later day gets a row in that day's partition
+  if model is Data:
+    filters.append(Data.day >= timestamp.date())
+
+  return filters
+
+def rowsByMac(session, model, ids, timestamp = False, order = None, idRange = None):
+  """
+    rowsByMac
+
+    Description: Loads the `model` rows (presence/data/rssi) of every
+    mac in `ids` with one `mac_id IN (...)` query per window of ids
+    and groups them per mac, instead of one query per mac.
+
+    @param session - SQLAlchemy session
+    @param model - Presence/Data/RSSI
+    @param ids - list of mac ids
+    @param timestamp - DateTime/False only rows after it
+    @param order - order_by clause within each mac
+    @param idRange - (after, upto) only rows with after < id <= upto
+    @return dict - mac id -> list of row dicts
+  """
+  out = {id: [] for id in ids}
+
+  for i in range(0, len(ids), ID_WINDOW):
+    query = session.query(model).filter(model.mac_id.in_(ids[i:i + ID_WINDOW]))
+
+    if timestamp:
+      query = query.filter(*timeFilters(model, timestamp))
+
+    if idRange:
+      query = query.filter(model.id > idRange[0], model.id <= idRange[1])
+
+    if order is not None:
+      query = query.order_by(order)
+
+    for row in query:
+      out[row.mac_id].append(row.as_dict())
+
+  return out
+
+def macs2json(macs, include = False, timestamp = False, plotAll = False, since = None, cursor = None):
   """
     macs2json
 
     Description: Takes a response from SQLAlchemy and transforms it
-    into a structure that can be passed to `jsonify`
+    into a structure that can be passed to `jsonify`. Presence, data
+    and rssi are fetched for the whole set of macs at once, so the
+    query count does not grow with the number of macs.
 
     @param macs - Array of mac dicts
     @param include - String/Bool to include data/rssi
+    @param since - Dict cursor, only rows after it (replaces timestamp)
+    @param cursor - Dict cursor, only rows up to it
   """
   out = []
+  ids = [mac.id for mac in macs]
+  presences = {}
+  datas = {}
+  rssis = {}
 
-  for mac in macs:
-    item = mac.as_dict()
-    item['data'] = []
-    item['rssi'] = []
-    item['uuid'] = []
-    item['presence'] = []
-
-    if mac.oui:
-      oui = mac.oui.as_dict()
+  if macs:
+    session = object_session(macs[0])
+    after = timestamp if timestamp and not plotAll and not since else False
 
-      if mac.oui.category:
-        oui['category'] = mac.oui.category.as_dict()
-
-      item['ouid'] = oui
+    def idRange(table):
+      return (since[table], cursor[table]) if since else None
 
     try:
-      if timestamp and not plotAll:
-        query = Presence.time > timestamp
-
-        for presence in mac.presence.filter(query).all():
-          item['presence'].append(presence.as_dict())
-      else:
-        for presence in mac.presence.all():
-          item['presence'].append(presence.as_dict())
+      presences = rowsByMac(session, Presence, ids, after, Presence.time.desc(), idRange('presence'))
     except Exception as e:
       print(e);
       pass
 
     if include and shouldInclude(include, 'data'):
       try:
-        if timestamp and not plotAll:
-          query = Data.time > timestamp
-
-          for data in mac.data.filter(query).all():
-            item['data'].append(data.as_dict())
-        else:
-          for data in mac.data.all():
-            item['data'].append(data.as_dict())
+        datas = rowsByMac(session, Data, ids, after, Data.id, idRange('data'))
       except:
         pass
 
     if include and shouldInclude(include, 'rssi'):
       try:
-        if timestamp and not plotAll:
-          query = RSSI.time > timestamp
-
-          for rssi in mac.rssis.filter(query).all():
-            item['rssi'].append(rssi.as_dict())
-        else:
-          for rssi in mac.rssis.all():
-            item['rssi'].append(rssi.as_dict())
+        rssis = rssiByMac(session, ids, after, idRange('rssi'))
+        rssis = {id: [row2json(row) for row in rows] for id, rows in rssis.items()}
       except:
         pass
 
+  for mac in macs:
+    item = mac.as_dict()
+    item['data'] = datas.get(mac.id, [])
+    item['rssi'] = rssis.get(mac.id, [])
+    item['uuid'] = []
+    item['presence'] = presences.get(mac.id, [])
+
+    if mac.oui:
+      oui = mac.oui.as_dict()
+
+      if mac.oui.category:
+        oui['category'] = mac.oui.category.as_dict()
+
+      item['ouid'] = oui
+
     try:
       for uuid in mac.uuids:
         uuidObj = uuid.as_dict()
@@ -223,6 +332,26 @@ def macs2json(macs, include = False, timestamp = False, plotAll = False):
 
   return out
 
+def row2json(row):
+  """
+    row2json
+
+    Description: Same shape as `Base.as_dict()` for a plain row dict
+    (ex: a write-behind row), times as naive UTC strings.
+
+    @param row - Dict
+    @return dict
+  """
+  out = {}
+
+  for key, value in row.items():
+    if isinstance(value, datetime) and value.tzinfo is not None:
+      value = value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    out[key] = str(value)
+
+  return out
+
 def macHasUUID(mac, uuid):
   """
     macHasUUID
@@ -242,6 +371,69 @@ def macHasUUID(mac, uuid):
 
   return False
 
+CURSOR_TABLES = ('presence', 'rssi', 'data')
+
+def currentCursor(session):
+  """
+    currentCursor
+
+    Description: Ingestion cursor, the highest committed presence,
+    rssi_summary and data ids. Rows are only ever committed in id order
+    (single write-behind flusher) so everything <= the cursor is visible.
+    An upserted rssi_summary/data row takes a new id (storage.nextId),
+    so updates count as new rows.
+
+    @param session - SQLAlchemy session
+    @return dict - table -> id
+  """
+  out = {}
+
+  for table, model in zip(CURSOR_TABLES, (Presence, RSSISummary, Data)):
+    out[table] = session.query(func.max(model.id)).scalar() or 0
+
+  return out
+
+def formatCursor(cursor):
+  """
+    formatCursor
+
+    Ex: { presence: 120, rssi: 53, data: 98 } -> 120-53-98
+  """
+  return '-'.join(str(cursor[table]) for table in CURSOR_TABLES)
+
+def parseCursor(value):
+  """
+    parseCursor
+
+    Ex: 120-53-98 -> { presence: 120, rssi: 53, data: 98 }
+
+    @raise ValueError on a malformed cursor
+  """
+  ids = [int(id) for id in value.split('-')]
+
+  if len(ids) != len(CURSOR_TABLES):
+    raise ValueError(f'Invalid cursor {value}')
+
+  return dict(zip(CURSOR_TABLES, ids))
+
+def changedMacIds(session, since, cursor):
+  """
+    changedMacIds
+
+    Description: Macs with ingestion between two cursors. Every
+    ingested event (new mac, name/data/uuid change, the first rssi of
+    each window) writes a presence row, so presence covers metadata
+    changes. rssi_summary and data cover the updates of their rows.
+
+    @return query - mac ids, usable in `Mac.id.in_()`
+  """
+  queries = [session.query(model.mac_id).filter(
+    model.id > since[table],
+    model.id <= cursor[table]
+  ) for table, model in zip(CURSOR_TABLES, (Presence, RSSISummary, Data))]
+
+  return queries[0].union(*queries[1:])
+
 def getQueryCount(query):
   """
     getQueryCount
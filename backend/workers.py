@@ -0,0 +1,121 @@
+import queue
+import logging
+import threading
+from zlib import crc32
+
+logger = logging.getLogger(__name__)
+
+STOP = object()
+
+class WorkerPool(object):
+  """
+    WorkerPool
+
+    Description: Runs ingestion events off the GLib main loop. Each
+    worker owns a bounded queue and events are routed by key (the
+    device address) so one device is always handled by the same
+    worker, in order. `submit` never blocks: when a queue is full the
+    event is dropped and counted.
+
+    @param target - Callable(*event) run on a worker thread
+    @param workers - Integer number of threads
+    @param maxQueue - Integer events queued per worker
+  """
+  def __init__(self, target, workers = 4, maxQueue = 10000):
+    self.target = target
+    self.queues = [queue.Queue(maxsize=maxQueue) for i in range(max(1, workers))]
+    self.threads = []
+    self.lock = threading.Lock()
+    self.running = False
+
+    self.submitted = 0
+    self.processed = 0
+    self.dropped = 0
+    self.errors = 0
+    self.maxDepth = 0
+
+  def submit(self, key, *event, block = False):
+    """
+      submit
+
+      @param key - String used to pick the worker
+      @param event - arguments for `target`
+      @param block - Bool wait for room instead of dropping (replay)
+      @return bool - False if the event was dropped
+    """
+    index = crc32(key.encode()) % len(self.queues) if key else 0
+
+    try:
+      self.queues[index].put(event, block=block)
+    except queue.Full:
+      with self.lock:
+        self.dropped += 1
+      return False
+
+    with self.lock:
+      self.submitted += 1
+      self.maxDepth = max(self.maxDepth, self.depth())
+
+    return True
+
+  def depth(self):
+    return sum(q.qsize() for q in self.queues)
+
+  def run(self, events):
+    while True:
+      event = events.get()
+
+      if event is STOP:
+        return
+
+      try:
+        self.target(*event)
+      except Exception as e:
+        logger.error(e)
+        with self.lock:
+          self.errors += 1
+      finally:
+        with self.lock:
+          self.processed += 1
+
+  def start(self):
+    if self.running:
+      return
+
+    self.running = True
+
+    for index, events in enumerate(self.queues):
+      thread = threading.Thread(target=self.run, args=(events,), name=f'ingest-{index}', daemon=True)
+      thread.start()
+      self.threads.append(thread)
+
+  def stop(self):
+    """
+      stop
+
+      Lets every worker drain its queue, then joins them
+    """
+    if not self.running:
+      return
+
+    self.running = False
+
+    for events in self.queues:
+      events.put(STOP)
+
+    for thread in self.threads:
+      thread.join()
+
+    self.threads = []
+
+  def stats(self):
+    with self.lock:
+      return {
+        'workers': len(self.queues),
+        'depth': self.depth(),
+        'maxDepth': self.maxDepth,
+        'submitted': self.submitted,
+        'processed': self.processed,
+        'dropped': self.dropped,
+        'errors': self.errors,
+      }
@@ -1,26 +1,157 @@
 import json
+import time
 import logging
 import threading
 from datetime import datetime
-from flask import Flask, request, render_template, abort, jsonify
-from sqlalchemy import tablesample, delete
+from flask import Flask, Response, request, render_template, abort, jsonify, g
+from sqlalchemy import delete
 from sqlalchemy.sql.expression import func
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm.session import sessionmaker
-from backend.bt import adapter, manager, loop
-from backend.util import macs2json, macToDBusPath, getDeviceForMac, macsAndPresence2json, getQueryCount, safeCommit
+from backend.util import macs2json, macsAndPresence2json, safeCommit, currentCursor, formatCursor, parseCursor, changedMacIds
+from backend.rollup import samplePresence, bucketStart
+from backend.columnar import macs2columnar, macsAndPresence2columnar, encode, FORMATS
 from backend.models import Mac, OUID, Data, RSSI, engine, Presence
-from gi.repository import GLib
+from backend.control import LocalController, RemoteController, ControlError
+from backend.config import LOG_LEVEL, CONTROL_SOCKET, RESPONSE_CACHE_BYTES, RESPONSE_TTL, RESPONSE_TIME_BUCKET
+from backend.metrics import registry, histogram, collected, CONTENT_TYPE
+from backend.responses import ResponseCache
 
-Session = sessionmaker(bind=engine)
-session = Session()
+# one session per request thread, handed back in `removeSession`
+session = scoped_session(sessionmaker(bind=engine))
 
-logging.basicConfig(format='%(asctime)s %(message)s', filename='log.txt', filemode='a', level=logging.DEBUG)
+logging.basicConfig(format='%(asctime)s %(message)s', filename='log.txt', filemode='a', level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__, template_folder='ui/templates', static_url_path='', static_folder='ui/templates')
 
-TRANSPORT = 'auto' # Default Transport upon boot Enum[bredr,auto,le]
+# adapter control and ingestion state. Served by a WSGI server (gunicorn
+# server:app) the API forwards them to the ingestion daemon, `python3
+# server.py` swaps in a LocalController and ingests in this process
+controller = RemoteController(CONTROL_SOCKET)
+
+requestSeconds = histogram('btdm_http_request_seconds', 'API request latency', ('route', 'method', 'status'))
+
+# `/api/query/sample` answers shared by every dashboard polling the same question
+responses = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_TTL)
+
+collected('btdm_response_cache_requests_total', 'Cacheable API requests by outcome (wait: joined a request already running the query)', 'counter', lambda: [
+  ((outcome,), responses.stats()[outcome + 's']) for outcome in ('hit', 'miss', 'wait')
+], ('outcome',))
+collected('btdm_response_cache_bytes', 'Response bodies held by the API response cache', 'gauge', lambda: [((), responses.size)])
+collected('btdm_response_cache_evictions_total', 'Responses evicted to stay under BTDM_RESPONSE_CACHE_BYTES', 'counter', lambda: [((), responses.evictions)])
+
+def cachedResponse(key, build):
+  """
+    cachedResponse
+
+    Serves `key` from `responses` while the ingestion generation is
+    unchanged, otherwise builds it once for every waiting request.
+
+    @param key - tuple of the normalized request
+    @param build - Callable returning a flask Response or (Response, status)
+    @return flask Response
+  """
+  try:
+    generation = controller.generation()
+  except ControlError as e:
+    # no daemon to tell the generation, answer uncached
+    logger.error(e)
+    return build()
+
+  def compute():
+    out = build()
+    response, status = out if isinstance(out, tuple) else (out, out.status_code)
+
+    # stored as raw parts, a flask Response is not shareable between requests
+    body = response.get_data()
+    value = (body, status, list(response.headers.items()))
+
+    return value, len(body), status == 200
+
+  body, status, headers = responses.get(key, generation, compute)
+
+  return Response(body, status=status, headers=headers)
+
+def invalidate():
+  """
+    invalidate
+
+    The API changed rows a cached response shows
+  """
+  responses.clear()
+
+  try:
+    controller.invalidate()
+  except ControlError as e:
+    logger.error(e)
+
+def topMacs(macs, count, dt):
+  """
+    topMacs
+
+    The `count` most seen macs, from the ingestion leaderboard when
+    it can answer, otherwise sorted by the database
+
+    @param macs - Query of Mac
+    @param count - Integer
+    @param dt - DateTime/False only macs seen since
+    @return Query of Mac
+  """
+  try:
+    ids = controller.top(count=count, since=dt or None)
+  except ControlError as e:
+    logger.error(e)
+    ids = None
+
+  if ids is None:
+    return macs.order_by(Mac.seen.desc()).limit(count)
+
+  return macs.filter(Mac.id.in_(ids)).order_by(Mac.seen.desc())
+
+def controlError(e):
+  """
+    controlError
+
+    @param e - ControlError
+    @return flask response tuple
+  """
+  out = { 'error': str(e) }
+
+  if e.data is not None:
+    out['job'] = e.data
+
+  return (jsonify(out), e.status)
+
+@app.teardown_appcontext
+def removeSession(exception = None):
+  session.remove()
+
+@app.before_request
+def startTimer():
+  g.started = time.perf_counter()
+
+@app.after_request
+def observeRequest(response):
+  # the url rule, not the path, so /api/query/<mac> is one series
+  route = request.url_rule.rule if request.url_rule else 'unmatched'
+  requestSeconds.observe(time.perf_counter() - g.get('started', time.perf_counter()), route, request.method, response.status_code)
+
+  return response
+
+@app.route('/api/metrics')
+def getMetrics():
+  try:
+    out = controller.metrics()
+  except ControlError as e:
+    logger.error(e)
+    out = ''
+
+  # API worker metrics live in this process, ingestion metrics in the daemon
+  if controller.remote:
+    out += registry.render()
+
+  return Response(out, content_type=CONTENT_TYPE)
 
 @app.route('/')
 def index():
@@ -28,13 +159,10 @@ def index():
 
 @app.route('/api/adapter')
 def getAdapter():
-  global TRANSPORT
-  out = {}
-
   try:
-    for key in adapter.get_cached_property_names():
-      out[key] = adapter.get_cached_property(key).unpack()
-    out['transport'] = TRANSPORT
+    out = controller.adapter(name=request.args.get('adapter'))
+  except ControlError as e:
+    return controlError(e)
   except Exception as e:
     logger.error(e)
     return (jsonify({
@@ -43,14 +171,27 @@ def getAdapter():
 
   return jsonify(out)
 
+@app.route('/api/adapters')
+def getAdapters():
+  try:
+    return jsonify(controller.adapters())
+  except ControlError as e:
+    return controlError(e)
+  except Exception as e:
+    logger.error(e)
+    return (jsonify({
+      'error': str(e)
+    }), 500)
+
 @app.route('/api/adapter/scan/on')
 def scanOn():
   try:
-    logger.info('Starting Discovery')
-    adapter.StartDiscovery()
     return jsonify({
-      'success': True
+      'success': True,
+      'adapters': controller.scan(on=True, name=request.args.get('adapter'))
     })
+  except ControlError as e:
+    return controlError(e)
   except Exception as e:
     logger.error(e)
     return (jsonify({
@@ -60,11 +201,12 @@ def scanOn():
 @app.route('/api/adapter/scan/off')
 def scanOff():
   try:
-    logger.info('Stopping Discovery')
-    adapter.StopDiscovery()
     return jsonify({
-      'success': True
+      'success': True,
+      'adapters': controller.scan(on=False, name=request.args.get('adapter'))
     })
+  except ControlError as e:
+    return controlError(e)
   except Exception as e:
     logger.error(e)
     return (jsonify({
@@ -73,12 +215,13 @@ def scanOff():
 
 @app.route('/api/adapter/transport', methods=['GET', 'POST'])
 def getSetTransport():
-  global TRANSPORT
-
   if request.method == 'GET':
-    return (jsonify({
-      'transport': TRANSPORT
-    }))
+    try:
+      return (jsonify({
+        'transport': controller.transport(name=request.args.get('adapter'))
+      }))
+    except ControlError as e:
+      return controlError(e)
   elif request.method == 'POST':
     try:
       transport = request.json['transport']
@@ -88,14 +231,15 @@ def getSetTransport():
           'error': 'Invalid Transport: bredr, auto, le'
         }), 400)
 
-      adapter.SetDiscoveryFilter('(a{sv})', { 'Transport': GLib.Variant('s', transport) })
-
-      TRANSPORT = transport
+      names = controller.setTransport(transport=transport, name=request.json.get('adapter') or request.args.get('adapter'))
 
       return jsonify({
         'success': True,
-        'transport': TRANSPORT
+        'transport': transport,
+        'adapters': names
       })
+    except ControlError as e:
+      return controlError(e)
     except Exception as e:
       logger.error(e)
       return (jsonify({
@@ -107,6 +251,40 @@ def getSetTransport():
       'error': 'Invalid HTTP Method'
     }), 400)
 
+@app.route('/api/ingest')
+def getIngest():
+  try:
+    return jsonify(controller.ingest())
+  except ControlError as e:
+    return controlError(e)
+
+@app.route('/api/stream')
+def stream():
+  try:
+    messages = controller.stream()
+  except ControlError as e:
+    return controlError(e)
+
+  return Response(messages, mimetype='text/event-stream', headers={
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+  })
+
+@app.route('/api/lookup/reload', methods=['POST'])
+def reloadLookups():
+  try:
+    out = controller.reloadLookups()
+    out['success'] = True
+
+    return jsonify(out)
+  except ControlError as e:
+    return controlError(e)
+  except Exception as e:
+    logger.error(e)
+    return (jsonify({
+      'error': str(e)
+    }), 500)
+
 @app.route('/api/query/<mac>', methods=['GET', 'DELETE'])
 def queryMac(mac = False):
   macFilterQuery = Mac.addr == mac.upper() if mac else None
@@ -124,18 +302,15 @@ def queryMac(mac = False):
     }), 400)
 
   if request.method == 'GET':
-    objects = manager.GetManagedObjects();
     out = macs2json([mac], 'rssi,data')
 
-    if macToDBusPath(mac.addr) in objects:
-      try:
-        device = getDeviceForMac(mac.addr)
-        out[0]['deviceData'] = {}
+    try:
+      device = controller.device(addr=mac.addr)
 
-        for key in device.get_cached_property_names():
-          out[0]['deviceData'][key] = device.get_cached_property(key).unpack()
-      except Exception as e:
-        logger.error(e)
+      if device:
+        out[0].update(device)
+    except Exception as e:
+      logger.error(e)
 
     return jsonify(out)
   elif request.method == 'DELETE':
@@ -144,7 +319,8 @@ def queryMac(mac = False):
       session.commit()
 
       try:
-        adapter.RemoveDevice('(o)', macToDBusPath(mac.addr))
+        # drops its ingestion state and removes it from every adapter
+        controller.forget(macs=[(mac.id, mac.addr)])
       except Exception as e:
         logger.error(e)
         pass
@@ -173,6 +349,7 @@ def tag(mac = False):
         mac = session.query(Mac).filter(Mac.addr == mac).first()
         mac.tag = tag
         session.commit()
+        invalidate()
 
         return jsonify({
           'success': True,
@@ -192,6 +369,7 @@ def tag(mac = False):
     mac = session.query(Mac).filter(Mac.addr == mac).first()
     mac.tag = None
     session.commit()
+    invalidate()
 
     return jsonify({
       'success': True,
@@ -204,19 +382,13 @@ def tag(mac = False):
 @app.route('/api/<mac>/connect', methods=['GET'])
 def connectMac(mac = False):
   try:
-    objects = manager.GetManagedObjects();
-
-    if macToDBusPath(mac) in objects:
-      device = getDeviceForMac(mac)
-      device.Connect()
+    controller.connect(addr=mac)
 
-      return (jsonify({
-        'success': True
-      }))
-    else:
-      return (jsonify({
-        'error': 'MAC is not in range'
-      }), 400)
+    return (jsonify({
+      'success': True
+    }))
+  except ControlError as e:
+    return controlError(e)
   except Exception as e:
     logger.error(e)
     return (jsonify({
@@ -226,19 +398,13 @@ def connectMac(mac = False):
 @app.route('/api/<mac>/disconnect', methods=['GET'])
 def disconnectMac(mac = False):
   try:
-    objects = manager.GetManagedObjects();
-
-    if macToDBusPath(mac) in objects:
-      device = getDeviceForMac(mac)
-      device.Disconnect()
+    controller.disconnect(addr=mac)
 
-      return (jsonify({
-        'success': True
-      }))
-    else:
-      return (jsonify({
-        'error': 'MAC is not in range'
-      }), 400)
+    return (jsonify({
+      'success': True
+    }))
+  except ControlError as e:
+    return controlError(e)
   except Exception as e:
     logger.error(e)
     return (jsonify({
@@ -251,6 +417,8 @@ def query():
   count = request.args.get('count', False, int)
   include = request.args.get('include', False, str)
   plotAll = request.args.get('all', False, bool)
+  sinceCursor = request.args.get('since', '')
+  fmt = request.args.get('format', 'json', str)
 
   try:
     dt = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ') if timestamp else False
@@ -259,6 +427,18 @@ def query():
       'error': 'Invalid time. Use Date.toJSON() or "%Y-%m-%dT%H:%M:%S.%fZ"'
     }), 400)
 
+  if fmt not in FORMATS:
+    return (jsonify({
+      'error': f'Invalid format: {", ".join(FORMATS)}'
+    }), 400)
+
+  try:
+    since = parseCursor(sinceCursor) if sinceCursor else None
+  except:
+    return (jsonify({
+      'error': 'Invalid since. Use the X-Cursor header of a previous response'
+    }), 400)
+
   timeFilterQuery = Mac.last_seen > dt if timestamp else None
 
   if timeFilterQuery is not None:
@@ -266,45 +446,46 @@ def query():
   else:
     macs = session.query(Mac)
 
+  if request.method == 'GET':
+    # taken before reading rows so nothing committed meanwhile is skipped
+    cursor = currentCursor(session)
+
+    if since:
+      macs = macs.filter(Mac.id.in_(changedMacIds(session, since, cursor)))
+
   if count and isinstance(count, int):
     if request.method == 'DELETE':
       return (jsonify({
         'error': 'Cannot use count with DELETE'
       }))
 
-    macs = macs.order_by(Mac.seen.desc()).limit(count)
+    # top n of the changed macs is a database question
+    macs = macs.order_by(Mac.seen.desc()).limit(count) if since else topMacs(macs, count, dt)
 
   if request.method == 'GET':
-    return jsonify(macs2json(macs.all(), include, dt, plotAll))
-  elif request.method == 'DELETE':
-    try:
-      session.execute("DELETE from rssi");
-      logger.info("rssi delete done")
-      session.execute("DELETE from uuid")
-      logger.info("uuid delete done")
-      session.execute("DELETE from presence")
-      logger.info("presence delete done")
-      session.execute("DELETE from data")
-      logger.info("data delete done")
-      session.execute("DELETE from mac")
-      logger.info("mac delete done")
-      safeCommit(session)
-
+    if fmt == 'json':
+      response = jsonify(macs2json(macs.all(), include, dt, plotAll, since, cursor))
+    else:
       try:
-        objects = manager.GetManagedObjects();
+        response = encode(macs2columnar(macs.all(), include, dt, plotAll, since, cursor), fmt, request.headers.get('Accept-Encoding'))
+      except ValueError as e:
+        return (jsonify({
+          'error': str(e)
+        }), 400)
 
-        for path in objects:
-          if 'dev' in path:
-            adapter.RemoveDevice('(o)', path)
-      except Exception as e:
-        logger.error(e)
-        pass
+    response.headers['X-Cursor'] = formatCursor(cursor)
 
-      return jsonify({
-        'success': True
-      })
+    return response
+  elif request.method == 'DELETE':
+    try:
+      # with a time the rows are removed by the job in bounded batches
+      return (jsonify({
+        'success': True,
+        'job': controller.reset(timestamp=dt or None)
+      }), 202)
+    except ControlError as e:
+      return controlError(e)
     except Exception as e:
-      session.rollback()
       logger.error(e)
       return (jsonify({
         'error': str(e)
@@ -314,6 +495,13 @@ def query():
       'error': 'Invalid HTTP Method'
     }), 400)
 
+@app.route('/api/query/reset', methods=['GET'])
+def queryReset():
+  try:
+    return jsonify(controller.resetProgress())
+  except ControlError as e:
+    return controlError(e)
+
 @app.route('/api/query/sample', methods=['GET'])
 def querySample():
   timestamp = request.args.get('time', '')
@@ -321,7 +509,8 @@ def querySample():
   count = request.args.get('count', False, int)
   include = request.args.get('include', False, str)
   plotAll = request.args.get('all', False, bool)
-  sampleSize = 35
+  sinceCursor = request.args.get('since', '')
+  fmt = request.args.get('format', 'json', str)
 
   try:
     dt = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ') if timestamp else False
@@ -330,8 +519,42 @@ def querySample():
       'error': 'Invalid time. Use Dat.toJSON() or "%Y-%m-%dT%H:%M:%S.%fZ"'
     }), 400)
 
-  macTimeFilterQuery = Mac.last_seen > dt if timestamp else None
-  presenceTimeFilterQuery = Presence.time > dt if timestamp else None
+  if fmt not in FORMATS:
+    return (jsonify({
+      'error': f'Invalid format: {", ".join(FORMATS)}'
+    }), 400)
+
+  try:
+    since = parseCursor(sinceCursor) if sinceCursor else None
+  except:
+    return (jsonify({
+      'error': 'Invalid since. Use the X-Cursor header of a previous response'
+    }), 400)
+
+  # delta polls are per client, only full answers are shared
+  if since or not RESPONSE_TTL:
+    return sampleResponse(dt, maxTarget, count, plotAll, since, fmt)
+
+  if dt:
+    # every dashboard asking for "the last N minutes" lands in the same bucket
+    dt = bucketStart(dt, RESPONSE_TIME_BUCKET)
+
+  gzipped = 'gzip' in (request.headers.get('Accept-Encoding') or '')
+  key = ('sample', dt, maxTarget, count, bool(plotAll), fmt, gzipped)
+
+  return cachedResponse(key, lambda: sampleResponse(dt, maxTarget, count, plotAll, since, fmt))
+
+def sampleResponse(dt, maxTarget, count, plotAll, since, fmt):
+  """
+    sampleResponse
+
+    Body of `/api/query/sample` once its parameters are validated
+
+    @return flask Response or (Response, status)
+  """
+  # taken before reading rows so nothing committed meanwhile is skipped
+  cursor = currentCursor(session)
+  macTimeFilterQuery = Mac.last_seen > dt if dt else None
 
   if macTimeFilterQuery is not None:
     macs = session.query(Mac).filter(macTimeFilterQuery)
@@ -339,56 +562,57 @@ def querySample():
     macs = session.query(Mac)
 
   if count and isinstance(count, int):
-    macs = macs.order_by(Mac.seen.desc()).limit(count)
+    macs = topMacs(macs, count, dt)
 
   allMacs = macs.all()
   allIds = [m.id for m in allMacs]
 
-  if presenceTimeFilterQuery is not None and not plotAll:
-    countQuery = session.query(func.count(Presence.id)).filter(Presence.mac_id.in_(allIds), presenceTimeFilterQuery)
-    count = getQueryCount(countQuery)
-
-    if count > maxTarget:
-      percent = (maxTarget / count) * 100
-      sampleSize = percent
-    else:
-      sampleSize = 100
+  if since:
+    changed = set(mac_id for mac_id, in changedMacIds(session, since, cursor))
+    allMacs = [m for m in allMacs if m.id in changed]
+    allIds = [m.id for m in allMacs]
+
+    resolution = 0
+    presences = session.query(Presence).filter(
+      Presence.mac_id.in_(allIds),
+      Presence.id > since['presence'],
+      Presence.id <= cursor['presence']
+    ).order_by(Presence.id.desc()).limit(maxTarget).all()
+  else:
+    after = dt if dt and not plotAll else False
+    resolution, presences = samplePresence(session, allIds, after, maxTarget)
 
-    presenceSampled = aliased(Presence, tablesample(Presence, sampleSize))
-    presenceSampleTimeFilterQuery = presenceSampled.time > dt if timestamp else None
+  logger.info(f'Presence Resolution: {resolution}s  Macs: {len(allMacs)}   Sampled Presences: {len(presences)}')
 
-    presences = session.query(presenceSampled).filter(presenceSampled.mac_id.in_(allIds), presenceSampleTimeFilterQuery).order_by(func.random()).all()
+  if fmt == 'json':
+    response = jsonify(macsAndPresence2json(allMacs, presences))
   else:
-    countQuery = session.query(func.count(Presence.id)).filter(Presence.mac_id.in_(allIds))
-    count = getQueryCount(countQuery)
+    try:
+      response = encode(macsAndPresence2columnar(allMacs, presences), fmt, request.headers.get('Accept-Encoding'))
+    except ValueError as e:
+      return (jsonify({
+        'error': str(e)
+      }), 400)
 
-    if count > maxTarget:
-      percent = (maxTarget / count) * 100
-      sampleSize = percent
-    else:
-      sampleSize = 100
+  response.headers['X-Cursor'] = formatCursor(cursor)
 
-    presenceSampled = aliased(Presence, tablesample(Presence, sampleSize))
-    presences = session.query(presenceSampled).order_by(func.random()).filter(presenceSampled.mac_id.in_(allIds)).all()
+  return response
 
-  logger.info(f'Presence Sample Size: {sampleSize}  Macs: {len(allMacs)}   Sampled Presences: {len(presences)}')
+if __name__ == '__main__':
+  # ingestion and the API in one process, see backend/daemon.py to split them
+  from backend.bt import loop, start, shutdown
 
-  if request.method == 'GET':
-    return jsonify(macsAndPresence2json(allMacs, presences))
-  else:
-    return (jsonify({
-      'error': 'Invalid HTTP Method'
-    }), 400)
+  start()
+  controller = LocalController()
 
-if __name__ == '__main__':
   logger.info('Starting flask')
   threading.Thread(target=lambda: app.run(host='0.0.0.0', port=1338, debug=False, use_reloader=False)).start()
 
-  try:
-    logger.info('Starting Discovery')
-    adapter.StartDiscovery()
-  except Exception as e:
-    logger.error(e)
+  controller.startDiscovery()
 
   logger.info('Starting GLib.MainLoop()')
-  loop.run()
+
+  try:
+    loop.run()
+  finally:
+    shutdown()
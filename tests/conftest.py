@@ -0,0 +1,68 @@
+"""
+  Test fixtures
+
+  The backend builds its engine from BTDM_DATABASE at import, so it is
+  set before anything from `backend` is imported. A scratch SQLite file
+  unless BTDM_DATABASE already points at a (throwaway) database.
+
+    python3 -m pytest -q
+    BTDM_DATABASE=postgresql:///blt_test python3 -m pytest -q
+"""
+import os
+import tempfile
+
+os.environ.setdefault('BTDM_DATABASE', 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='btdm-'), 'test.db'))
+
+import pytest
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from backend.models import Base, Mac, engine
+from backend.storage import isSQLite
+from backend.migrations import migrate
+from backend.partitions import prepare
+
+@pytest.fixture
+def db():
+  """
+    db
+
+    Empty, fully migrated database
+
+    @return engine - SQLAlchemy Engine
+  """
+  if isSQLite(engine):
+    Base.metadata.drop_all(engine)
+  else:
+    with engine.begin() as conn:
+      conn.execute(text('DROP SCHEMA public CASCADE'))
+      conn.execute(text('CREATE SCHEMA public'))
+
+  migrate(engine)
+  prepare(engine)
+
+  return engine
+
+@pytest.fixture
+def session(db):
+  # no refresh after commit: an idle open transaction would block TRUNCATE/DROP on postgres
+  session = sessionmaker(bind=db, expire_on_commit=False)()
+
+  yield session
+
+  session.close()
+
+def addMac(session, addr, seen = 1, when = None):
+  """
+    addMac
+
+    @return Mac
+  """
+  mac = Mac(addr, addr.replace(':', '-'), None)
+  mac.seen = seen
+  mac.first_seen = mac.last_seen = when or datetime.utcnow()
+  session.add(mac)
+  session.commit()
+
+  return mac
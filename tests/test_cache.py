@@ -0,0 +1,106 @@
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from backend.cache import DeviceCache
+from backend.gatt import GattBatches
+from backend.ingest import IngestBuffer
+from backend.models import Mac, UUID
+
+from conftest import addMac
+
+def wire(db, maxSize = 1):
+  """
+    wire
+
+    IngestBuffer, DeviceCache and GattBatches hooked up like backend/bt.py
+  """
+  buffer = IngestBuffer(db)
+  devices = DeviceCache(maxSize)
+  gatt = GattBatches(idle=0)
+  buffer.register(devices.collect)
+  buffer.register(gatt.collect)
+  devices.register(lambda mac_id: [row['uuid'] for row in buffer.queued(UUID) if row['mac_id'] == mac_id])
+  devices.register(gatt.queued)
+  buffer.listen(devices.flushed)
+  buffer.listen(gatt.flushed)
+
+  return buffer, devices, gatt
+
+def addUUID(buffer, state, uuid):
+  state.uuids.add(uuid)
+  buffer.add(UUID, mac_id=state.id, lookup_id=None, uuid=uuid, type='primary', flags='', value='')
+
+def test_reloaded_state_knows_queued_uuids(db, session):
+  a, b = addMac(session, 'AA:00:00:00:01:01'), addMac(session, 'AA:00:00:00:01:02')
+  buffer, devices, gatt = wire(db)
+
+  state = devices.fetch(session, a.addr)
+  addUUID(buffer, state, '180F')
+  gatt.add(a.id, None, '2A19', 'characteristic', 'read', '', datetime.utcnow())
+
+  # a is evicted clean (no counters changed) with its uuids still queued
+  devices.fetch(session, b.addr)
+  assert devices.get(a.addr) is None
+
+  state = devices.fetch(session, a.addr)
+  assert state.uuids == {'180F', '2A19'}
+
+def test_reloaded_state_knows_uuids_of_the_running_flush(db, session):
+  a, b = addMac(session, 'AA:00:00:00:01:03'), addMac(session, 'AA:00:00:00:01:04')
+  buffer, devices, gatt = wire(db)
+  reloaded = []
+
+  state = devices.fetch(session, a.addr)
+  addUUID(buffer, state, '180F')
+  devices.fetch(session, b.addr)
+
+  # runs after the pending rows were swapped out, before they are committed
+  def reload():
+    other = sessionmaker(bind=db)()
+    reloaded.append(devices.fetch(other, a.addr).uuids)
+    other.close()
+    return []
+
+  buffer.register(reload)
+  buffer.flush()
+
+  assert reloaded == [{'180F'}]
+
+def test_evicted_dirty_state_is_pinned_until_flushed(db, session):
+  a, b = addMac(session, 'AA:00:00:00:01:05', seen=5), addMac(session, 'AA:00:00:00:01:06')
+  buffer, devices, gatt = wire(db)
+
+  state = devices.fetch(session, a.addr)
+  devices.touch(state, datetime.utcnow())
+  devices.fetch(session, b.addr)
+
+  # the unwritten sighting is not lost to a stale read
+  assert devices.fetch(session, a.addr) is state
+  assert state.seen == 6
+
+  devices.fetch(session, b.addr)
+  buffer.flush()
+  assert devices.evicted == {}
+
+  with db.begin() as conn:
+    assert conn.execute(select([Mac.seen]).where(Mac.id == a.id)).scalar() == 6
+
+  assert devices.fetch(session, a.addr).seen == 6
+
+def test_queued_uuids_are_written_once(db, session):
+  a, b = addMac(session, 'AA:00:00:00:01:07'), addMac(session, 'AA:00:00:00:01:08')
+  buffer, devices, gatt = wire(db)
+
+  for i in range(3):
+    state = devices.fetch(session, a.addr)
+
+    if '180F' not in state.uuids:
+      addUUID(buffer, state, '180F')
+
+    devices.fetch(session, b.addr)
+
+  buffer.flush()
+
+  with db.begin() as conn:
+    assert conn.execute(select([UUID.uuid]).where(UUID.mac_id == a.id)).fetchall() == [('180F',)]
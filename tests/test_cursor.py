@@ -0,0 +1,101 @@
+from datetime import datetime
+
+from backend.ingest import IngestBuffer
+from backend.models import Presence, Data
+from backend.payload import PayloadStore
+from backend.reset import truncate
+from backend.rssi import RSSIAggregator, rssiByMac
+from backend.util import currentCursor, changedMacIds, rowsByMac
+
+from conftest import addMac
+
+WHEN = datetime(2024, 1, 1, 12, 0, 1)
+
+def changed(session, since, cursor):
+  return sorted(mac_id for mac_id, in changedMacIds(session, since, cursor))
+
+def idRange(since, cursor, table):
+  return (since[table], cursor[table])
+
+def test_presence_after_the_cursor(db, session):
+  a, b = addMac(session, 'AA:00:00:00:04:01'), addMac(session, 'AA:00:00:00:04:02')
+  buffer = IngestBuffer(db)
+
+  buffer.add(Presence, mac_id=a.id, type='seen')
+  buffer.add(Presence, mac_id=b.id, type='seen')
+  buffer.flush()
+  since = currentCursor(session)
+
+  buffer.add(Presence, mac_id=b.id, type='rssi')
+  buffer.flush()
+  cursor = currentCursor(session)
+
+  assert cursor['presence'] > since['presence']
+  assert changed(session, since, cursor) == [b.id]
+
+  rows = rowsByMac(session, Presence, [a.id, b.id], idRange=idRange(since, cursor, 'presence'))
+  assert [row['type'] for row in rows[b.id]] == ['rssi']
+  assert rows[a.id] == []
+
+def test_updated_rssi_summary_is_in_the_delta(db, session):
+  a, b = addMac(session, 'AA:00:00:00:04:03'), addMac(session, 'AA:00:00:00:04:04')
+  buffer = IngestBuffer(db)
+  rssis = RSSIAggregator(window=10, ring=8)
+  buffer.register(rssis.collect)
+
+  rssis.add(a.id, -60, WHEN)
+  rssis.add(b.id, -60, WHEN)
+  buffer.flush()
+  since = currentCursor(session)
+
+  # same window: the stored summary is updated, not inserted
+  rssis.add(a.id, -40, WHEN.replace(second=2))
+  buffer.flush()
+  cursor = currentCursor(session)
+
+  assert changed(session, since, cursor) == [a.id]
+
+  rows = rssiByMac(session, [a.id, b.id], idRange=idRange(since, cursor, 'rssi'))
+  assert [(row['count'], row['max'], row['last']) for row in rows[a.id]] == [(2, -40, -40)]
+  assert rows[b.id] == []
+
+  # a later cursor sees nothing new
+  assert changed(session, cursor, currentCursor(session)) == []
+
+def test_updated_data_is_in_the_delta(db, session):
+  mac = addMac(session, 'AA:00:00:00:04:05')
+  buffer = IngestBuffer(db)
+  payloads = PayloadStore()
+  buffer.register(payloads.collect)
+
+  payloads.add(mac.id, '004c', b'\x01\x02', WHEN)
+  buffer.flush()
+  since = currentCursor(session)
+
+  payloads.add(mac.id, '004c', b'\x01\x02', WHEN.replace(second=30))
+  buffer.flush()
+  cursor = currentCursor(session)
+
+  assert changed(session, since, cursor) == [mac.id]
+
+  rows = rowsByMac(session, Data, [mac.id], idRange=idRange(since, cursor, 'data'))
+  assert [(row['key'], row['value'], row['count']) for row in rows[mac.id]] == [('004c', '1 2', '2')]
+
+def test_rekeyed_ids_stay_ahead_of_a_reset(db, session):
+  mac = addMac(session, 'AA:00:00:00:04:06')
+  buffer = IngestBuffer(db)
+  rssis = RSSIAggregator(window=10, ring=8)
+  buffer.register(rssis.collect)
+
+  rssis.add(mac.id, -60, WHEN)
+  buffer.flush()
+  rssis.add(mac.id, -50, WHEN.replace(second=2))
+  buffer.flush()
+  since = currentCursor(session)
+
+  truncate(db)
+  mac = addMac(session, 'AA:00:00:00:04:07')
+  rssis.add(mac.id, -70, WHEN)
+  buffer.flush()
+
+  assert currentCursor(session)['rssi'] > since['rssi']
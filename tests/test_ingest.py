@@ -0,0 +1,96 @@
+from datetime import datetime
+from sqlalchemy import select, func
+
+from backend.ingest import IngestBuffer
+from backend.models import Presence, RSSISummary
+from backend.rssi import RSSIAggregator
+
+from conftest import addMac
+
+def count(engine, model):
+  with engine.begin() as conn:
+    return conn.execute(select([func.count()]).select_from(model.__table__)).scalar()
+
+def test_flush_writes_pending_rows_and_notifies_listeners(db, session):
+  mac = addMac(session, 'AA:00:00:00:00:01')
+  buffer = IngestBuffer(db)
+  committed = []
+  buffer.listen(committed.append)
+
+  for type in ('seen', 'rssi', 'name'):
+    buffer.add(Presence, mac_id=mac.id, type=type, adapter='hci0')
+
+  assert buffer.size == 3
+  assert buffer.flush() == 3
+  assert buffer.size == 0
+  assert count(db, Presence) == 3
+
+  rows = committed[0][Presence.__table__]
+  assert [row['type'] for row in rows] == ['seen', 'rssi', 'name']
+
+  # nothing pending, nothing written, listeners not called
+  assert buffer.flush() == 0
+  assert len(committed) == 1
+
+def test_collectors_run_in_the_flush(db, session):
+  mac = addMac(session, 'AA:00:00:00:00:02')
+  buffer = IngestBuffer(db)
+  rssis = RSSIAggregator(window=10, ring=8)
+  buffer.register(rssis.collect)
+
+  when = datetime(2024, 1, 1, 12, 0, 1)
+
+  for mac_id in (mac.id,):
+    for i, rssi in enumerate((-60, -70, -50)):
+      rssis.add(mac_id, rssi, when.replace(second=1 + i))
+
+  buffer.flush()
+
+  with db.begin() as conn:
+    row = conn.execute(select([RSSISummary.__table__])).one()
+
+  assert (row.count, row.min, row.max, row.last) == (3, -70, -50, -50)
+  assert buffer.stats['updates'] == 1
+
+def test_updates_count_every_bound_row(db, session):
+  macs = [addMac(session, f'AA:00:00:00:01:0{i}') for i in range(4)]
+  buffer = IngestBuffer(db)
+  rssis = RSSIAggregator(window=10, ring=8)
+  buffer.register(rssis.collect)
+
+  when = datetime(2024, 1, 1, 12, 0, 1)
+
+  for mac in macs:
+    rssis.add(mac.id, -60, when)
+
+  buffer.flush()
+
+  # one upsert statement, four rows: on postgres too, where it is a multi-row VALUES
+  assert buffer.stats['updates'] == 4
+  assert count(db, RSSISummary) == 4
+
+def test_rejected_batch_falls_back_to_row_by_row(db, session):
+  mac = addMac(session, 'AA:00:00:00:00:03')
+  buffer = IngestBuffer(db)
+  committed = []
+  buffer.listen(committed.append)
+
+  buffer.add(Presence, mac_id=mac.id, type='seen')
+  # the mac was deleted while its row was pending
+  buffer.add(Presence, mac_id=mac.id + 1000, type='seen')
+
+  buffer.flush()
+
+  assert buffer.stats['errors'] == 1
+  assert count(db, Presence) == 1
+  assert len(committed[0][Presence.__table__]) == 1
+
+def test_clear_drops_pending_rows(db, session):
+  mac = addMac(session, 'AA:00:00:00:00:04')
+  buffer = IngestBuffer(db)
+
+  buffer.add(Presence, mac_id=mac.id, type='seen')
+
+  assert buffer.clear() == 1
+  assert buffer.flush() == 0
+  assert count(db, Presence) == 0
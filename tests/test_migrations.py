@@ -0,0 +1,43 @@
+import pytest
+from sqlalchemy import select, text
+
+from backend.models import Presence
+from backend.migrations import MIGRATIONS, migrate
+from backend.storage import isSQLite
+
+from conftest import addMac
+
+def test_sqlite_cursor_tables_are_rebuilt_with_autoincrement(db, session):
+  if not isSQLite(db):
+    pytest.skip('sqlite only')
+
+  mac = addMac(session, 'AA:00:00:00:03:01')
+
+  # presence as created before migration 7, with the column migration 5 added
+  with db.begin() as conn:
+    conn.execute(text('DROP TABLE presence'))
+    conn.execute(text(
+      'CREATE TABLE presence (id INTEGER NOT NULL, mac_id INTEGER, type VARCHAR, time DATETIME, '
+      'PRIMARY KEY (id), FOREIGN KEY(mac_id) REFERENCES mac (id))'
+    ))
+    conn.execute(text('ALTER TABLE presence ADD COLUMN adapter varchar'))
+    conn.execute(text('CREATE INDEX ix_presence_mac_time ON presence (mac_id, time DESC)'))
+    conn.execute(text("INSERT INTO presence (id, mac_id, type, adapter) VALUES (1, :id, 'seen', 'hci0'), (5, :id, 'rssi', NULL)"), { 'id': mac.id })
+    conn.execute(text('DELETE FROM schema_version WHERE version >= 7'))
+
+  assert migrate(db) == [version for version, name, migration in MIGRATIONS if version >= 7]
+
+  with db.begin() as conn:
+    sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'presence'")).scalar()
+    indexes = [name for name, in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'presence'"))]
+    rows = conn.execute(select([Presence.id, Presence.type, Presence.adapter]).order_by(Presence.id)).fetchall()
+
+    conn.execute(Presence.__table__.delete())
+    conn.execute(Presence.__table__.insert(), [{ 'mac_id': mac.id, 'type': 'seen' }])
+    id = conn.execute(select([Presence.id])).scalar()
+
+  assert 'AUTOINCREMENT' in sql
+  assert 'ix_presence_mac_time' in indexes
+  assert rows == [(1, 'seen', 'hci0'), (5, 'rssi', None)]
+  assert id == 6
+  assert migrate(db) == []
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, func
+
+from backend.models import Mac, Presence, RSSISummary, Data
+from backend.reset import truncate, deleteSince
+
+from conftest import addMac
+
+CURSOR_MODELS = (Presence, RSSISummary, Data)
+
+def addRows(db, mac_id, when):
+  with db.begin() as conn:
+    conn.execute(Presence.__table__.insert(), [{ 'mac_id': mac_id, 'type': 'seen', 'time': when }])
+    conn.execute(RSSISummary.__table__.insert(), [{ 'mac_id': mac_id, 'time': when, 'count': 1 }])
+    conn.execute(Data.__table__.insert(), [{ 'mac_id': mac_id, 'day': when.date(), 'time': when, 'key': 'ManufacturerData', 'value': '1 2' }])
+
+def maxIds(db):
+  with db.begin() as conn:
+    return [conn.execute(select([func.max(model.id)])).scalar() for model in CURSOR_MODELS]
+
+def test_truncate_does_not_reuse_cursor_ids(db, session):
+  when = datetime.utcnow()
+  addRows(db, addMac(session, 'AA:00:00:00:02:01').id, when)
+  before = maxIds(db)
+
+  truncate(db)
+
+  assert maxIds(db) == [None, None, None]
+
+  addRows(db, addMac(session, 'AA:00:00:00:02:02').id, when)
+
+  # a cursor handed out before the reset still sees the new rows
+  assert all(after > id for after, id in zip(maxIds(db), before))
+
+def test_delete_since_removes_recent_macs_and_their_rows(db, session):
+  now = datetime.utcnow()
+  old = addMac(session, 'AA:00:00:00:02:03', when=now - timedelta(hours=2))
+  new = [addMac(session, f'AA:00:00:00:02:1{i}', when=now) for i in range(3)]
+
+  for mac in [old] + new:
+    addRows(db, mac.id, now)
+
+  batches = list(deleteSince(db, now - timedelta(hours=1), batchSize=2))
+
+  assert [len(batch) for batch in batches] == [2, 1]
+  assert sorted(addr for batch in batches for id, addr in batch) == [mac.addr for mac in new]
+
+  with db.begin() as conn:
+    assert conn.execute(select([Mac.id])).fetchall() == [(old.id,)]
+
+    for model in CURSOR_MODELS:
+      assert conn.execute(select([model.mac_id])).fetchall() == [(old.id,)]
@@ -16,7 +16,7 @@ export const DataList = ({
       <div style={{ maxHeight: 300, overflowY: 'scroll' }}>
         <Typography variant='body'>
           {data.map((d) => (
-            <React.Fragment key={d.id}>
+            <React.Fragment key={`${d.time}-${d.key}`}>
               {parseDate(d.time).toLocaleString()} {d.key}:{d.value}
               <br/>
             </React.Fragment>
@@ -19,9 +19,9 @@ export const RSSIGraph = ({
   rssi
 }) => {
   
-  const data = rssi.sort((f, l) => {
-    return f.id - l.id
-  }).map((r) => ({
+  const data = [...rssi].sort((f, l) => (
+    parseDate(f.time) - parseDate(l.time)
+  )).map((r) => ({
     x: parseDate(r.time),
     y: (r.rssi * (-1))
   }));
@@ -17,11 +17,16 @@ import { Header } from './components/header';
 import { Graph } from './components/graphs';
 import { 
   uuidFilter,
-  parseDate
+  parseDate,
+  mergeRows,
+  mergeMacs
 } from '../common/util';
 
 import './main.scss';
 
+// full reloads resync every minute, in between the stream or `since` deltas are merged
+const RESYNC_INTERVAL = 60000;
+
 export const ColorModeContext = React.createContext({ toggleColorMode: () => {} });
 
 export const Index = () => {
@@ -50,8 +55,14 @@ export const Index = () => {
     },
   }), []);
 
-  const fetchData = (timeframe) => {
+  const fetchData = (timeframe, delta = false) => {
     window.loading = true;
+    delta = delta && window.cursor;
+
+    if (!delta) {
+      window.lastFetch = Date.now();
+    }
+
     setLoading(true);
     const params = new URLSearchParams();
 
@@ -69,9 +80,13 @@ export const Index = () => {
       params.append('all', true);
     }
 
-    let route = `/api/query/sample?${params.toString()}`;
+    setLastQuery(new URLSearchParams(params));
 
-    setLastQuery(params);
+    if (delta) {
+      params.append('since', window.cursor);
+    }
+
+    let route = `/api/query/sample?${params.toString()}`;
 
     const promise = axios.get(route, {
       signal: window.controller.signal
@@ -82,7 +97,11 @@ export const Index = () => {
         return;
       }
       
-      if (res.data) {  
+      window.cursor = res.headers['x-cursor'];
+
+      if (res.data && delta) {
+        setData((macs) => mergeMacs(macs, res.data));
+      } else if (res.data) {
         setData(res.data);
       }
 
@@ -98,6 +117,7 @@ export const Index = () => {
   const getMacData = React.useRef((mac, cb = () => {}) => {
     window.macController = new AbortController();
     window.macLoading = true;
+    window.lastMacFetch = Date.now();
     setLoading(true);
     axios.get(`/api/query/${mac}`, { signal: window.macController.signal })
       .then((res) => {
@@ -143,7 +163,9 @@ export const Index = () => {
           console.log('skip request. polling off');
         }
 
-        if (!window.macLoading && window.polling) {
+        const due = !window.streaming || Date.now() - window.lastMacFetch > RESYNC_INTERVAL;
+
+        if (!window.macLoading && window.polling && due) {
           getMacData(v.y, cb);
         }
       }, 5000);
@@ -156,6 +178,7 @@ export const Index = () => {
     window.polling = polling;
     window.controller.abort();
     clearInterval(window.ticker);
+    window.cursor = undefined;
     fetchData(timeframe);
 
     const enablePolling = timeframe <= 60;
@@ -167,12 +190,74 @@ export const Index = () => {
 
     window.ticker = setInterval(() => {
       window.controller = new AbortController();
-      if (!window.loading && window.polling) {
-        fetchData(timeframe)
+      const resync = Date.now() - window.lastFetch > RESYNC_INTERVAL;
+
+      if (!window.loading && window.polling && (resync || !window.streaming)) {
+        fetchData(timeframe, !resync)
       }
     }, 5000);
   }, [timeframe, count, polling, plotAll]);
 
+  React.useEffect(() => {
+    window.showNewMacs = count === 'all';
+  }, [count]);
+
+  /**
+   * Live updates
+   *
+   * `/api/stream` pushes new presence/rssi/data rows, new devices and
+   * name changes. Polling above falls back to every 5 seconds whenever
+   * the stream is disconnected.
+   */
+  React.useEffect(() => {
+    if (!window.EventSource) {
+      return;
+    }
+
+    const stream = new EventSource('/api/stream');
+
+    stream.onopen = () => { window.streaming = true; };
+    stream.onerror = () => { window.streaming = false; };
+
+    stream.addEventListener('batch', (e) => {
+      if (!window.polling) {
+        return;
+      }
+
+      const batch = JSON.parse(e.data);
+
+      setData((macs) => mergeRows(macs, batch));
+      setSelectedMac((mac) => (
+        mac ? mergeRows([mac], batch, ['presence', 'rssi', 'data'])[0] : mac
+      ));
+    });
+
+    stream.addEventListener('device', (e) => {
+      if (!window.polling || !window.showNewMacs) {
+        return;
+      }
+
+      const mac = JSON.parse(e.data);
+
+      setData((macs) => (
+        macs.some((m) => m.id === mac.id) ? macs : [...macs, mac]
+      ));
+    });
+
+    stream.addEventListener('name', (e) => {
+      const { id, name } = JSON.parse(e.data);
+      const rename = (m) => (m.id === id ? { ...m, name } : m);
+
+      setData((macs) => macs.map(rename));
+      setSelectedMac((mac) => (mac ? rename(mac) : mac));
+    });
+
+    return () => {
+      window.streaming = false;
+      stream.close();
+    };
+  }, []);
+
   const themeOverride = React.useMemo(() => 
     createTheme({
       ...theme,
@@ -33,3 +33,89 @@ export const uuidFilter = (f, m) => {
 
   return uuids.length > 0 || attrs.length > 0
 };
+
+/**
+ * mergeRows
+ *
+ * Appends pushed rows (from `/api/stream` batch events) to the
+ * matching macs. Only the macs that received rows are copied.
+ *
+ * @param {array} macs - loaded mac objects
+ * @param {object} batch - { presence: [], rssi: [], data: [] }
+ * @param {array} fields - which series to merge
+ * @return array
+ */
+export const mergeRows = (macs, batch, fields = ['presence']) => {
+  const byId = {};
+  const changed = {};
+
+  macs.forEach((m) => { byId[m.id] = m; });
+
+  fields.forEach((field) => {
+    (batch[field] || []).forEach((row) => {
+      const mac = byId[row.mac_id];
+
+      if (!mac) {
+        return;
+      }
+
+      if (!changed[mac.id]) {
+        changed[mac.id] = {
+          ...mac,
+          presence: [...mac.presence],
+          rssi: [...mac.rssi],
+          data: [...mac.data]
+        };
+        byId[mac.id] = changed[mac.id];
+      }
+
+      changed[mac.id][field].push(row);
+
+      if (row.time > changed[mac.id].last_seen) {
+        changed[mac.id].last_seen = row.time;
+      }
+    });
+  });
+
+  if (Object.keys(changed).length === 0) {
+    return macs;
+  }
+
+  return macs.map((m) => changed[m.id] || m);
+};
+
+/**
+ * mergeMacs
+ *
+ * Merges a `since=<cursor>` delta response into the loaded macs.
+ * Changed macs get their metadata replaced and the new presence
+ * points appended, new macs are added.
+ *
+ * @param {array} macs - loaded mac objects
+ * @param {array} delta - macs from the delta response
+ * @return array
+ */
+export const mergeMacs = (macs, delta) => {
+  const byId = {};
+
+  delta.forEach((d) => { byId[d.id] = d; });
+
+  const merged = macs.map((m) => {
+    const d = byId[m.id];
+
+    if (!d) {
+      return m;
+    }
+
+    delete byId[m.id];
+
+    return {
+      ...d,
+      presence: [...m.presence, ...d.presence],
+      rssi: [...m.rssi, ...d.rssi],
+      data: [...m.data, ...d.data]
+    };
+  });
+
+  return [...merged, ...Object.values(byId)];
+};